@@ -0,0 +1,64 @@
+# benchmarks/keyword_matcher_bench.py
+
+"""
+Микро-бенчмарк: прежняя проверка ключевых слов против KeywordMatcher.
+
+Запуск из корня репозитория:
+    python benchmarks/keyword_matcher_bench.py
+"""
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from components.keyword_matcher import KeywordMatcher
+
+ALPHABET = "абвгдежзийклмнопрстуфхцчшщыэюяabcdefghijklmnopqrstuvwxyz"
+
+
+def _random_word(rng, min_len=4, max_len=10):
+    return ''.join(rng.choice(ALPHABET) for _ in range(rng.randint(min_len, max_len)))
+
+
+def _naive_find_all(keywords, text):
+    # Так проверка выглядела в telegram_processor до KeywordMatcher
+    return [keyword for keyword in keywords if keyword.lower() in text.lower()]
+
+
+def run(keyword_count, message_count=500, seed=42):
+    rng = random.Random(seed)
+    keywords = list({_random_word(rng) for _ in range(keyword_count)})
+    messages = []
+    for _ in range(message_count):
+        words = [_random_word(rng, 2, 9) for _ in range(rng.randint(10, 60))]
+        if rng.random() < 0.2:
+            words.insert(rng.randrange(len(words)), rng.choice(keywords).upper())
+        messages.append(' '.join(words))
+
+    started = time.perf_counter()
+    matcher = KeywordMatcher(keywords)
+    build_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    naive_results = [_naive_find_all(keywords, text) for text in messages]
+    naive_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    matcher_results = [matcher.find_all(text) for text in messages]
+    matcher_seconds = time.perf_counter() - started
+
+    assert [sorted(r) for r in naive_results] == [sorted(r) for r in matcher_results], "Результаты не совпадают"
+
+    print(
+        f"{len(keywords):>6} слов, {message_count} сообщений: "
+        f"наивно {naive_seconds * 1000:8.1f} мс | автомат {matcher_seconds * 1000:7.1f} мс "
+        f"(+ построение {build_seconds * 1000:6.1f} мс) | ускорение x{naive_seconds / matcher_seconds:.1f}"
+    )
+
+
+if __name__ == "__main__":
+    for count in (10, 100, 1000, 5000):
+        run(count)
@@ -0,0 +1,46 @@
+# benchmarks/prefilter_recall.py
+
+"""
+Проверка полноты локального фильтра (components/prefilter.py) на реальных данных.
+
+Берет последние сообщения из ai_suggestions_log — на них агент уже отвечал или писал лидам,
+то есть фильтр не должен их отбрасывать — и сравнивает долю пропущенных с
+PREFILTER_RECALL_TARGET. Код выхода 1, если полнота ниже цели.
+
+Запуск из корня репозитория (нужен NEON_DB_CONNECTION_STRING):
+    python benchmarks/prefilter_recall.py [число сообщений]
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from components import config
+from components import database_manager as db
+from components import prefilter
+
+
+def main():
+    limit = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    try:
+        texts = db.get_logged_message_texts(limit)
+    finally:
+        db.close_pool()
+    if not texts:
+        print("ℹ️ В ai_suggestions_log нет сообщений для оценки.")
+        return 0
+
+    recall, rejected = prefilter.evaluate_recall(texts)
+    print(f"Сообщений: {len(texts)}, пропущено фильтром: {recall:.2%} (цель {config.PREFILTER_RECALL_TARGET:.0%})")
+    for text in rejected[:20]:
+        print(f"   отброшено: {text!r}")
+    if recall < config.PREFILTER_RECALL_TARGET:
+        print("❌ Полнота ниже цели: ослабьте PREFILTER_MIN_LETTERS или список стоп-фраз.")
+        return 1
+    print("✅ Полнота в пределах цели.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,9 +1,16 @@
 # components/ai_processor.py
 
+import asyncio
 import json
 import google.generativeai as genai
 from . import config
-from . import database_manager as db
+from . import async_database_manager as adb
+from . import token_estimator
+from . import response_cache
+from . import prefilter
+from . import structured_output
+from . import model_client
+from .structured_output import RoutingDecision, LeadDecision
 
 try:
     genai.configure(api_key=config.GEMINI_API_KEY)
@@ -14,21 +21,42 @@ except Exception as e:
     print(f"❌ Ошибка инициализации Gemini AI: {e}")
     exit()
 
+async def _count_prompt_tokens(model, full_prompt, stage, label):
+    """
+    Оценивает длину промпта локально (без сетевого запроса) и пишет ее в лог.
+    В отладочном режиме GEMINI_EXACT_TOKEN_COUNT дополнительно считает токены через API.
+    Возвращает оценку, которую затем нужно передать в token_estimator.record_usage.
+    """
+    estimated_tokens = token_estimator.estimate_tokens(full_prompt, stage)
+    if not config.GEMINI_EXACT_TOKEN_COUNT:
+        print(f"    📊 Длина промпта для {label}: ~{estimated_tokens} токенов (оценка).")
+        return estimated_tokens
+
+    try:
+        token_count = await model.count_tokens_async(full_prompt)
+        print(f"    📊 Длина промпта для {label}: {token_count.total_tokens} токенов (оценка: {estimated_tokens}).")
+    except Exception as e:
+        print(f"    ⚠️ Не удалось подсчитать токены для {label}: {e}")
+    return estimated_tokens
+
+
 # --- ФУНКЦИОНАЛ "АГЕНТ ВЛИЯНИЯ" ---
 
 async def get_routing_decisions(messages):
     """
     ЭТАП 1: Вызывает Gemini Flash для принятия решения: ответить или игнорировать.
+    Возвращает список RoutingDecision.
     """
     print("  🤖 Этап 1 (Агент влияния): Отправка сообщений на сортировку...")
-    prompt_template = db.get_prompt_template("router_prompt")
+    prompt_template = await adb.get_prompt_template("router_prompt")
     if not prompt_template:
         print("     ❌ Не найден 'router_prompt' в базе данных!")
         return []
 
+    # Реплики вроде "спасибо" и сообщения без букв отсеиваются локально, до сборки промпта
     messages_for_prompt = [
         {"message_id": msg.id, "text": msg.text.strip()}
-        for msg in messages if msg.text and not msg.text.isspace()
+        for msg in messages if prefilter.is_candidate(msg.text)
     ]
 
     if not messages_for_prompt:
@@ -37,16 +65,20 @@ async def get_routing_decisions(messages):
     messages_json = json.dumps(messages_for_prompt, ensure_ascii=False, indent=4)
     full_prompt = prompt_template.replace('{messages_for_prompt}', messages_json)
 
-    try:
-        # --- НОВАЯ ЛОГИКА: ПОДСЧЕТ ТОКЕНОВ ---
-        try:
-            token_count = await gemini_flash_model.count_tokens_async(full_prompt)
-            print(f"    📊 Длина промпта для Сортировщика: {token_count.total_tokens} токенов.")
-        except Exception as e:
-            print(f"    ⚠️ Не удалось подсчитать токены для Сортировщика: {e}")
-        # --- КОНЕЦ НОВОЙ ЛОГИКИ ---
+    cached_decisions = await response_cache.get(config.GEMINI_FLASH_MODEL_NAME, full_prompt)
+    if cached_decisions is not None:
+        print(f"     ✅ Сортировщик (Агент влияния): {len(cached_decisions)} решений взято из кэша.")
+        return structured_output.to_decisions(RoutingDecision, cached_decisions)
 
-        response = await gemini_flash_model.generate_content_async(full_prompt)
+    try:
+        estimated_tokens = await _count_prompt_tokens(gemini_flash_model, full_prompt, 'router', "Сортировщика")
+
+        response = await model_client.generate(
+            gemini_flash_model, config.GEMINI_FLASH_MODEL_NAME, 'router', full_prompt,
+            generation_config=structured_output.generation_config(structured_output.ROUTER_SCHEMA),
+            estimated_tokens=estimated_tokens
+        )
+        token_estimator.record_usage('router', estimated_tokens, response)
         
         # --- НОВАЯ ЛОГИКА: ПРОВЕРКА ОТВЕТА ---
         if not response.parts:
@@ -54,11 +86,20 @@ async def get_routing_decisions(messages):
             return []
         # --- КОНЕЦ НОВОЙ ЛОГИКИ ---
 
-        cleaned_response_text = response.text.strip().removeprefix('```json').removesuffix('```')
-        decisions = json.loads(cleaned_response_text)
+        items, complete = structured_output.parse_json_array(response.text)
+        decisions = structured_output.to_decisions(RoutingDecision, items)
+        if not complete:
+            print(f"     ⚠️ Ответ Сортировщика оборван или поврежден. Восстановлено решений: {len(decisions)}.")
         print(f"     ✅ Сортировщик (Агент влияния) принял {len(decisions)} решений.")
+        if complete:
+            await response_cache.put(config.GEMINI_FLASH_MODEL_NAME, full_prompt, [d.to_dict() for d in decisions])
         return decisions
+    except model_client.ModelCallError as e:
+        # Вызывающий код не отметит сообщения обработанными, и они будут разобраны в следующий раз
+        print(f"     ❌ Gemini Flash недоступен на этапе сортировки (Агент влияния): {e}")
+        raise
     except Exception as e:
+        # Сюда же попадает ModelRequestError: запрос отвергнут, и сообщения считаются разобранными
         print(f"     ❌ Критическая ошибка на этапе сортировки (Агент влияния): {e}")
         return []
 
@@ -70,20 +111,22 @@ async def generate_final_reply(conversation_history, persona: str, chat_id: int,
     prompt_name = f"{persona.lower()}_prompt"
     print(f"  🤖 Этап 2 (Агент влияния): Генерация ответа с личностью '{persona}'...")
 
-    prompt_template = db.get_prompt_template(prompt_name)
+    prompt_template = await adb.get_prompt_template(prompt_name)
     if not prompt_template:
         print(f"     ❌ Не найден промпт '{prompt_name}' в базе данных!")
         return None
 
     # --- ФОРМИРОВАНИЕ ПРИМЕРОВ ---
-    good_examples = db.get_examples_by_status(prompt_name, status='approved', limit=10)
+    # Удачные и неудачные примеры приходят одним запросом (и из кэша при повторных вызовах)
+    examples = await adb.get_examples_for_prompt(prompt_name, limit=10)
+    good_examples = examples['approved']
     good_examples_string = ""
     if good_examples:
         example_texts = [f"Исходное сообщение: {ex['original_message_text']}\nТвой удачный ответ: {ex['ai_generated_text']}" for ex in good_examples if ex.get('original_message_text') and ex.get('ai_generated_text')]
         if example_texts:
             good_examples_string = "Вот несколько свежих примеров твоих удачных ответов в этой роли. Изучи их, чтобы сохранить свой стиль:\n" + "\n---\n".join(example_texts)
 
-    bad_examples = db.get_examples_by_status(prompt_name, status='declined', limit=10)
+    bad_examples = examples['declined']
     bad_examples_string = ""
     if bad_examples:
         example_texts = [f"Исходное сообщение: {ex['original_message_text']}\nТвой НЕУДАЧНЫЙ ответ: {ex['ai_generated_text']}" for ex in bad_examples if ex.get('original_message_text') and ex.get('ai_generated_text')]
@@ -106,15 +149,14 @@ async def generate_final_reply(conversation_history, persona: str, chat_id: int,
     full_prompt = prompt_with_bad.replace('{conversation_history_json}', history_json_string)
     
     try:
-        # --- НОВАЯ ЛОГИКА: ПОДСЧЕТ ТОКЕНОВ ---
-        try:
-            token_count = await gemini_pro_model.count_tokens_async(full_prompt)
-            print(f"    📊 Длина промпта для Генератора '{persona}': {token_count.total_tokens} токенов.")
-        except Exception as e:
-            print(f"    ⚠️ Не удалось подсчитать токены для Генератора: {e}")
-        # --- КОНЕЦ НОВОЙ ЛОГИКИ ---
-
-        response = await gemini_pro_model.generate_content_async(full_prompt)
+        estimated_tokens = await _count_prompt_tokens(gemini_pro_model, full_prompt, 'reply', f"Генератора '{persona}'")
+
+        response = await model_client.generate(
+            gemini_pro_model, config.GEMINI_PRO_MODEL_NAME, 'reply', full_prompt,
+            generation_config=structured_output.generation_config(),
+            estimated_tokens=estimated_tokens
+        )
+        token_estimator.record_usage('reply', estimated_tokens, response)
         
         # --- НОВАЯ ЛОГИКА: ПРОВЕРКА ОТВЕТА, ЧТОБЫ СКРИПТ НЕ ПАДАЛ ---
         if not response.parts:
@@ -122,13 +164,11 @@ async def generate_final_reply(conversation_history, persona: str, chat_id: int,
             return None # Просто выходим из функции, если ответа нет
         # --- КОНЕЦ НОВОЙ ЛОГИКИ ---
         
-        cleaned_response_text = response.text.strip().removeprefix('```json').removesuffix('```')
-        ai_actions = json.loads(cleaned_response_text)
-
-        if not ai_actions:
+        # Формат ответа задается промптом личности, поэтому схема не навязывается, только JSON
+        action = structured_output.parse_json_object(response.text)
+        if not action:
+            print(f"     ❌ Ошибка (Агент влияния): Gemini Pro не вернул ни одного корректного JSON-объекта.")
             return None
-
-        action = ai_actions[0]
         
         original_message = conversation_history[-1] if conversation_history else None
         original_message_text = original_message.text if original_message else ""
@@ -145,61 +185,136 @@ async def generate_final_reply(conversation_history, persona: str, chat_id: int,
         })
         return action
 
-    except json.JSONDecodeError:
-        print(f"     ❌ Ошибка (Агент влияния): Gemini Pro вернул невалидный JSON.")
-        return None
+    except model_client.ModelCallError as e:
+        print(f"     ❌ Gemini Pro недоступен на этапе генерации ответа (Агент влияния): {e}")
+        raise
     except Exception as e:
+        # Сюда же попадает ModelRequestError: запрос отвергнут, и сообщения считаются разобранными
         print(f"     ❌ Критическая ошибка на этапе генерации ответа (Агент влияния): {e}")
         return None
 
 
 # --- ФУНКЦИОНАЛ "ОХОТНИК ЗА ЛИДАМИ" ---
 
+def _split_into_token_chunks(items, chunk_tokens, stage=None):
+    """Делит элементы на куски, каждый из которых в JSON занимает не больше chunk_tokens (кроме слишком длинных одиночных)."""
+    chunks = []
+    current, current_tokens = [], 0
+    for item in items:
+        item_tokens = token_estimator.estimate_tokens(json.dumps(item, ensure_ascii=False, indent=4), stage)
+        if current and current_tokens + item_tokens > chunk_tokens:
+            chunks.append(current)
+            current, current_tokens = [], 0
+        current.append(item)
+        current_tokens += item_tokens
+    if current:
+        chunks.append(current)
+    return chunks
+
+
 async def get_lead_decisions(messages):
     """
     ЭТАП 1 (Охотник): Вызывает Gemini Flash для КЛАССИФИКАЦИИ лидов.
+    Сообщения делятся на куски по LEAD_CLASSIFIER_CHUNK_TOKENS токенов, которые классифицируются
+    параллельно; решения объединяются по message_id. Куски сверх LEAD_CLASSIFIER_MAX_RUN_TOKENS
+    за вызов не отправляются. Возвращает список LeadDecision.
+    Если Gemini недоступен хотя бы для одной части, выбрасывает ModelCallError
+    (удачные части к тому времени уже в кэше ответов).
     """
     print("  🕵️‍♂️ Этап 1 (Охотник): Отправка сообщений на классификацию лидов...")
-    prompt_template = db.get_prompt_template("lead_finder_prompt")
+    prompt_template = await adb.get_prompt_template("lead_finder_prompt")
     if not prompt_template:
         print("     ❌ Не найден 'lead_finder_prompt' в базе данных!")
         return []
 
+    # Реплики вроде "спасибо" и сообщения без букв отсеиваются локально, до сборки промпта
     messages_for_prompt = [
         {"message_id": msg.id, "text": msg.text.strip()}
-        for msg in messages if msg.text and not msg.text.isspace()
+        for msg in messages if prefilter.is_candidate(msg.text)
     ]
 
     if not messages_for_prompt:
         return []
 
+    template_tokens = token_estimator.estimate_tokens(prompt_template, 'lead_classifier')
+    chunks = _split_into_token_chunks(messages_for_prompt, config.LEAD_CLASSIFIER_CHUNK_TOKENS, 'lead_classifier')
+
+    # --- ПОТОЛОК ТОКЕНОВ НА ЗАПУСК ---
+    selected_chunks, run_tokens = [], 0
+    for chunk in chunks:
+        chunk_tokens = template_tokens + sum(
+            token_estimator.estimate_tokens(json.dumps(item, ensure_ascii=False, indent=4), 'lead_classifier') for item in chunk
+        )
+        if selected_chunks and run_tokens + chunk_tokens > config.LEAD_CLASSIFIER_MAX_RUN_TOKENS:
+            skipped = sum(len(c) for c in chunks[len(selected_chunks):])
+            print(f"    ✂️ Достигнут потолок в {config.LEAD_CLASSIFIER_MAX_RUN_TOKENS} токенов на запуск. Пропущено сообщений: {skipped}.")
+            break
+        selected_chunks.append(chunk)
+        run_tokens += chunk_tokens
+
+    if len(selected_chunks) > 1:
+        print(f"    📦 Сообщения разбиты на {len(selected_chunks)} частей (~{run_tokens} токенов всего).")
+
+    semaphore = asyncio.Semaphore(config.LEAD_CLASSIFIER_CONCURRENCY)
+    chunk_results = await asyncio.gather(*(
+        _classify_lead_chunk(prompt_template, chunk, semaphore) for chunk in selected_chunks
+    ))
+
+    # Объединяем решения по message_id: по одному решению на сообщение, только для отправленных ID
+    sent_ids = {item['message_id'] for chunk in selected_chunks for item in chunk}
+    decisions_by_id = {}
+    for decisions in chunk_results:
+        for decision in decisions:
+            if decision.message_id in sent_ids and decision.message_id not in decisions_by_id:
+                decisions_by_id[decision.message_id] = decision
+
+    if len(selected_chunks) > 1:
+        print(f"     ✅ Классификатор (Охотник) принял {len(decisions_by_id)} решений по всем частям.")
+    return list(decisions_by_id.values())
+
+
+async def _classify_lead_chunk(prompt_template, messages_for_prompt, semaphore):
+    """Отправляет одну часть сообщений на классификацию лидов и возвращает список LeadDecision."""
     messages_json = json.dumps(messages_for_prompt, ensure_ascii=False, indent=4)
     full_prompt = prompt_template.replace('{messages_for_prompt}', messages_json)
 
-    try:
-        # --- НОВАЯ ЛОГИКА: ПОДСЧЕТ ТОКЕНОВ ---
+    cached_decisions = await response_cache.get(config.GEMINI_FLASH_MODEL_NAME, full_prompt)
+    if cached_decisions is not None:
+        print(f"     ✅ Классификатор (Охотник): {len(cached_decisions)} решений взято из кэша.")
+        return structured_output.to_decisions(LeadDecision, cached_decisions)
+
+    async with semaphore:
         try:
-            token_count = await gemini_flash_model.count_tokens_async(full_prompt)
-            print(f"    📊 Длина промпта для Классификатора лидов: {token_count.total_tokens} токенов.")
+            estimated_tokens = await _count_prompt_tokens(gemini_flash_model, full_prompt, 'lead_classifier', "Классификатора лидов")
+
+            response = await model_client.generate(
+                gemini_flash_model, config.GEMINI_FLASH_MODEL_NAME, 'lead_classifier', full_prompt,
+                generation_config=structured_output.generation_config(structured_output.LEAD_SCHEMA),
+                estimated_tokens=estimated_tokens
+            )
+            token_estimator.record_usage('lead_classifier', estimated_tokens, response)
+
+            # --- НОВАЯ ЛОГИКА: ПРОВЕРКА ОТВЕТА ---
+            if not response.parts:
+                print(f"    ❌ Ошибка (Классификатор лидов): Gemini Flash вернул пустой ответ. Причина: {response.candidates[0].finish_reason.name}")
+                return []
+            # --- КОНЕЦ НОВОЙ ЛОГИКИ ---
+
+            items, complete = structured_output.parse_json_array(response.text)
+            decisions = structured_output.to_decisions(LeadDecision, items)
+            if not complete:
+                print(f"    ⚠️ Ответ Классификатора лидов оборван или поврежден. Восстановлено решений: {len(decisions)}.")
+            print(f"     ✅ Классификатор (Охотник) принял {len(decisions)} решений.")
+            if complete:
+                await response_cache.put(config.GEMINI_FLASH_MODEL_NAME, full_prompt, [d.to_dict() for d in decisions])
+            return decisions
+        except model_client.ModelCallError as e:
+            # Сообщения не теряются: "Охотник" отложит их до следующего запуска
+            print(f"     ❌ Gemini Flash недоступен на этапе классификации лидов (Охотник): {e}")
+            raise
         except Exception as e:
-            print(f"    ⚠️ Не удалось подсчитать токены для Классификатора лидов: {e}")
-        # --- КОНЕЦ НОВОЙ ЛОГИКИ ---
-
-        response = await gemini_flash_model.generate_content_async(full_prompt)
-
-        # --- НОВАЯ ЛОГИКА: ПРОВЕРКА ОТВЕТА ---
-        if not response.parts:
-            print(f"    ❌ Ошибка (Классификатор лидов): Gemini Flash вернул пустой ответ. Причина: {response.candidates[0].finish_reason.name}")
+            print(f"     ❌ Критическая ошибка на этапе классификации лидов (Охотник): {e}")
             return []
-        # --- КОНЕЦ НОВОЙ ЛОГИКИ ---
-
-        cleaned_response_text = response.text.strip().removeprefix('```json').removesuffix('```')
-        decisions = json.loads(cleaned_response_text)
-        print(f"     ✅ Классификатор (Охотник) принял {len(decisions)} решений.")
-        return decisions
-    except Exception as e:
-        print(f"     ❌ Критическая ошибка на этапе классификации лидов (Охотник): {e}")
-        return []
 
 
 async def generate_lead_outreach_message(target_message):
@@ -207,7 +322,7 @@ async def generate_lead_outreach_message(target_message):
     ЭТАП 2 (Охотник): Вызывает Gemini Pro для ГЕНЕРАЦИИ персонального сообщения лиду.
     """
     print(f"  🕵️‍♂️ Этап 2 (Охотник): Генерация персонального сообщения для лида...")
-    prompt_template = db.get_prompt_template("lead_outreach_prompt")
+    prompt_template = await adb.get_prompt_template("lead_outreach_prompt")
     if not prompt_template:
         print("     ❌ Не найден 'lead_outreach_prompt' в базе данных!")
         return None
@@ -220,16 +335,20 @@ async def generate_lead_outreach_message(target_message):
     
     full_prompt = prompt_template.replace('{lead_message_json}', lead_message_json)
 
+    cached_action = await response_cache.get(config.GEMINI_PRO_MODEL_NAME, full_prompt)
+    if cached_action is not None:
+        print(f"     ✅ Текст для лида {target_message.sender.first_name} взят из кэша.")
+        return cached_action
+
     try:
-        # --- НОВАЯ ЛОГИКА: ПОДСЧЕТ ТОКЕНОВ ---
-        try:
-            token_count = await gemini_pro_model.count_tokens_async(full_prompt)
-            print(f"    📊 Длина промпта для Генератора лидов: {token_count.total_tokens} токенов.")
-        except Exception as e:
-            print(f"    ⚠️ Не удалось подсчитать токены для Генератора лидов: {e}")
-        # --- КОНЕЦ НОВОЙ ЛОГИКИ ---
+        estimated_tokens = await _count_prompt_tokens(gemini_pro_model, full_prompt, 'lead_outreach', "Генератора лидов")
 
-        response = await gemini_pro_model.generate_content_async(full_prompt)
+        response = await model_client.generate(
+            gemini_pro_model, config.GEMINI_PRO_MODEL_NAME, 'lead_outreach', full_prompt,
+            generation_config=structured_output.generation_config(structured_output.OUTREACH_SCHEMA),
+            estimated_tokens=estimated_tokens
+        )
+        token_estimator.record_usage('lead_outreach', estimated_tokens, response)
 
         # --- НОВАЯ ЛОГИКА: ПРОВЕРКА ОТВЕТА ---
         if not response.parts:
@@ -237,14 +356,18 @@ async def generate_lead_outreach_message(target_message):
             return None
         # --- КОНЕЦ НОВОЙ ЛОГИКИ ---
 
-        cleaned_response_text = response.text.strip().removeprefix('```json').removesuffix('```')
-        action = json.loads(cleaned_response_text)
+        action = structured_output.parse_json_object(response.text)
+        if not action:
+            print(f"     ❌ Ошибка (Охотник): Gemini Pro не вернул корректный JSON-объект.")
+            return None
         print(f"     ✅ Сгенерирован текст для лида: {target_message.sender.first_name}")
+        await response_cache.put(config.GEMINI_PRO_MODEL_NAME, full_prompt, action)
         return action
 
-    except json.JSONDecodeError:
-        print(f"     ❌ Ошибка (Охотник): Gemini Pro вернул невалидный JSON.")
-        return None
+    except model_client.ModelCallError as e:
+        # Лид не теряется: "Охотник" отложит его до следующего запуска
+        print(f"     ❌ Gemini Pro недоступен на этапе генерации сообщения лиду (Охотник): {e}")
+        raise
     except Exception as e:
         print(f"     ❌ Критическая ошибка на этапе генерации сообщения лиду (Охотник): {e}")
         return None
\ No newline at end of file
@@ -0,0 +1,122 @@
+# components/approval_outbox.py
+
+"""
+Надежная очередь (outbox) действий на утверждение.
+
+Если Cloudflare Worker тормозил или был недоступен, send_action_for_approval писал ошибку
+в лог, и сгенерированный ответ или лид терялся — а за Gemini Pro приходилось платить снова.
+Теперь каждое действие сначала записывается в таблицу approval_outbox с ключом
+идемпотентности (sha256 содержимого), а фоновая задача отправляет записи пачками
+и при ошибке откладывает повтор с растущей задержкой. Недоставленные записи из прошлых
+запусков отправляются в начале следующего (drain()).
+"""
+
+import asyncio
+import hashlib
+import json
+from . import config
+from . import async_database_manager as adb
+from . import approval_service
+
+_wakeup = asyncio.Event()
+_task = None
+
+
+def idempotency_key(action_data):
+    """Ключ идемпотентности: одинаковые действия получают одинаковый ключ."""
+    canonical = json.dumps(action_data, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+async def enqueue_many(actions):
+    """
+    Записывает действия в outbox и будит фоновую отправку. Возвращает True, если записи сохранены.
+    Если база недоступна, действия отправляются сразу напрямую, чтобы не потерять их.
+    """
+    if not actions:
+        return True
+    entries = [(idempotency_key(action), action) for action in actions]
+    if not await adb.enqueue_approval_actions(entries):
+        print("   ⚠️ Outbox недоступен. Действия отправляются на утверждение напрямую.")
+        results = await approval_service.send_actions_for_approval(
+            [{**action, 'idempotency_key': key} for key, action in entries]
+        )
+        return all(results)
+    print(f"   📥 Действий поставлено в очередь на утверждение: {len(entries)}.")
+    _wakeup.set()
+    return True
+
+
+async def enqueue(action_data):
+    """Записывает одно действие в outbox (см. enqueue_many)."""
+    return await enqueue_many([action_data])
+
+
+async def flush_once(due_only=True):
+    """
+    Отправляет одну пачку записей outbox. Возвращает число доставленных записей:
+    меньше OUTBOX_BATCH_SIZE — доставлять сейчас больше нечего (или воркер не принимает).
+    """
+    entries = await adb.get_outbox_entries(config.OUTBOX_BATCH_SIZE, due_only)
+    if not entries:
+        return 0
+
+    payloads = [{**payload, 'idempotency_key': key} for _, key, payload in entries]
+    results = await approval_service.send_actions_for_approval(payloads)
+
+    delivered = [entry_id for (entry_id, _, _), ok in zip(entries, results) if ok]
+    failed = [entry_id for (entry_id, _, _), ok in zip(entries, results) if not ok]
+    if delivered and not await adb.mark_outbox_delivered(delivered, config.OUTBOX_RETENTION_DAYS):
+        # Без отметки записи уйдут повторно, но ключ идемпотентности позволит воркеру их отбросить
+        return 0
+    if failed:
+        print(f"   ⏳ Не доставлено {len(failed)} действий из outbox. Повтор будет позже.")
+        if not await adb.reschedule_outbox_entries(
+            failed, "воркер не принял действие", config.OUTBOX_RETRY_BASE_SECONDS, config.OUTBOX_RETRY_MAX_SECONDS
+        ):
+            return 0
+    return len(delivered)
+
+
+async def _flush_available(due_only=True):
+    while await flush_once(due_only) == config.OUTBOX_BATCH_SIZE:
+        pass
+
+
+async def drain():
+    """Отправляет все недоставленные записи прошлых запусков, не дожидаясь времени их повтора."""
+    print("🔄 Отправка недоставленных действий из outbox...")
+    await _flush_available(due_only=False)
+
+
+async def _run():
+    while True:
+        try:
+            await asyncio.wait_for(_wakeup.wait(), timeout=config.OUTBOX_POLL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+        _wakeup.clear()
+        try:
+            await _flush_available()
+        except Exception as e:
+            print(f"❌ Ошибка фоновой отправки outbox: {e}")
+
+
+def start():
+    """Запускает фоновую отправку outbox в текущем цикле событий."""
+    global _task
+    if _task is None or _task.done():
+        _task = asyncio.create_task(_run())
+
+
+async def stop():
+    """Останавливает фоновую отправку и последний раз отправляет то, что уже можно."""
+    global _task
+    if _task is not None:
+        _task.cancel()
+        try:
+            await _task
+        except asyncio.CancelledError:
+            pass
+        _task = None
+    await _flush_available()
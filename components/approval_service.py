@@ -1,16 +1,115 @@
 # approval_service.py
-import requests
+
+"""
+Отправка сгенерированных действий на утверждение (Cloudflare Worker).
+
+Раньше каждый keyword_alert, ответ и лид отправлялся синхронным requests.post без сессии:
+новое TCP+TLS соединение на каждое действие и блокировка цикла asyncio на время запроса.
+Теперь асинхронный клиент держит пул соединений aiohttp с keep-alive и таймаутами, а если
+задан APPROVAL_BATCH_URL, отправляет много действий одним запросом {"actions": [...]}.
+send_action_for_approval() оставлена для синхронного кода и использует requests.Session.
+"""
+
+import asyncio
 import json
+import aiohttp
+import requests
 from . import config
 
+_HEADERS = {'Content-Type': 'application/json'}
+
+# --- Асинхронный клиент ---
+
+_session = None
+
+
+def _get_session():
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=config.APPROVAL_MAX_CONNECTIONS, keepalive_timeout=config.APPROVAL_KEEPALIVE_SECONDS
+            ),
+            timeout=aiohttp.ClientTimeout(
+                total=config.APPROVAL_TIMEOUT_SECONDS, connect=config.APPROVAL_CONNECT_TIMEOUT_SECONDS
+            ),
+            headers=_HEADERS,
+        )
+    return _session
+
+
+async def _post(url, payload):
+    # Ключ идемпотентности (из outbox) дублируется в заголовке, чтобы воркер мог отбросить повтор
+    key = payload.get('idempotency_key')
+    headers = {'Idempotency-Key': key} if key else None
+    async with _get_session().post(url, data=json.dumps(payload), headers=headers) as response:
+        response.raise_for_status()
+
+
+async def send_action_for_approval_async(action_data):
+    """Отправляет одно действие на утверждение. Возвращает True при успехе."""
+    msg_id = action_data.get('reply_to_message_id')
+    print(f"   📤 Отправка действия на утверждение для сообщения {msg_id}...")
+    try:
+        await _post(config.CLOUDFLARE_WORKER_URL, action_data)
+        print(f"   ✅ Действие для сообщения {msg_id} успешно отправлено.")
+        return True
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        print(f"   ❌ Ошибка отправки на утверждение для сообщения {msg_id}. Ошибка: {e!r}")
+        return False
+
+
+async def send_actions_for_approval(actions):
+    """
+    Отправляет несколько действий. С APPROVAL_BATCH_URL — пачками по APPROVAL_BATCH_SIZE
+    одним запросом на пачку, иначе — параллельными запросами по одному действию.
+    Возвращает список флагов успеха в порядке actions.
+    """
+    if not actions:
+        return []
+    if not config.APPROVAL_BATCH_URL:
+        return list(await asyncio.gather(*(send_action_for_approval_async(action) for action in actions)))
+
+    results = []
+    for start in range(0, len(actions), config.APPROVAL_BATCH_SIZE):
+        batch = actions[start:start + config.APPROVAL_BATCH_SIZE]
+        print(f"   📤 Отправка пачки из {len(batch)} действий на утверждение...")
+        try:
+            await _post(config.APPROVAL_BATCH_URL, {'actions': batch})
+            print(f"   ✅ Пачка из {len(batch)} действий успешно отправлена.")
+            results.extend([True] * len(batch))
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print(f"   ❌ Ошибка отправки пачки из {len(batch)} действий. Ошибка: {e!r}")
+            results.extend([False] * len(batch))
+    return results
+
+
+async def close():
+    """Закрывает пул соединений (в конце запуска)."""
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+
+# --- Синхронная совместимость ---
+
+_sync_session = requests.Session()
+_sync_session.headers.update(_HEADERS)
+
+
 def send_action_for_approval(action_data):
-    """Отправляет сгенерированное AI действие на утверждение."""
+    """Отправляет сгенерированное AI действие на утверждение (синхронно, с переиспользованием соединения)."""
     msg_id = action_data.get('reply_to_message_id')
     print(f"   📤 Отправка действия на утверждение для сообщения {msg_id}...")
     try:
-        headers = {'Content-Type': 'application/json'}
-        response = requests.post(config.CLOUDFLARE_WORKER_URL, data=json.dumps(action_data), headers=headers)
+        response = _sync_session.post(
+            config.CLOUDFLARE_WORKER_URL, data=json.dumps(action_data),
+            timeout=(config.APPROVAL_CONNECT_TIMEOUT_SECONDS, config.APPROVAL_TIMEOUT_SECONDS)
+        )
         response.raise_for_status() # Вызовет исключение для кодов 4xx/5xx
         print(f"   ✅ Действие для сообщения {msg_id} успешно отправлено.")
+        return True
     except requests.exceptions.RequestException as e:
-        print(f"   ❌ Ошибка отправки на утверждение для сообщения {msg_id}. Ошибка: {e}")
\ No newline at end of file
+        print(f"   ❌ Ошибка отправки на утверждение для сообщения {msg_id}. Ошибка: {e}")
+        return False
@@ -0,0 +1,104 @@
+# components/async_database_manager.py
+
+"""
+Асинхронный доступ к Neon с тем же набором функций, что и в database_manager.
+
+Весь агент работает на asyncio, а psycopg2 — синхронный: любой запрос из корутины
+замораживает обработку обновлений Telethon и параллельные ожидания Gemini.
+Здесь каждая функция database_manager выполняется в отдельном пуле потоков, размер
+которого равен размеру пула соединений, поэтому обработка чатов может идти параллельно
+с запросами к базе, а запрос никогда не упрется в исчерпанный пул соединений.
+
+Синхронный database_manager остается основной реализацией (SQL, пул, кэши, unit of work)
+и по-прежнему используется напрямую из скриптов вроде add_chats.py.
+"""
+
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from . import config
+from . import database_manager as db
+
+_executor = ThreadPoolExecutor(
+    max_workers=config.DB_POOL_MAX_CONNECTIONS,
+    thread_name_prefix="neon-db"
+)
+
+def _to_async(func):
+    """Превращает синхронную функцию database_manager в корутину, выполняемую в пуле потоков."""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_executor, functools.partial(func, *args, **kwargs))
+    return wrapper
+
+# --- Пул соединений, схема и unit of work ---
+init_db = _to_async(db.init_db)
+begin_unit_of_work = _to_async(db.begin_unit_of_work)
+end_unit_of_work = _to_async(db.end_unit_of_work)
+flush_pending_writes = _to_async(db.flush_pending_writes)
+get_pool_stats = _to_async(db.get_pool_stats)
+
+# --- Управление сессией ---
+get_session_string = _to_async(db.get_session_string)
+save_session_string = _to_async(db.save_session_string)
+
+# --- Работа с чатами и сообщениями ---
+get_target_chats = _to_async(db.get_target_chats)
+get_target_chats_with_state = _to_async(db.get_target_chats_with_state)
+save_chat_entity = _to_async(db.save_chat_entity)
+invalidate_chat_entity = _to_async(db.invalidate_chat_entity)
+get_last_message_id = _to_async(db.get_last_message_id)
+update_last_message_id = _to_async(db.update_last_message_id)
+get_last_post_time = _to_async(db.get_last_post_time)
+update_last_post_time = _to_async(db.update_last_post_time)
+
+# --- Работа с промптами и логами ---
+invalidate_prompt_cache = _to_async(db.invalidate_prompt_cache)
+get_prompt_template = _to_async(db.get_prompt_template)
+get_examples_for_prompt = _to_async(db.get_examples_for_prompt)
+get_examples_by_status = _to_async(db.get_examples_by_status)
+
+# --- Кэш ответов Gemini ---
+get_cached_ai_response = _to_async(db.get_cached_ai_response)
+save_cached_ai_response = _to_async(db.save_cached_ai_response)
+
+# --- Кластеры повторяющихся сообщений ---
+load_message_clusters = _to_async(db.load_message_clusters)
+save_message_clusters = _to_async(db.save_message_clusters)
+
+# --- Поправки оценки токенов ---
+load_token_corrections = _to_async(db.load_token_corrections)
+save_token_corrections = _to_async(db.save_token_corrections)
+
+# --- Очередь действий на утверждение (outbox) ---
+enqueue_approval_actions = _to_async(db.enqueue_approval_actions)
+get_outbox_entries = _to_async(db.get_outbox_entries)
+mark_outbox_delivered = _to_async(db.mark_outbox_delivered)
+reschedule_outbox_entries = _to_async(db.reschedule_outbox_entries)
+
+# --- Отложенные сообщения "Охотника за лидами" ---
+save_lead_retries = _to_async(db.save_lead_retries)
+get_lead_retries = _to_async(db.get_lead_retries)
+delete_lead_retries = _to_async(db.delete_lead_retries)
+
+# --- Работа с отложенными действиями ---
+claim_pending_actions = _to_async(db.claim_pending_actions)
+extend_action_leases = _to_async(db.extend_action_leases)
+release_claimed_actions = _to_async(db.release_claimed_actions)
+mark_action_as_completed = _to_async(db.mark_action_as_completed)
+record_action_deliveries = _to_async(db.record_action_deliveries)
+
+# --- Уведомления о новых действиях (LISTEN/NOTIFY) ---
+open_notification_listener = _to_async(db.open_notification_listener)
+
+# --- Работа со статусом агента ---
+is_agent_active = _to_async(db.is_agent_active)
+get_last_initialization_date = _to_async(db.get_last_initialization_date)
+update_initialization_date = _to_async(db.update_initialization_date)
+
+# --- Ключевые слова и контакты ---
+get_keyword_triggers = _to_async(db.get_keyword_triggers)
+was_user_contacted_today = _to_async(db.was_user_contacted_today)
+record_user_contact = _to_async(db.record_user_contact)
+
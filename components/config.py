@@ -9,18 +9,105 @@ load_dotenv()
 TELEGRAM_API_ID = os.getenv('TELEGRAM_API_ID')
 TELEGRAM_API_HASH = os.getenv('TELEGRAM_API_HASH')
 SESSION_NAME = os.getenv("SESSION_NAME", "hr_vision_agent_session")
+# Сколько страниц истории (по 100 сообщений) максимум читать из одного чата за запуск
+TELEGRAM_MAX_PAGES_PER_CHAT = int(os.getenv('TELEGRAM_MAX_PAGES_PER_CHAT', '5'))
+# Сколько чатов обрабатывается одновременно и как долго можно ждать по FloodWait
+CHAT_PROCESSING_CONCURRENCY = int(os.getenv('CHAT_PROCESSING_CONCURRENCY', '4'))
+FLOOD_WAIT_MAX_SECONDS = int(os.getenv('FLOOD_WAIT_MAX_SECONDS', '300'))
+FLOOD_WAIT_MAX_RETRIES = int(os.getenv('FLOOD_WAIT_MAX_RETRIES', '2'))
+# Отправка одобренных действий: сколько получателей обслуживается одновременно
+SENDER_CONCURRENCY = int(os.getenv('SENDER_CONCURRENCY', '8'))
+# Захват действий на отправку: размер страницы и срок аренды (должен покрывать отправку страницы вместе с FloodWait)
+SENDER_PAGE_SIZE = int(os.getenv('SENDER_PAGE_SIZE', '50'))
+SENDER_LEASE_SECONDS = int(os.getenv('SENDER_LEASE_SECONDS', '900'))
+# Режим доставки: резервный опрос очереди (если уведомление потерялось) и пауза для сбора пачки уведомлений
+DELIVERY_POLL_SECONDS = int(os.getenv('DELIVERY_POLL_SECONDS', '60'))
+DELIVERY_DEBOUNCE_SECONDS = float(os.getenv('DELIVERY_DEBOUNCE_SECONDS', '1'))
+# Через сколько дней access_hash и связанный чат из кэша target_chats перепроверяются через Telegram
+ENTITY_CACHE_TTL_DAYS = int(os.getenv('ENTITY_CACHE_TTL_DAYS', '7'))
+# Искать ключевые слова только целыми словами (по умолчанию — как подстроки)
+KEYWORD_MATCH_WHOLE_WORDS = os.getenv('KEYWORD_MATCH_WHOLE_WORDS', 'false').lower() == 'true'
+# Режим демона: окно накопления пачки, ее максимальный размер и период перечитывания настроек из базы
+DAEMON_BATCH_SECONDS = int(os.getenv('DAEMON_BATCH_SECONDS', '60'))
+DAEMON_MAX_BATCH_SIZE = int(os.getenv('DAEMON_MAX_BATCH_SIZE', '500'))
+DAEMON_REFRESH_SECONDS = int(os.getenv('DAEMON_REFRESH_SECONDS', '600'))
+# Сколько персональных сообщений лидам генерируется одновременно (Gemini Pro)
+LEAD_OUTREACH_CONCURRENCY = int(os.getenv('LEAD_OUTREACH_CONCURRENCY', '4'))
+# Отложенные из-за недоступности Gemini сообщения "Охотника": сколько брать за запуск и сколько часов хранить
+LEAD_RETRY_BATCH_SIZE = int(os.getenv('LEAD_RETRY_BATCH_SIZE', '500'))
+LEAD_RETRY_MAX_AGE_HOURS = int(os.getenv('LEAD_RETRY_MAX_AGE_HOURS', '24'))
+# Классификатор лидов: размер одной части промпта, сколько частей идут параллельно и потолок токенов на запуск
+LEAD_CLASSIFIER_CHUNK_TOKENS = int(os.getenv('LEAD_CLASSIFIER_CHUNK_TOKENS', '8000'))
+LEAD_CLASSIFIER_CONCURRENCY = int(os.getenv('LEAD_CLASSIFIER_CONCURRENCY', '4'))
+LEAD_CLASSIFIER_MAX_RUN_TOKENS = int(os.getenv('LEAD_CLASSIFIER_MAX_RUN_TOKENS', '200000'))
+# Подавление повторяющихся сообщений: минимальная длина нормализованного текста,
+# порог расстояния Хэмминга между SimHash и сколько дней помнить кластеры
+DEDUP_MIN_TEXT_LENGTH = int(os.getenv('DEDUP_MIN_TEXT_LENGTH', '40'))
+DEDUP_MAX_HAMMING_DISTANCE = int(os.getenv('DEDUP_MAX_HAMMING_DISTANCE', '3'))
+DEDUP_WINDOW_DAYS = int(os.getenv('DEDUP_WINDOW_DAYS', '14'))
+# Локальный фильтр перед Gemini Flash: минимум букв в сообщении без вопроса и целевая полнота
+PREFILTER_ENABLED = os.getenv('PREFILTER_ENABLED', 'true').lower() == 'true'
+PREFILTER_MIN_LETTERS = int(os.getenv('PREFILTER_MIN_LETTERS', '8'))
+PREFILTER_RECALL_TARGET = float(os.getenv('PREFILTER_RECALL_TARGET', '0.98'))
 
 # --- Конфигурация базы данных Neon ---
 # 👇 УДАЛИЛИ SUPABASE_URL и SUPABASE_KEY, ЗАМЕНИЛИ НА ЭТО:
 DATABASE_URL = os.getenv('NEON_DB_CONNECTION_STRING')
+# Пул соединений: сколько соединений держать открытыми и как часто проверять простаивающие.
+# psycopg2 закрывает возвращенное соединение, если свободных уже DB_POOL_MIN_CONNECTIONS,
+# поэтому по умолчанию минимум равен максимуму: иначе параллельные запросы каждый раз открывали бы новое
+DB_POOL_MAX_CONNECTIONS = int(os.getenv('DB_POOL_MAX_CONNECTIONS', '10'))
+DB_POOL_MIN_CONNECTIONS = int(os.getenv('DB_POOL_MIN_CONNECTIONS', str(DB_POOL_MAX_CONNECTIONS)))
+DB_HEALTHCHECK_INTERVAL_SECONDS = int(os.getenv('DB_HEALTHCHECK_INTERVAL_SECONDS', '30'))
+# Прямое (не через пулер) подключение для LISTEN/NOTIFY: пулер Neon в режиме транзакций не передает уведомления
+DATABASE_LISTEN_URL = os.getenv('NEON_DB_DIRECT_CONNECTION_STRING') or DATABASE_URL
 
 # --- Конфигурация Gemini AI ---
 GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
 GEMINI_FLASH_MODEL_NAME = 'gemini-2.5-flash'
 GEMINI_PRO_MODEL_NAME = 'gemini-2.5-pro'
+# Как долго промпты и примеры из Neon считаются актуальными без повторной проверки
+PROMPT_CACHE_TTL_SECONDS = int(os.getenv('PROMPT_CACHE_TTL_SECONDS', '300'))
+# Отладка: точный подсчет токенов промпта через API Gemini (лишний сетевой запрос на каждый вызов)
+GEMINI_EXACT_TOKEN_COUNT = os.getenv('GEMINI_EXACT_TOKEN_COUNT', 'false').lower() == 'true'
+# Кэш ответов Gemini: срок жизни записи, максимум записей и обход кэша для экспериментов с промптами
+AI_CACHE_TTL_HOURS = int(os.getenv('AI_CACHE_TTL_HOURS', '48'))
+AI_CACHE_MAX_ENTRIES = int(os.getenv('AI_CACHE_MAX_ENTRIES', '5000'))
+AI_CACHE_BYPASS = os.getenv('AI_CACHE_BYPASS', 'false').lower() == 'true'
+# Надежность вызовов Gemini: таймауты этапов, повторы с задержкой, дублирующие запросы и автомат защиты
+GEMINI_ROUTER_TIMEOUT_SECONDS = float(os.getenv('GEMINI_ROUTER_TIMEOUT_SECONDS', '60'))
+GEMINI_REPLY_TIMEOUT_SECONDS = float(os.getenv('GEMINI_REPLY_TIMEOUT_SECONDS', '120'))
+GEMINI_LEAD_CLASSIFIER_TIMEOUT_SECONDS = float(os.getenv('GEMINI_LEAD_CLASSIFIER_TIMEOUT_SECONDS', '90'))
+GEMINI_LEAD_OUTREACH_TIMEOUT_SECONDS = float(os.getenv('GEMINI_LEAD_OUTREACH_TIMEOUT_SECONDS', '120'))
+GEMINI_MAX_RETRIES = int(os.getenv('GEMINI_MAX_RETRIES', '3'))
+GEMINI_BACKOFF_BASE_SECONDS = float(os.getenv('GEMINI_BACKOFF_BASE_SECONDS', '2'))
+GEMINI_BACKOFF_MAX_SECONDS = float(os.getenv('GEMINI_BACKOFF_MAX_SECONDS', '60'))
+GEMINI_HEDGE_STAGES = {stage.strip() for stage in os.getenv('GEMINI_HEDGE_STAGES', 'reply,lead_outreach').split(',') if stage.strip()}
+GEMINI_HEDGE_DELAY_SECONDS = float(os.getenv('GEMINI_HEDGE_DELAY_SECONDS', '45'))
+GEMINI_BREAKER_FAILURE_THRESHOLD = int(os.getenv('GEMINI_BREAKER_FAILURE_THRESHOLD', '5'))
+GEMINI_BREAKER_COOLDOWN_SECONDS = float(os.getenv('GEMINI_BREAKER_COOLDOWN_SECONDS', '120'))
+# Квоты Gemini в минуту (запросы и токены) для клиентского ограничителя; 0 — без ограничения
+GEMINI_FLASH_RPM = int(os.getenv('GEMINI_FLASH_RPM', '1000'))
+GEMINI_FLASH_TPM = int(os.getenv('GEMINI_FLASH_TPM', '1000000'))
+GEMINI_PRO_RPM = int(os.getenv('GEMINI_PRO_RPM', '150'))
+GEMINI_PRO_TPM = int(os.getenv('GEMINI_PRO_TPM', '2000000'))
 
 # --- Конфигурация Внешних Сервисов ---
 CLOUDFLARE_WORKER_URL = os.getenv('CLOUDFLARE_WORKER_URL')
+# Необязательный адрес воркера, принимающего пачку действий {"actions": [...]} одним запросом
+APPROVAL_BATCH_URL = os.getenv('APPROVAL_BATCH_URL')
+APPROVAL_BATCH_SIZE = int(os.getenv('APPROVAL_BATCH_SIZE', '50'))
+# HTTP-клиент воркера: таймауты, размер пула соединений и время жизни простаивающего соединения
+APPROVAL_TIMEOUT_SECONDS = float(os.getenv('APPROVAL_TIMEOUT_SECONDS', '15'))
+APPROVAL_CONNECT_TIMEOUT_SECONDS = float(os.getenv('APPROVAL_CONNECT_TIMEOUT_SECONDS', '5'))
+APPROVAL_MAX_CONNECTIONS = int(os.getenv('APPROVAL_MAX_CONNECTIONS', '10'))
+APPROVAL_KEEPALIVE_SECONDS = float(os.getenv('APPROVAL_KEEPALIVE_SECONDS', '30'))
+# Outbox действий на утверждение: размер пачки, период фоновой отправки, задержки повторов и срок хранения
+OUTBOX_BATCH_SIZE = int(os.getenv('OUTBOX_BATCH_SIZE', '50'))
+OUTBOX_POLL_SECONDS = float(os.getenv('OUTBOX_POLL_SECONDS', '15'))
+OUTBOX_RETRY_BASE_SECONDS = float(os.getenv('OUTBOX_RETRY_BASE_SECONDS', '30'))
+OUTBOX_RETRY_MAX_SECONDS = float(os.getenv('OUTBOX_RETRY_MAX_SECONDS', '3600'))
+OUTBOX_RETENTION_DAYS = int(os.getenv('OUTBOX_RETENTION_DAYS', '7'))
 
 def validate_config():
     """Проверяет, что все необходимые переменные окружения установлены."""
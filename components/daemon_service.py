@@ -0,0 +1,188 @@
+# components/daemon_service.py
+
+"""
+Режим демона: агент постоянно подключен к Telegram и реагирует на новые сообщения.
+
+Вместо запуска `python -u main.py` по расписанию (со стартом Python, импортом Gemini,
+подключением к Neon и Telegram и полным опросом всех чатов) демон подписывается на
+events.NewMessage и копит входящие сообщения целевых чатов в очереди. Каждые
+DAEMON_BATCH_SECONDS накопленная пачка проходит через тот же конвейер, что и разовый запуск:
+process_chats_for_engagement (с часовым лимитом и правилом "один контакт в день") и
+"Охотника за лидами".
+Если чат в пачке не обработан (часовой лимит, сбой Gemini, ошибка), его сообщения не теряются:
+в следующих пачках он читается из Telegram от сохраненного last_message_id, пока не догонит события.
+Так же после запуска (или добавления в список) читается каждый чат, пока не будет дочитан хотя бы раз:
+события не покрывают сообщения, пришедшие, пока демон не работал.
+Параллельно демон доставляет одобренные действия по уведомлениям Neon (см. delivery_service.py).
+"""
+
+import asyncio
+import time
+from datetime import date
+from telethon import events
+from . import config
+from . import async_database_manager as adb
+from . import entity_cache
+from . import dedup
+from . import token_estimator
+from . import delivery_service
+from . import telegram_processor
+from . import lead_hunter_service
+from .keyword_matcher import KeywordMatcher
+
+
+async def _load_watch_list(client, target_chats):
+    """
+    Возвращает {ID чата, из которого читаем сообщения: chat_info}.
+    Для каналов это чат комментариев, каналы без комментариев пропускаются.
+    """
+    watch = {}
+    for chat_info in target_chats:
+        try:
+            _, linked_chat_id, _ = await entity_cache.resolve_chat(client, chat_info)
+        except Exception as e:
+            print(f"❌ Не удалось разрешить чат {chat_info['chat_id']} для подписки: {e}")
+            continue
+        if chat_info.get('chat_type') == 'channel':
+            if linked_chat_id:
+                watch[linked_chat_id] = chat_info
+        else:
+            watch[chat_info['chat_id']] = chat_info
+    return watch
+
+
+async def _collect_batch(queue, idle_timeout):
+    """
+    Ждет первое сообщение не дольше idle_timeout секунд (иначе возвращает пустой список)
+    и затем добирает все, что придет за DAEMON_BATCH_SECONDS.
+    """
+    try:
+        batch = [await asyncio.wait_for(queue.get(), timeout=idle_timeout)]
+    except asyncio.TimeoutError:
+        return []
+    deadline = time.monotonic() + config.DAEMON_BATCH_SECONDS
+    while len(batch) < config.DAEMON_MAX_BATCH_SIZE:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            batch.append(await asyncio.wait_for(queue.get(), timeout=remaining))
+        except asyncio.TimeoutError:
+            break
+    return batch
+
+
+async def run_daemon(client, my_id, initialize_day):
+    """
+    Основной цикл демона. Работает, пока агент активен в базе данных.
+    initialize_day — корутина первой инициализации дня (initialize_first_run_of_day из main.py).
+    """
+    print("\n--- 🛰️ ЗАПУСК HR VISION AGENT (РЕЖИМ ДЕМОНА) ---\n")
+
+    watch = {}
+    keyword_matcher = None
+    refreshed_at = 0.0
+    current_day = date.today()
+    queue = asyncio.Queue()
+    # Чаты, сообщения которых пришли событиями, но еще не обработаны:
+    # {chat_id из target_chats: (ID чата, из которого читаем, максимальный ID полученного сообщения)}
+    backlog = {}
+    # Чаты, которые с момента запуска (или добавления в список) еще ни разу не были дочитаны из Telegram:
+    # события не покрывают сообщения между сохраненным last_message_id и первым событием
+    unsynced = set()
+
+    async def on_new_message(event):
+        # Фильтруем сами, по словарю watch: он обновляется без перерегистрации обработчика
+        if event.chat_id in watch:
+            queue.put_nowait((event.chat_id, event.message))
+
+    async def refresh():
+        nonlocal watch, keyword_matcher, refreshed_at
+        if not await adb.is_agent_active():
+            print("⏹️ Агент деактивирован. Демон останавливается.")
+            return False
+        target_chats = await adb.get_target_chats_with_state()
+        new_watch = await _load_watch_list(client, target_chats)
+        unsynced.update(
+            chat_info['chat_id'] for source_chat_id, chat_info in new_watch.items() if source_chat_id not in watch
+        )
+        watch = new_watch
+        keyword_matcher = KeywordMatcher(
+            await adb.get_keyword_triggers(), whole_words=config.KEYWORD_MATCH_WHOLE_WORDS
+        )
+        refreshed_at = time.monotonic()
+        print(f"👂 Демон слушает {len(watch)} чатов. Пачки по {config.DAEMON_BATCH_SECONDS} с.")
+        return True
+
+    client.add_event_handler(on_new_message, events.NewMessage(incoming=True))
+    delivery_service.start(client)
+    try:
+        # Список чатов нужен обработчику событий до catch_up, иначе догнанные обновления отбрасываются
+        if not await refresh():
+            return
+        # Догоняем обновления, пропущенные с прошлого отключения (состояние хранится в PostgresSession)
+        await client.catch_up()
+
+        while True:
+            if time.monotonic() - refreshed_at >= config.DAEMON_REFRESH_SECONDS:
+                if not await refresh():
+                    return
+
+            # Недочитанные чаты не должны ждать первого события до DAEMON_REFRESH_SECONDS
+            idle_timeout = config.DAEMON_BATCH_SECONDS if unsynced else config.DAEMON_REFRESH_SECONDS
+            batch = await _collect_batch(queue, idle_timeout=idle_timeout)
+            if not batch and not backlog and not unsynced:
+                continue
+
+            # Свежее состояние (последний ID, время последнего ответа) — одним запросом на пачку
+            states = {chat['chat_id']: chat for chat in await adb.get_target_chats_with_state()}
+            lagging = {chat_id for chat_id in set(backlog) | unsynced if chat_id in states}
+            messages_by_chat = {}
+            for source_chat_id, message in batch:
+                chat_info = watch.get(source_chat_id)
+                if chat_info:
+                    chat_id = chat_info['chat_id']
+                    messages_by_chat.setdefault(chat_id, []).append(message)
+                    if message.text:
+                        _, newest_id = backlog.get(chat_id, (source_chat_id, 0))
+                        backlog[chat_id] = (source_chat_id, max(newest_id, message.id))
+
+            # Чаты с необработанными сообщениями из прошлых пачек и еще не дочитанные после запуска
+            # читаются из Telegram от сохраненного last_message_id, остальные — из накопленных событий
+            prefetched = {chat_id: messages for chat_id, messages in messages_by_chat.items() if chat_id not in lagging}
+            chats_to_process = [states[chat_id] for chat_id in set(messages_by_chat) | lagging if chat_id in states]
+            print(f"\n--- 📨 Пачка из {len(batch)} сообщений в {len(chats_to_process)} чатах ---")
+
+            completed_chats = set()
+            messages_for_lead_hunter = await telegram_processor.process_chats_for_engagement(
+                client, chats_to_process, my_id, keyword_matcher,
+                prefetched_messages=prefetched, completed_chats=completed_chats
+            )
+            unsynced -= completed_chats & lagging
+            await adb.flush_pending_writes()
+
+            # Вызывается и без новых сообщений: "Охотник" дообрабатывает отложенные из-за сбоя Gemini
+            await lead_hunter_service.find_and_process_leads(client, messages_for_lead_hunter or [])
+            await adb.flush_pending_writes()
+            await dedup.save()
+            await token_estimator.save()
+
+            # Чат, пропущенный по часовому лимиту, из-за сбоя Gemini или ошибки, остается в backlog,
+            # пока его last_message_id не догонит последнее полученное сообщение
+            unsynced &= set(states)
+            for chat_id, (source_chat_id, newest_id) in list(backlog.items()):
+                if chat_id not in states or await adb.get_last_message_id(source_chat_id) >= newest_id:
+                    del backlog[chat_id]
+            if backlog:
+                print(f"⏳ Чатов с отложенными сообщениями: {len(backlog)}. Они будут прочитаны из Telegram в следующий раз.")
+
+            if date.today() != current_day:
+                # Пачка уже обработана; инициализация дня переносит ID последних сообщений на текущие
+                await initialize_day(client)
+                current_day = date.today()
+                refreshed_at = 0.0
+                backlog.clear()
+                unsynced.clear()
+    finally:
+        await delivery_service.stop()
+        client.remove_event_handler(on_new_message)
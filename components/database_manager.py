@@ -1,18 +1,415 @@
 # components/database_manager.py - НОВЫЙ КОД ДЛЯ NEON
 
+import time
+import threading
+from contextlib import contextmanager
 import psycopg2
+import psycopg2.errors
+import psycopg2.extensions
 import psycopg2.extras  # Необходим для получения результатов в виде словарей
-from datetime import date, datetime
+import psycopg2.pool
+import psycopg2.sql
+from datetime import date, datetime, timezone
 from . import config
 
+# Канал NOTIFY, в который триггер pending_actions_notify пишет id новых действий
+PENDING_ACTIONS_CHANNEL = 'pending_actions'
+
+# --- Пул соединений ---
+# Каждое новое соединение с Neon — это полноценное TLS-рукопожатие и "холодный" старт пулера,
+# поэтому все функции модуля берут соединения из одного общего пула и возвращают их обратно.
+_pool = None
+_pool_lock = threading.Lock()
+_pool_stats = {'opened': 0, 'reused': 0, 'reconnected': 0}
+
+class _PooledConnection(psycopg2.extensions.connection):
+    """Соединение пула, которое помнит, когда его последний раз вернули в пул (None — еще не использовалось)."""
+    last_used = None
+
+def _get_pool():
+    """Возвращает общий пул соединений, создавая его при первом обращении."""
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool.closed:
+            try:
+                _pool = psycopg2.pool.ThreadedConnectionPool(
+                    config.DB_POOL_MIN_CONNECTIONS,
+                    config.DB_POOL_MAX_CONNECTIONS,
+                    config.DATABASE_URL,
+                    connection_factory=_PooledConnection,
+                    # TCP keepalive не дает прокси Neon молча оборвать простаивающее соединение
+                    keepalives=1, keepalives_idle=30, keepalives_interval=10, keepalives_count=3
+                )
+            except Exception as e:
+                print(f"❌ КРИТИЧЕСКАЯ ОШИБКА: Не удалось подключиться к базе данных Neon: {e}")
+                exit()
+        return _pool
+
+def _is_connection_healthy(conn):
+    """Проверяет соединение перед выдачей. Долго простаивавшие соединения пингуются через SELECT 1."""
+    if conn.closed:
+        return False
+    last_used = conn.last_used
+    if last_used is None or time.monotonic() - last_used < config.DB_HEALTHCHECK_INTERVAL_SECONDS:
+        return True
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1")
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+def _discard_connection(pool, conn):
+    try:
+        pool.putconn(conn, close=True)
+    except Exception:
+        pass
+
+def _checkout_connection(pool):
+    """Берет из пула живое соединение, при необходимости переподключаясь."""
+    for _ in range(3):
+        try:
+            conn = pool.getconn()
+        except psycopg2.pool.PoolError:
+            raise
+        except Exception as e:
+            print(f"❌ КРИТИЧЕСКАЯ ОШИБКА: Не удалось подключиться к базе данных Neon: {e}")
+            exit()
+
+        is_new = conn.last_used is None
+        if _is_connection_healthy(conn):
+            with _pool_lock:
+                _pool_stats['opened' if is_new else 'reused'] += 1
+            return conn
+
+        print("⚠️ Соединение с Neon потеряно. Переподключаемся...")
+        with _pool_lock:
+            _pool_stats['reconnected'] += 1
+        _discard_connection(pool, conn)
+
+    print("❌ КРИТИЧЕСКАЯ ОШИБКА: Не удалось получить рабочее соединение с Neon.")
+    exit()
+
+@contextmanager
 def _get_db_connection():
-    """Создает и возвращает новое соединение с базой данных Neon."""
+    """
+    Выдает соединение из пула на время блока `with`.
+    Транзакция фиксируется при успешном выходе и откатывается при ошибке,
+    после чего соединение возвращается в пул (или закрывается, если оно сломано).
+    """
+    pool = _get_pool()
+    conn = _checkout_connection(pool)
+    broken = False
     try:
-        conn = psycopg2.connect(config.DATABASE_URL)
-        return conn
+        with conn:
+            yield conn
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        broken = True
+        raise
+    finally:
+        if broken or conn.closed:
+            _discard_connection(pool, conn)
+        else:
+            conn.last_used = time.monotonic()
+            pool.putconn(conn)
+
+def get_pool_stats():
+    """Возвращает счетчики пула: сколько соединений открыто, переиспользовано и пересоздано."""
+    with _pool_lock:
+        return dict(_pool_stats)
+
+def close_pool():
+    """Закрывает все соединения пула и печатает итоговую статистику."""
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool.closed:
+            return
+        _pool.closeall()
+        _pool = None
+        stats = dict(_pool_stats)
+    print(
+        f"🔌 Пул соединений с Neon закрыт. Открыто соединений: {stats['opened']}, "
+        f"переиспользовано: {stats['reused']}, переподключений: {stats['reconnected']}."
+    )
+
+# --- Отложенная запись состояния (unit of work) ---
+# Пока unit of work активен, update_last_message_id, update_last_post_time, record_user_contact
+# и mark_action_as_completed не пишут в базу сразу, а копят изменения в памяти.
+# flush_pending_writes() сбрасывает их несколькими многострочными upsert'ами в одной транзакции:
+# после сбоя в середине запуска состояние в базе соответствует последней контрольной точке.
+_unit_of_work_active = False
+_pending_lock = threading.Lock()
+_pending_writes = {
+    'last_message_ids': {},     # chat_id -> message_id
+    'post_times': {},           # chat_id -> datetime (UTC)
+    'user_contacts': {},        # user_id -> date
+    'completed_actions': set(), # id из pending_actions
+}
+
+def begin_unit_of_work():
+    """Включает буферизацию записей состояния до вызова flush_pending_writes()/end_unit_of_work()."""
+    global _unit_of_work_active
+    _unit_of_work_active = True
+
+def end_unit_of_work():
+    """Сбрасывает накопленные изменения и возвращает модуль к немедленной записи."""
+    global _unit_of_work_active
+    result = flush_pending_writes()
+    _unit_of_work_active = False
+    return result
+
+def _has_pending_writes(pending):
+    return any(pending.values())
+
+def _restore_pending_writes(snapshot):
+    """Возвращает несохраненные изменения в буфер, не затирая более свежие значения."""
+    with _pending_lock:
+        for key in ('last_message_ids', 'post_times', 'user_contacts'):
+            for item_id, value in snapshot[key].items():
+                _pending_writes[key].setdefault(item_id, value)
+        _pending_writes['completed_actions'] |= snapshot['completed_actions']
+
+def flush_pending_writes():
+    """
+    Контрольная точка: записывает все накопленные изменения в одной транзакции.
+    Возвращает True, если буфер пуст или запись прошла успешно.
+    """
+    with _pending_lock:
+        snapshot = {
+            'last_message_ids': dict(_pending_writes['last_message_ids']),
+            'post_times': dict(_pending_writes['post_times']),
+            'user_contacts': dict(_pending_writes['user_contacts']),
+            'completed_actions': set(_pending_writes['completed_actions']),
+        }
+        for value in _pending_writes.values():
+            value.clear()
+
+    if not _has_pending_writes(snapshot):
+        return True
+
+    print(
+        f"🔄 Сохранение состояния запуска: {len(snapshot['last_message_ids'])} ID сообщений, "
+        f"{len(snapshot['post_times'])} меток времени, {len(snapshot['user_contacts'])} контактов, "
+        f"{len(snapshot['completed_actions'])} выполненных действий..."
+    )
+    try:
+        with _get_db_connection() as conn:
+            with conn.cursor() as cur:
+                if snapshot['last_message_ids']:
+                    psycopg2.extras.execute_values(cur, """
+                        INSERT INTO public.channel_state (chat_id, last_message_id)
+                        VALUES %s
+                        ON CONFLICT (chat_id)
+                        DO UPDATE SET last_message_id = EXCLUDED.last_message_id;
+                    """, list(snapshot['last_message_ids'].items()))
+                if snapshot['post_times']:
+                    psycopg2.extras.execute_values(cur, """
+                        INSERT INTO public.channel_state (chat_id, last_agent_post_timestamp)
+                        VALUES %s
+                        ON CONFLICT (chat_id)
+                        DO UPDATE SET last_agent_post_timestamp = EXCLUDED.last_agent_post_timestamp;
+                    """, list(snapshot['post_times'].items()))
+                if snapshot['user_contacts']:
+                    psycopg2.extras.execute_values(cur, """
+                        INSERT INTO public.daily_user_contacts (user_id, last_contact_date)
+                        VALUES %s
+                        ON CONFLICT (user_id)
+                        DO UPDATE SET last_contact_date = EXCLUDED.last_contact_date;
+                    """, list(snapshot['user_contacts'].items()))
+                if snapshot['completed_actions']:
+                    cur.execute(
+                        "UPDATE public.pending_actions SET is_completed = TRUE, delivery_status = 'sent', lease_expires_at = NULL WHERE id = ANY(%s)",
+                        (list(snapshot['completed_actions']),)
+                    )
+            conn.commit()
+        print("✅ Состояние запуска успешно сохранено.")
+        return True
     except Exception as e:
-        print(f"❌ КРИТИЧЕСКАЯ ОШИБКА: Не удалось подключиться к базе данных Neon: {e}")
-        exit()
+        print(f"❌ Ошибка при сохранении состояния запуска: {e}. Изменения будут повторно записаны при следующей контрольной точке.")
+        _restore_pending_writes(snapshot)
+        return False
+
+# --- Схема базы ---
+
+def init_db():
+    """
+    Добавляет в существующую схему служебные колонки и таблицы, которые нужны агенту.
+    Все операторы идемпотентны, поэтому функция безопасно вызывается при каждом запуске.
+    """
+    print("🔄 Проверка схемы базы данных Neon...")
+    statements = [
+        # Кэш разрешенных сущностей Telegram (см. entity_cache.py)
+        "ALTER TABLE public.target_chats ADD COLUMN IF NOT EXISTS access_hash BIGINT",
+        "ALTER TABLE public.target_chats ADD COLUMN IF NOT EXISTS linked_chat_id BIGINT",
+        "ALTER TABLE public.target_chats ADD COLUMN IF NOT EXISTS linked_access_hash BIGINT",
+        "ALTER TABLE public.target_chats ADD COLUMN IF NOT EXISTS entity_resolved_at TIMESTAMPTZ",
+        # Сессия Telethon в Postgres (см. postgres_session.py)
+        """
+        CREATE TABLE IF NOT EXISTS public.telethon_sessions (
+            session_name TEXT PRIMARY KEY,
+            dc_id INTEGER,
+            server_address TEXT,
+            port INTEGER,
+            auth_key BYTEA,
+            takeout_id BIGINT,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS public.telethon_entities (
+            session_name TEXT NOT NULL,
+            id BIGINT NOT NULL,
+            hash BIGINT NOT NULL,
+            username TEXT,
+            phone TEXT,
+            name TEXT,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            PRIMARY KEY (session_name, id)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS public.telethon_sent_files (
+            session_name TEXT NOT NULL,
+            md5_digest BYTEA NOT NULL,
+            file_size BIGINT NOT NULL,
+            type INTEGER NOT NULL,
+            id BIGINT NOT NULL,
+            hash BIGINT NOT NULL,
+            PRIMARY KEY (session_name, md5_digest, file_size, type)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS public.telethon_update_state (
+            session_name TEXT NOT NULL,
+            id BIGINT NOT NULL,
+            pts INTEGER,
+            qts INTEGER,
+            date TIMESTAMPTZ,
+            seq INTEGER,
+            PRIMARY KEY (session_name, id)
+        )
+        """,
+        # Кэш ответов Gemini (см. response_cache.py)
+        """
+        CREATE TABLE IF NOT EXISTS public.ai_response_cache (
+            cache_key TEXT PRIMARY KEY,
+            model_name TEXT NOT NULL,
+            response_json JSONB NOT NULL,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            last_hit_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS ai_response_cache_last_hit_idx ON public.ai_response_cache (last_hit_at)",
+        # Кластеры повторяющихся сообщений и их вердикты (см. dedup.py)
+        """
+        CREATE TABLE IF NOT EXISTS public.message_clusters (
+            text_hash TEXT PRIMARY KEY,
+            simhash BIGINT NOT NULL,
+            lead_type TEXT,
+            route_decision TEXT,
+            route_persona TEXT,
+            copies INTEGER NOT NULL DEFAULT 0,
+            first_seen_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            last_seen_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS message_clusters_last_seen_idx ON public.message_clusters (last_seen_at)",
+        # Решения Сортировщика для копий (таблица могла быть создана без этих столбцов)
+        "ALTER TABLE public.message_clusters ADD COLUMN IF NOT EXISTS route_decision TEXT",
+        "ALTER TABLE public.message_clusters ADD COLUMN IF NOT EXISTS route_persona TEXT",
+        # Надежная очередь действий на утверждение (см. approval_outbox.py)
+        """
+        CREATE TABLE IF NOT EXISTS public.approval_outbox (
+            id BIGSERIAL PRIMARY KEY,
+            idempotency_key TEXT NOT NULL UNIQUE,
+            payload JSONB NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT,
+            next_attempt_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            delivered_at TIMESTAMPTZ
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS approval_outbox_pending_idx ON public.approval_outbox (next_attempt_at) WHERE delivered_at IS NULL",
+        # Захват отложенных действий отправителями (см. claim_pending_actions)
+        "ALTER TABLE public.pending_actions ADD COLUMN IF NOT EXISTS delivery_status TEXT NOT NULL DEFAULT 'pending'",
+        "ALTER TABLE public.pending_actions ADD COLUMN IF NOT EXISTS claimed_by TEXT",
+        "ALTER TABLE public.pending_actions ADD COLUMN IF NOT EXISTS lease_expires_at TIMESTAMPTZ",
+        "CREATE INDEX IF NOT EXISTS pending_actions_claim_idx ON public.pending_actions (id) WHERE is_completed = FALSE",
+        # Сообщения "Охотника", отложенные из-за недоступности Gemini (см. lead_hunter_service.py)
+        """
+        CREATE TABLE IF NOT EXISTS public.lead_retry_queue (
+            chat_id BIGINT NOT NULL,
+            message_id BIGINT NOT NULL,
+            sender_id BIGINT,
+            sender_username TEXT,
+            sender_first_name TEXT,
+            message_text TEXT NOT NULL,
+            lead_type TEXT,
+            attempts INTEGER NOT NULL DEFAULT 1,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            PRIMARY KEY (chat_id, message_id)
+        )
+        """,
+        # Поправки локальной оценки токенов по этапам (см. token_estimator.py)
+        """
+        CREATE TABLE IF NOT EXISTS public.token_corrections (
+            stage TEXT PRIMARY KEY,
+            correction DOUBLE PRECISION NOT NULL,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        )
+        """,
+    ]
+    try:
+        with _get_db_connection() as conn:
+            with conn.cursor() as cur:
+                for statement in statements:
+                    cur.execute(statement)
+            conn.commit()
+            print("✅ Схема базы данных актуальна.")
+    except Exception as e:
+        print(f"❌ Ошибка при обновлении схемы базы данных: {e}")
+    _ensure_pending_actions_trigger()
+
+def _ensure_pending_actions_trigger():
+    """
+    Создает триггер уведомления отправителей о новых одобренных действиях (см. delivery_service.py).
+    Триггер создается только при его отсутствии: CREATE TRIGGER берет блокировку pending_actions,
+    поэтому при обычном запуске таблица не блокируется. Отдельная транзакция нужна, чтобы сбой
+    здесь (например, не хватает прав) не откатывал остальную схему — доставка тогда работает по опросу.
+    """
+    exists_sql = """
+        SELECT 1 FROM pg_trigger
+        WHERE tgrelid = 'public.pending_actions'::regclass AND tgname = 'pending_actions_notify'
+    """
+    try:
+        with _get_db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(exists_sql)
+                if cur.fetchone():
+                    return
+                cur.execute(f"""
+                    CREATE OR REPLACE FUNCTION public.notify_pending_action() RETURNS trigger AS $$
+                    BEGIN
+                        PERFORM pg_notify('{PENDING_ACTIONS_CHANNEL}', NEW.id::text);
+                        RETURN NEW;
+                    END;
+                    $$ LANGUAGE plpgsql
+                """)
+                cur.execute("""
+                    CREATE TRIGGER pending_actions_notify
+                    AFTER INSERT ON public.pending_actions
+                    FOR EACH ROW WHEN (NEW.is_completed IS NOT TRUE)
+                    EXECUTE FUNCTION public.notify_pending_action()
+                """)
+            conn.commit()
+            print("✅ Создан триггер уведомлений о новых одобренных действиях.")
+    except psycopg2.errors.DuplicateObject:
+        # Триггер успел создать параллельно запущенный процесс
+        pass
+    except Exception as e:
+        print(f"⚠️ Не удалось создать триггер уведомлений ({e}). Доставка будет работать по опросу.")
 
 # --- Управление сессией ---
 
@@ -50,11 +447,117 @@ def save_session_string(session_string):
     except Exception as e:
         print(f"❌ Ошибка при сохранении сессии в Neon: {e}")
 
+# --- Сессия Telethon в Postgres ---
+
+def load_telethon_session(session_name):
+    """
+    Загружает сохраненную сессию Telethon: {'auth', 'entities', 'files', 'update_states'}.
+    Возвращает None, если сессия еще не сохранялась или база недоступна.
+    """
+    print(f"🔄 Загрузка сессии Telethon '{session_name}' из Neon...")
+    try:
+        with _get_db_connection() as conn:
+            with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+                cur.execute(
+                    "SELECT dc_id, server_address, port, auth_key, takeout_id FROM public.telethon_sessions WHERE session_name = %s",
+                    (session_name,)
+                )
+                auth = cur.fetchone()
+            with conn.cursor() as cur:
+                cur.execute(
+                    "SELECT id, hash, username, phone, name FROM public.telethon_entities WHERE session_name = %s",
+                    (session_name,)
+                )
+                entities = cur.fetchall()
+                cur.execute(
+                    "SELECT md5_digest, file_size, type, id, hash FROM public.telethon_sent_files WHERE session_name = %s",
+                    (session_name,)
+                )
+                files = cur.fetchall()
+                cur.execute(
+                    "SELECT id, pts, qts, date, seq FROM public.telethon_update_state WHERE session_name = %s",
+                    (session_name,)
+                )
+                update_states = cur.fetchall()
+        if not auth and not entities:
+            print("ℹ️ Сессия Telethon в Neon не найдена.")
+            return None
+        print(f"✅ Сессия Telethon загружена: {len(entities)} сущностей, {len(update_states)} состояний обновлений.")
+        return {'auth': auth, 'entities': entities, 'files': files, 'update_states': update_states}
+    except Exception as e:
+        print(f"❌ Ошибка при загрузке сессии Telethon из Neon: {e}")
+        return None
+
+def save_telethon_session(session_name, auth, entities, files, update_states):
+    """
+    Записывает изменения сессии Telethon одной транзакцией.
+    auth — словарь с ключом авторизации (или None, если он не менялся),
+    остальные аргументы — только новые или изменившиеся строки.
+    """
+    try:
+        with _get_db_connection() as conn:
+            with conn.cursor() as cur:
+                if auth is not None:
+                    cur.execute("""
+                        INSERT INTO public.telethon_sessions (session_name, dc_id, server_address, port, auth_key, takeout_id, updated_at)
+                        VALUES (%s, %s, %s, %s, %s, %s, NOW())
+                        ON CONFLICT (session_name)
+                        DO UPDATE SET dc_id = EXCLUDED.dc_id, server_address = EXCLUDED.server_address,
+                                      port = EXCLUDED.port, auth_key = EXCLUDED.auth_key,
+                                      takeout_id = EXCLUDED.takeout_id, updated_at = NOW();
+                    """, (
+                        session_name, auth['dc_id'], auth['server_address'], auth['port'],
+                        psycopg2.Binary(auth['auth_key']) if auth['auth_key'] else None, auth['takeout_id']
+                    ))
+                if entities:
+                    psycopg2.extras.execute_values(cur, """
+                        INSERT INTO public.telethon_entities (session_name, id, hash, username, phone, name)
+                        VALUES %s
+                        ON CONFLICT (session_name, id)
+                        DO UPDATE SET hash = EXCLUDED.hash, username = EXCLUDED.username, phone = EXCLUDED.phone,
+                                      name = EXCLUDED.name, updated_at = NOW();
+                    """, [(session_name, *row) for row in entities])
+                if files:
+                    psycopg2.extras.execute_values(cur, """
+                        INSERT INTO public.telethon_sent_files (session_name, md5_digest, file_size, type, id, hash)
+                        VALUES %s
+                        ON CONFLICT (session_name, md5_digest, file_size, type)
+                        DO UPDATE SET id = EXCLUDED.id, hash = EXCLUDED.hash;
+                    """, [(session_name, psycopg2.Binary(md5), size, file_type, file_id, file_hash)
+                          for md5, size, file_type, file_id, file_hash in files])
+                if update_states:
+                    psycopg2.extras.execute_values(cur, """
+                        INSERT INTO public.telethon_update_state (session_name, id, pts, qts, date, seq)
+                        VALUES %s
+                        ON CONFLICT (session_name, id)
+                        DO UPDATE SET pts = EXCLUDED.pts, qts = EXCLUDED.qts, date = EXCLUDED.date, seq = EXCLUDED.seq;
+                    """, [(session_name, *row) for row in update_states])
+            conn.commit()
+        return True
+    except Exception as e:
+        print(f"❌ Ошибка при сохранении сессии Telethon в Neon: {e}")
+        return False
+
+def delete_telethon_session(session_name):
+    """Удаляет все данные сессии Telethon (например, перед повторной авторизацией)."""
+    try:
+        with _get_db_connection() as conn:
+            with conn.cursor() as cur:
+                for table in ('telethon_sessions', 'telethon_entities', 'telethon_sent_files', 'telethon_update_state'):
+                    cur.execute(f"DELETE FROM public.{table} WHERE session_name = %s", (session_name,))
+            conn.commit()
+            print(f"✅ Сессия Telethon '{session_name}' удалена из Neon.")
+    except Exception as e:
+        print(f"❌ Ошибка при удалении сессии Telethon из Neon: {e}")
+
 # --- Работа с чатами и сообщениями ---
 
 def get_target_chats():
     print("🔄 Получение списка целевых чатов из Neon...")
-    sql = "SELECT chat_id, chat_type FROM public.target_chats"
+    sql = """
+        SELECT chat_id, chat_type, access_hash, linked_chat_id, linked_access_hash, entity_resolved_at
+        FROM public.target_chats
+    """
     try:
         with _get_db_connection() as conn:
             # RealDictCursor гарантирует, что результат будет списком словарей,
@@ -68,7 +571,73 @@ def get_target_chats():
         print(f"❌ Ошибка при получении чатов из Neon: {e}")
         return []
 
+def get_target_chats_with_state():
+    """
+    Загружает все целевые чаты вместе с их состоянием из channel_state одним запросом.
+    Каждый словарь содержит колонки target_chats, state_chat_id, last_message_id и
+    last_agent_post_timestamp, поэтому обработчику чата не нужно отдельно ходить в базу за состоянием.
+    Для каналов с известным чатом комментариев состояние берется по ID этого чата (state_chat_id).
+    """
+    print("🔄 Получение списка целевых чатов и их состояния из Neon...")
+    sql = """
+        SELECT t.chat_id, t.chat_type,
+               t.access_hash, t.linked_chat_id, t.linked_access_hash, t.entity_resolved_at,
+               s.chat_id AS state_chat_id,
+               COALESCE(s.last_message_id, 0) AS last_message_id,
+               s.last_agent_post_timestamp
+        FROM public.target_chats t
+        LEFT JOIN public.channel_state s
+               ON s.chat_id = CASE WHEN t.chat_type = 'channel'
+                                   THEN COALESCE(t.linked_chat_id, t.chat_id)
+                                   ELSE t.chat_id END
+    """
+    try:
+        with _get_db_connection() as conn:
+            with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+                cur.execute(sql)
+                chats = cur.fetchall()
+                for chat in chats:
+                    chat['last_message_id'] = int(chat['last_message_id'])
+                    if chat['state_chat_id'] is None:
+                        # Состояния еще нет: ключом будет тот же ID, что и в JOIN выше
+                        is_channel = chat['chat_type'] == 'channel'
+                        chat['state_chat_id'] = (chat['linked_chat_id'] if is_channel else None) or chat['chat_id']
+                print(f"✅ Найдено {len(chats)} целевых чатов.")
+                return chats
+    except Exception as e:
+        print(f"❌ Ошибка при получении чатов из Neon: {e}")
+        return []
+
+def save_chat_entity(chat_id, access_hash, linked_chat_id, linked_access_hash):
+    """Сохраняет access_hash чата и его связанный чат комментариев, разрешенные через Telegram."""
+    sql = """
+        UPDATE public.target_chats
+        SET access_hash = %s, linked_chat_id = %s, linked_access_hash = %s, entity_resolved_at = NOW()
+        WHERE chat_id = %s
+    """
+    try:
+        with _get_db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(sql, (access_hash, linked_chat_id, linked_access_hash, chat_id))
+            conn.commit()
+    except Exception as e:
+        print(f"❌ Ошибка при сохранении сущности чата {chat_id} в кэш: {e}")
+
+def invalidate_chat_entity(chat_id):
+    """Сбрасывает кэш сущности чата, чтобы при следующем обращении он был разрешен заново."""
+    sql = "UPDATE public.target_chats SET entity_resolved_at = NULL WHERE chat_id = %s"
+    try:
+        with _get_db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(sql, (chat_id,))
+            conn.commit()
+    except Exception as e:
+        print(f"❌ Ошибка при сбросе кэша сущности чата {chat_id}: {e}")
+
 def get_last_message_id(chat_id):
+    with _pending_lock:
+        if chat_id in _pending_writes['last_message_ids']:
+            return _pending_writes['last_message_ids'][chat_id]
     sql = "SELECT last_message_id FROM public.channel_state WHERE chat_id = %s"
     try:
         with _get_db_connection() as conn:
@@ -80,6 +649,10 @@ def get_last_message_id(chat_id):
         return 0
 
 def update_last_message_id(chat_id, message_id):
+    if _unit_of_work_active:
+        with _pending_lock:
+            _pending_writes['last_message_ids'][chat_id] = message_id
+        return
     print(f"🔄 Обновление ID последнего сообщения для чата {chat_id} на {message_id}...")
     sql = """
         INSERT INTO public.channel_state (chat_id, last_message_id) 
@@ -97,6 +670,9 @@ def update_last_message_id(chat_id, message_id):
         print(f"❌ Критическая ошибка при записи ID последнего сообщения для чата {chat_id}: {e}")
 
 def get_last_post_time(chat_id: int) -> datetime | None:
+    with _pending_lock:
+        if chat_id in _pending_writes['post_times']:
+            return _pending_writes['post_times'][chat_id]
     sql = "SELECT last_agent_post_timestamp FROM public.channel_state WHERE chat_id = %s"
     try:
         with _get_db_connection() as conn:
@@ -109,6 +685,10 @@ def get_last_post_time(chat_id: int) -> datetime | None:
         return None
 
 def update_last_post_time(chat_id: int):
+    if _unit_of_work_active:
+        with _pending_lock:
+            _pending_writes['post_times'][chat_id] = datetime.now(timezone.utc)
+        return
     print(f"🔄 Установка метки времени последнего ответа для чата {chat_id}...")
     # Используем SQL-функцию NOW() для установки текущего времени на сервере
     sql = """
@@ -128,22 +708,108 @@ def update_last_post_time(chat_id: int):
 
 # --- Работа с промптами и логами ---
 
+# Кэш промптов живет весь процесс. Раз в PROMPT_CACHE_TTL_SECONDS одним запросом сверяются
+# хэши содержимого (md5) всех промптов, и заново загружаются только изменившиеся.
+_prompt_cache = {}  # name -> {'content': str, 'version': str}
+_prompt_cache_checked_at = None
+_prompt_cache_lock = threading.Lock()
+
+# Примеры из ai_suggestions_log: (prompt_name, limit) -> {'examples': dict, 'loaded_at': float}
+_examples_cache = {}
+
+def _refresh_prompt_cache():
+    """Сверяет версии промптов с базой и догружает новые или изменившиеся."""
+    global _prompt_cache_checked_at
+    with _get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT name, md5(content) FROM public.prompts")
+            versions = dict(cur.fetchall())
+            stale = [
+                name for name, version in versions.items()
+                if name not in _prompt_cache or _prompt_cache[name]['version'] != version
+            ]
+            if stale:
+                cur.execute(
+                    "SELECT name, content, md5(content) FROM public.prompts WHERE name = ANY(%s)",
+                    (stale,)
+                )
+                for name, content, version in cur.fetchall():
+                    _prompt_cache[name] = {'content': content.replace('\r\n', '\n'), 'version': version}
+                print(f"✅ Загружено промптов из Neon: {len(stale)}.")
+    for name in list(_prompt_cache):
+        if name not in versions:
+            del _prompt_cache[name]
+    _prompt_cache_checked_at = time.monotonic()
+
+def invalidate_prompt_cache():
+    """Сбрасывает кэш промптов и примеров: следующий запрос пойдет в базу."""
+    global _prompt_cache_checked_at
+    with _prompt_cache_lock:
+        _prompt_cache.clear()
+        _examples_cache.clear()
+        _prompt_cache_checked_at = None
+
 def get_prompt_template(prompt_name: str):
-    print(f"🔄 Загрузка промпта '{prompt_name}' из Neon...")
-    sql = "SELECT content FROM public.prompts WHERE name = %s"
+    with _prompt_cache_lock:
+        is_fresh = (
+            _prompt_cache_checked_at is not None
+            and time.monotonic() - _prompt_cache_checked_at < config.PROMPT_CACHE_TTL_SECONDS
+        )
+        if not is_fresh:
+            print("🔄 Проверка актуальности промптов в Neon...")
+            try:
+                _refresh_prompt_cache()
+            except Exception as e:
+                print(f"❌ Ошибка при загрузке промпта '{prompt_name}': {e}")
+                # Если база недоступна, лучше отдать последнюю известную версию, чем ничего
+                cached = _prompt_cache.get(prompt_name)
+                return cached['content'] if cached else None
+
+        cached = _prompt_cache.get(prompt_name)
+        if cached:
+            return cached['content']
+        print(f"❌ Промпт '{prompt_name}' не найден в Neon.")
+        return None
+
+def get_examples_for_prompt(prompt_name: str, limit: int = 10):
+    """
+    Возвращает удачные и неудачные примеры для промпта одним запросом:
+    {'approved': [...], 'declined': [...]}, в каждом списке не более `limit` последних записей
+    в хронологическом порядке. Результат кэшируется на PROMPT_CACHE_TTL_SECONDS.
+    """
+    cache_key = (prompt_name, limit)
+    with _prompt_cache_lock:
+        cached = _examples_cache.get(cache_key)
+        if cached and time.monotonic() - cached['loaded_at'] < config.PROMPT_CACHE_TTL_SECONDS:
+            return cached['examples']
+
+    print(f"🔄 Запрос до {limit} удачных и неудачных примеров для промпта '{prompt_name}'...")
+    sql = """
+        SELECT status, original_message_text, ai_generated_text
+        FROM (
+            SELECT status, original_message_text, ai_generated_text, created_at,
+                   ROW_NUMBER() OVER (PARTITION BY status ORDER BY created_at DESC) AS rn
+            FROM public.ai_suggestions_log
+            WHERE prompt_version = %s AND status IN ('approved', 'declined')
+        ) ranked
+        WHERE rn <= %s
+        ORDER BY status, created_at ASC
+    """
+    examples = {'approved': [], 'declined': []}
     try:
         with _get_db_connection() as conn:
-            with conn.cursor() as cur:
-                cur.execute(sql, (prompt_name,))
-                result = cur.fetchone()
-                if result:
-                    print(f"✅ Промпт '{prompt_name}' успешно загружен.")
-                    return result[0].replace('\r\n', '\n')
-                print(f"❌ Промпт '{prompt_name}' не найден в Neon.")
-                return None
+            with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+                cur.execute(sql, (prompt_name, limit))
+                for row in cur.fetchall():
+                    examples[row.pop('status')].append(row)
+        print(f"✅ Найдено примеров: удачных {len(examples['approved'])}, неудачных {len(examples['declined'])}.")
     except Exception as e:
-        print(f"❌ Ошибка при загрузке промпта '{prompt_name}': {e}")
-        return None
+        print(f"❌ Ошибка при получении примеров для '{prompt_name}': {e}")
+        return examples
+
+    with _prompt_cache_lock:
+        _examples_cache[cache_key] = {'examples': examples, 'loaded_at': time.monotonic()}
+    return examples
 
 def get_examples_by_status(prompt_name: str, status: str, limit: int = 5):
     print(f"🔄 Запрос {limit} примеров со статусом '{status}' для промпта '{prompt_name}'...")
@@ -167,21 +833,429 @@ def get_examples_by_status(prompt_name: str, status: str, limit: int = 5):
         print(f"❌ Ошибка при получении примеров для '{prompt_name}' со статусом '{status}': {e}")
         return []
 
+def get_logged_message_texts(limit: int = 2000):
+    """Тексты последних сообщений, на которые агент уже предлагал ответ или писал лиду (для оценки фильтра)."""
+    sql = """
+        SELECT original_message_text
+        FROM public.ai_suggestions_log
+        WHERE original_message_text IS NOT NULL
+        ORDER BY created_at DESC
+        LIMIT %s
+    """
+    try:
+        with _get_db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(sql, (limit,))
+                return [row[0] for row in cur.fetchall()]
+    except Exception as e:
+        print(f"❌ Ошибка при загрузке сообщений из ai_suggestions_log: {e}")
+        return []
+
+# --- Кэш ответов Gemini ---
+
+def get_cached_ai_response(cache_key: str, ttl_hours: int):
+    """Возвращает разобранный JSON из кэша (и отмечает использование записи) или None."""
+    sql = """
+        UPDATE public.ai_response_cache
+        SET last_hit_at = NOW()
+        WHERE cache_key = %s AND created_at > NOW() - make_interval(hours => %s)
+        RETURNING response_json
+    """
+    try:
+        with _get_db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(sql, (cache_key, ttl_hours))
+                result = cur.fetchone()
+            conn.commit()
+            return result[0] if result else None
+    except Exception as e:
+        print(f"⚠️ Ошибка при чтении кэша ответов Gemini: {e}")
+        return None
+
+def save_cached_ai_response(cache_key: str, model_name: str, response, ttl_hours: int, max_entries: int):
+    """Сохраняет ответ в кэш и вытесняет просроченные и самые давно использованные записи."""
+    try:
+        with _get_db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    INSERT INTO public.ai_response_cache (cache_key, model_name, response_json)
+                    VALUES (%s, %s, %s)
+                    ON CONFLICT (cache_key)
+                    DO UPDATE SET response_json = EXCLUDED.response_json, created_at = NOW(), last_hit_at = NOW();
+                """, (cache_key, model_name, psycopg2.extras.Json(response)))
+                cur.execute(
+                    "DELETE FROM public.ai_response_cache WHERE created_at < NOW() - make_interval(hours => %s)",
+                    (ttl_hours,)
+                )
+                cur.execute("""
+                    DELETE FROM public.ai_response_cache
+                    WHERE cache_key IN (
+                        SELECT cache_key FROM public.ai_response_cache
+                        ORDER BY last_hit_at DESC
+                        OFFSET %s
+                    )
+                """, (max_entries,))
+            conn.commit()
+    except Exception as e:
+        print(f"⚠️ Ошибка при сохранении ответа Gemini в кэш: {e}")
+
+# --- Кластеры повторяющихся сообщений ---
+
+def load_message_clusters(window_days: int):
+    """
+    Возвращает [(text_hash, simhash, lead_type, route_decision, route_persona)]
+    кластеров, встречавшихся за последние window_days дней.
+    """
+    sql = """
+        SELECT text_hash, simhash, lead_type, route_decision, route_persona
+        FROM public.message_clusters
+        WHERE last_seen_at > NOW() - make_interval(days => %s)
+    """
+    try:
+        with _get_db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(sql, (window_days,))
+                return cur.fetchall()
+    except Exception as e:
+        print(f"❌ Ошибка при загрузке кластеров сообщений: {e}")
+        return []
+
+def save_message_clusters(clusters: list, window_days: int) -> bool:
+    """
+    Сохраняет кластеры [(text_hash, simhash, lead_type, route_decision, route_persona, new_copies)] одним upsert'ом
+    и удаляет кластеры, не встречавшиеся дольше window_days дней.
+    """
+    try:
+        with _get_db_connection() as conn:
+            with conn.cursor() as cur:
+                psycopg2.extras.execute_values(cur, """
+                    INSERT INTO public.message_clusters (text_hash, simhash, lead_type, route_decision, route_persona, copies)
+                    VALUES %s
+                    ON CONFLICT (text_hash)
+                    DO UPDATE SET lead_type = COALESCE(EXCLUDED.lead_type, message_clusters.lead_type),
+                                  route_decision = COALESCE(EXCLUDED.route_decision, message_clusters.route_decision),
+                                  route_persona = CASE WHEN EXCLUDED.route_decision IS NULL
+                                                       THEN message_clusters.route_persona
+                                                       ELSE EXCLUDED.route_persona END,
+                                  copies = message_clusters.copies + EXCLUDED.copies,
+                                  last_seen_at = NOW();
+                """, clusters)
+                cur.execute(
+                    "DELETE FROM public.message_clusters WHERE last_seen_at < NOW() - make_interval(days => %s)",
+                    (window_days,)
+                )
+            conn.commit()
+        print(f"✅ Сохранено кластеров повторяющихся сообщений: {len(clusters)}.")
+        return True
+    except Exception as e:
+        print(f"❌ Ошибка при сохранении кластеров сообщений: {e}")
+        return False
+
+# --- Поправки оценки токенов ---
+
+def load_token_corrections():
+    """Возвращает {stage: поправочный коэффициент}, накопленные прошлыми запусками."""
+    try:
+        with _get_db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT stage, correction FROM public.token_corrections")
+                return dict(cur.fetchall())
+    except Exception as e:
+        print(f"⚠️ Ошибка при загрузке поправок оценки токенов: {e}")
+        return {}
+
+def save_token_corrections(corrections: dict) -> bool:
+    """Сохраняет поправки {stage: коэффициент} одним upsert'ом."""
+    try:
+        with _get_db_connection() as conn:
+            with conn.cursor() as cur:
+                psycopg2.extras.execute_values(cur, """
+                    INSERT INTO public.token_corrections (stage, correction)
+                    VALUES %s
+                    ON CONFLICT (stage)
+                    DO UPDATE SET correction = EXCLUDED.correction, updated_at = NOW();
+                """, list(corrections.items()))
+            conn.commit()
+        return True
+    except Exception as e:
+        print(f"⚠️ Ошибка при сохранении поправок оценки токенов: {e}")
+        return False
+
+# --- Очередь действий на утверждение (outbox) ---
+
+def enqueue_approval_actions(entries: list) -> bool:
+    """Записывает [(idempotency_key, payload)] в outbox. Повторная запись с тем же ключом игнорируется."""
+    try:
+        with _get_db_connection() as conn:
+            with conn.cursor() as cur:
+                psycopg2.extras.execute_values(cur, """
+                    INSERT INTO public.approval_outbox (idempotency_key, payload)
+                    VALUES %s
+                    ON CONFLICT (idempotency_key) DO NOTHING;
+                """, [(key, psycopg2.extras.Json(payload)) for key, payload in entries])
+            conn.commit()
+        return True
+    except Exception as e:
+        print(f"❌ Ошибка при записи действий в outbox: {e}")
+        return False
+
+def get_outbox_entries(limit: int, due_only: bool = True):
+    """
+    Возвращает до `limit` недоставленных записей outbox [(id, idempotency_key, payload)] в порядке записи.
+    due_only=False — включая записи, время повтора которых еще не наступило.
+    """
+    sql = """
+        SELECT id, idempotency_key, payload
+        FROM public.approval_outbox
+        WHERE delivered_at IS NULL AND (%s OR next_attempt_at <= NOW())
+        ORDER BY id
+        LIMIT %s
+    """
+    try:
+        with _get_db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(sql, (not due_only, limit))
+                return cur.fetchall()
+    except Exception as e:
+        print(f"❌ Ошибка при чтении outbox: {e}")
+        return []
+
+def mark_outbox_delivered(entry_ids: list, retention_days: int) -> bool:
+    """Отмечает записи доставленными и удаляет доставленные записи старше retention_days дней."""
+    try:
+        with _get_db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "UPDATE public.approval_outbox SET delivered_at = NOW() WHERE id = ANY(%s)",
+                    (entry_ids,)
+                )
+                cur.execute(
+                    "DELETE FROM public.approval_outbox WHERE delivered_at < NOW() - make_interval(days => %s)",
+                    (retention_days,)
+                )
+            conn.commit()
+        return True
+    except Exception as e:
+        print(f"❌ Ошибка при отметке доставки в outbox: {e}")
+        return False
+
+def reschedule_outbox_entries(entry_ids: list, error: str, base_delay_seconds: float, max_delay_seconds: float) -> bool:
+    """Откладывает повтор недоставленных записей с экспоненциально растущей задержкой."""
+    sql = """
+        UPDATE public.approval_outbox
+        SET attempts = attempts + 1,
+            last_error = %s,
+            next_attempt_at = NOW() + make_interval(secs => LEAST(%s, %s * power(2, attempts)))
+        WHERE id = ANY(%s)
+    """
+    try:
+        with _get_db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(sql, (error, max_delay_seconds, base_delay_seconds, entry_ids))
+            conn.commit()
+        return True
+    except Exception as e:
+        print(f"❌ Ошибка при переносе повтора в outbox: {e}")
+        return False
+
+# --- Отложенные сообщения "Охотника за лидами" ---
+
+def save_lead_retries(entries: list) -> bool:
+    """
+    Откладывает сообщения до следующего запуска.
+    entries — [(chat_id, message_id, sender_id, sender_username, sender_first_name, message_text, lead_type)],
+    lead_type = None — сообщение еще не классифицировано, иначе для лида осталось сгенерировать сообщение.
+    """
+    if not entries:
+        return True
+    try:
+        with _get_db_connection() as conn:
+            with conn.cursor() as cur:
+                psycopg2.extras.execute_values(cur, """
+                    INSERT INTO public.lead_retry_queue
+                        (chat_id, message_id, sender_id, sender_username, sender_first_name, message_text, lead_type)
+                    VALUES %s
+                    ON CONFLICT (chat_id, message_id)
+                    DO UPDATE SET lead_type = EXCLUDED.lead_type,
+                                  attempts = public.lead_retry_queue.attempts + 1;
+                """, entries)
+            conn.commit()
+        print(f"⏳ Отложено сообщений \"Охотника\" до следующего запуска: {len(entries)}.")
+        return True
+    except Exception as e:
+        print(f"❌ Ошибка при сохранении отложенных сообщений \"Охотника\": {e}")
+        return False
+
+def get_lead_retries(limit: int, max_age_hours: int):
+    """Удаляет отложенные сообщения старше max_age_hours часов и возвращает до `limit` оставшихся (старые первыми)."""
+    try:
+        with _get_db_connection() as conn:
+            with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+                cur.execute(
+                    "DELETE FROM public.lead_retry_queue WHERE created_at < NOW() - make_interval(hours => %s)",
+                    (max_age_hours,)
+                )
+                cur.execute(
+                    "SELECT * FROM public.lead_retry_queue ORDER BY created_at, chat_id, message_id LIMIT %s",
+                    (limit,)
+                )
+                rows = cur.fetchall()
+            conn.commit()
+        return rows
+    except Exception as e:
+        print(f"❌ Ошибка при чтении отложенных сообщений \"Охотника\": {e}")
+        return []
+
+def delete_lead_retries(keys: list) -> bool:
+    """Удаляет обработанные отложенные сообщения. keys — [(chat_id, message_id)]."""
+    if not keys:
+        return True
+    try:
+        with _get_db_connection() as conn:
+            with conn.cursor() as cur:
+                psycopg2.extras.execute_values(cur, """
+                    DELETE FROM public.lead_retry_queue AS q
+                    USING (VALUES %s) AS done (chat_id, message_id)
+                    WHERE q.chat_id = done.chat_id AND q.message_id = done.message_id
+                """, keys)
+            conn.commit()
+        return True
+    except Exception as e:
+        print(f"❌ Ошибка при удалении отложенных сообщений \"Охотника\": {e}")
+        return False
+
 # --- Работа с отложенными действиями ---
 
-def get_pending_actions():
-    sql = "SELECT * FROM public.pending_actions WHERE is_completed = FALSE"
+def claim_pending_actions(worker_id: str, limit: int, lease_seconds: float):
+    """
+    Захватывает до `limit` невыполненных действий для отправителя worker_id и возвращает их в порядке id.
+    Захваченные действия получают статус 'in_flight' и аренду на lease_seconds секунд: другие
+    отправители их пропускают (FOR UPDATE SKIP LOCKED), пока аренда не истечет или действие
+    не будет освобождено (release_claimed_actions). У освобожденного с задержкой действия
+    lease_expires_at означает "не раньше": до этого момента оно тоже не захватывается.
+    """
+    # Порядок записи важен: сообщения одному получателю отправляются в том же порядке
+    sql = """
+        WITH claimable AS (
+            SELECT id
+            FROM public.pending_actions
+            WHERE is_completed = FALSE
+              AND (lease_expires_at IS NULL OR lease_expires_at < NOW())
+            ORDER BY id
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        )
+        UPDATE public.pending_actions AS p
+        SET delivery_status = 'in_flight',
+            claimed_by = %s,
+            lease_expires_at = NOW() + make_interval(secs => %s)
+        FROM claimable
+        WHERE p.id = claimable.id
+        RETURNING p.*
+    """
     try:
         with _get_db_connection() as conn:
             with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
-                cur.execute(sql)
-                return cur.fetchall()
+                cur.execute(sql, (limit, worker_id, lease_seconds))
+                actions = cur.fetchall()
+            conn.commit()
+        return sorted(actions, key=lambda action: action['id'])
+    except Exception as e:
+        print(f"❌ Ошибка при захвате отложенных действий из Neon: {e}")
+        return []
+
+def extend_action_leases(action_ids: list, worker_id: str, lease_seconds: float) -> list:
+    """
+    Продлевает аренду действий, которые все еще держит worker_id, на lease_seconds секунд от текущего момента.
+    Возвращает id действий, аренду которых удалось продлить (остальные уже захвачены другим отправителем или выполнены).
+    """
+    if not action_ids:
+        return []
+    sql = """
+        UPDATE public.pending_actions
+        SET lease_expires_at = NOW() + make_interval(secs => %s)
+        WHERE id = ANY(%s) AND claimed_by = %s AND delivery_status = 'in_flight' AND is_completed = FALSE
+        RETURNING id
+    """
+    try:
+        with _get_db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(sql, (lease_seconds, action_ids, worker_id))
+                extended = [row[0] for row in cur.fetchall()]
+            conn.commit()
+        return extended
     except Exception as e:
-        print(f"❌ Ошибка при получении отложенных действий из Neon: {e}")
+        print(f"❌ Ошибка при продлении аренды действий {action_ids}: {e}")
         return []
 
+def release_claimed_actions(action_ids: list, worker_id: str, retry_after_seconds: float = 0) -> bool:
+    """
+    Возвращает неотправленные действия в очередь, снимая аренду worker_id.
+    С retry_after_seconds > 0 (например, по FloodWait) действия снова захватываются не раньше, чем через это время.
+    """
+    if not action_ids:
+        return True
+    sql = """
+        UPDATE public.pending_actions
+        SET delivery_status = 'pending', claimed_by = NULL,
+            lease_expires_at = CASE WHEN %s > 0 THEN NOW() + make_interval(secs => %s) END
+        WHERE id = ANY(%s) AND claimed_by = %s AND is_completed = FALSE
+    """
+    try:
+        with _get_db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(sql, (retry_after_seconds, retry_after_seconds, action_ids, worker_id))
+            conn.commit()
+        return True
+    except Exception as e:
+        print(f"❌ Ошибка при освобождении действий {action_ids}: {e}. Они освободятся по истечении аренды.")
+        return False
+
+def record_action_deliveries(deliveries: list) -> bool:
+    """
+    Одной транзакцией фиксирует результат отправки нескольких действий.
+    deliveries — [(action_id, user_id или None, chat_id публичного ответа или None)]:
+    действие помечается выполненным, контакт с пользователем записывается на сегодня,
+    а для публичного ответа обновляется время последнего поста в чате.
+    """
+    if not deliveries:
+        return True
+    action_ids = [action_id for action_id, _, _ in deliveries]
+    user_ids = sorted({user_id for _, user_id, _ in deliveries if user_id})
+    chat_ids = sorted({chat_id for _, _, chat_id in deliveries if chat_id})
+    try:
+        with _get_db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "UPDATE public.pending_actions SET is_completed = TRUE, delivery_status = 'sent', lease_expires_at = NULL WHERE id = ANY(%s)",
+                    (action_ids,)
+                )
+                if user_ids:
+                    psycopg2.extras.execute_values(cur, """
+                        INSERT INTO public.daily_user_contacts (user_id, last_contact_date)
+                        VALUES %s
+                        ON CONFLICT (user_id)
+                        DO UPDATE SET last_contact_date = EXCLUDED.last_contact_date;
+                    """, [(user_id, date.today()) for user_id in user_ids])
+                if chat_ids:
+                    psycopg2.extras.execute_values(cur, """
+                        INSERT INTO public.channel_state (chat_id, last_agent_post_timestamp)
+                        VALUES %s
+                        ON CONFLICT (chat_id)
+                        DO UPDATE SET last_agent_post_timestamp = EXCLUDED.last_agent_post_timestamp;
+                    """, [(chat_id, datetime.now(timezone.utc)) for chat_id in chat_ids])
+            conn.commit()
+        return True
+    except Exception as e:
+        print(f"❌ Ошибка при фиксации отправки действий {action_ids}: {e}")
+        return False
+
 def mark_action_as_completed(action_id):
-    sql = "UPDATE public.pending_actions SET is_completed = TRUE WHERE id = %s"
+    if _unit_of_work_active:
+        with _pending_lock:
+            _pending_writes['completed_actions'].add(action_id)
+        return True
+    sql = "UPDATE public.pending_actions SET is_completed = TRUE, delivery_status = 'sent', lease_expires_at = NULL WHERE id = %s"
     try:
         with _get_db_connection() as conn:
             with conn.cursor() as cur:
@@ -192,6 +1266,42 @@ def mark_action_as_completed(action_id):
         print(f"❌ Ошибка при обновлении статуса действия {action_id} в Neon: {e}")
         return False
 
+# --- Уведомления о новых действиях (LISTEN/NOTIFY) ---
+
+def open_notification_listener(channel: str = PENDING_ACTIONS_CHANNEL):
+    """
+    Открывает отдельное от пула соединение в режиме autocommit и подписывает его на канал `channel`.
+    Возвращает соединение или None, если подписаться не удалось.
+    """
+    try:
+        conn = psycopg2.connect(
+            config.DATABASE_LISTEN_URL,
+            keepalives=1, keepalives_idle=30, keepalives_interval=10, keepalives_count=3
+        )
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            cur.execute(psycopg2.sql.SQL("LISTEN {}").format(psycopg2.sql.Identifier(channel)))
+        return conn
+    except Exception as e:
+        print(f"❌ Не удалось подписаться на уведомления Neon ({channel}): {e}")
+        return None
+
+def read_notifications(conn) -> list:
+    """
+    Забирает уже пришедшие в соединение уведомления и возвращает их payload.
+    Не блокирует; если соединение оборвалось, бросает psycopg2.Error.
+    """
+    conn.poll()
+    payloads = [notify.payload for notify in conn.notifies]
+    conn.notifies.clear()
+    return payloads
+
+def close_notification_listener(conn):
+    try:
+        conn.close()
+    except Exception:
+        pass
+
 # --- Работа со статусом агента ---
 
 def is_agent_active():
@@ -264,6 +1374,9 @@ def get_keyword_triggers():
         return []
 
 def was_user_contacted_today(user_id: int) -> bool:
+    with _pending_lock:
+        if _pending_writes['user_contacts'].get(user_id) == date.today():
+            return True
     sql = "SELECT 1 FROM public.daily_user_contacts WHERE user_id = %s AND last_contact_date = %s"
     try:
         with _get_db_connection() as conn:
@@ -275,6 +1388,10 @@ def was_user_contacted_today(user_id: int) -> bool:
         return False
 
 def record_user_contact(user_id: int):
+    if _unit_of_work_active:
+        with _pending_lock:
+            _pending_writes['user_contacts'][user_id] = date.today()
+        return
     print(f"🔄 Запись о контакте с пользователем {user_id} на сегодня...")
     sql = """
         INSERT INTO public.daily_user_contacts (user_id, last_contact_date) 
@@ -0,0 +1,268 @@
+# components/dedup.py
+
+"""
+Подавление почти одинаковых сообщений перед AI-этапами.
+
+Спам и вакансии в рабочих чатах часто рассылаются сразу по многим чатам, и каждая копия
+раньше отдельно уходила и в Сортировщик, и в Классификатор лидов. Здесь каждое достаточно
+длинное сообщение нормализуется и относится к кластеру:
+  - точные копии (после нормализации) находятся по sha1 нормализованного текста;
+  - почти точные — по 64-битному SimHash: сообщения с расстоянием Хэмминга не больше
+    DEDUP_MAX_HAMMING_DISTANCE считаются одним кластером. Кандидаты ищутся по "полосам"
+    хэша (расстояние d делит 64 бита на d + 1 полос, и хотя бы одна полоса у близких хэшей
+    совпадает целиком), поэтому поиск не перебирает все известные кластеры.
+
+Кластеры и вердикты хранятся в таблице message_clusters и загружаются один раз за запуск.
+И Сортировщик, и Классификатор лидов видят только одного представителя кластера, после чего
+их вердикт запоминается в кластере и раздается всем копиям — в этом запуске и в следующих.
+"""
+
+import asyncio
+import hashlib
+import re
+from dataclasses import replace
+from collections import Counter
+from . import config
+from . import async_database_manager as adb
+from .structured_output import LeadDecision, RoutingDecision
+
+_HASH_BITS = 64
+_HASH_MASK = (1 << _HASH_BITS) - 1
+
+_URL_RE = re.compile(r'https?://\S+|t\.me/\S+|www\.\S+')
+_NON_WORD_RE = re.compile(r'[\W_]+')
+
+_load_lock = asyncio.Lock()
+_loaded = False
+
+# text_hash представителя -> {'text_hash', 'simhash', 'lead_type', 'route', 'new_copies'},
+# где route — (decision, persona) Сортировщика или None, пока он кластер не разбирал
+_clusters = {}
+_exact_index = {}  # text_hash любой увиденной копии -> text_hash представителя
+_band_index = []   # по словарю на полосу: значение полосы -> [text_hash представителей]
+_dirty = set()     # text_hash представителей, которые нужно записать в базу
+
+
+def _band_layout():
+    """Ширина и число полос SimHash для заданного порога расстояния."""
+    bands = config.DEDUP_MAX_HAMMING_DISTANCE + 1
+    return _HASH_BITS // bands, bands
+
+
+def normalize(text):
+    """Приводит текст к виду, в котором копии из разных чатов совпадают."""
+    text = text.casefold().replace('ё', 'е')
+    text = _URL_RE.sub(' url ', text)
+    return ' '.join(_NON_WORD_RE.sub(' ', text).split())
+
+
+def _features(normalized):
+    """Символьные триграммы с частотами: на коротких текстах они устойчивее шинглов из слов."""
+    return Counter(normalized[i:i + 3] for i in range(max(len(normalized) - 2, 1)))
+
+
+def simhash(normalized):
+    """64-битный SimHash нормализованного текста."""
+    weights = [0] * _HASH_BITS
+    for feature, count in _features(normalized).items():
+        value = int.from_bytes(hashlib.blake2b(feature.encode('utf-8'), digest_size=8).digest(), 'big')
+        for bit in range(_HASH_BITS):
+            weights[bit] += count if value >> bit & 1 else -count
+    return sum(1 << bit for bit, weight in enumerate(weights) if weight > 0)
+
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count('1')
+
+
+def _bands(value):
+    width, count = _band_layout()
+    mask = (1 << width) - 1
+    return [(value >> (band * width)) & mask for band in range(count)]
+
+
+def _index(cluster):
+    if not _band_index:
+        _band_index.extend({} for _ in range(_band_layout()[1]))
+    for band, value in zip(_band_index, _bands(cluster['simhash'])):
+        band.setdefault(value, []).append(cluster['text_hash'])
+    _exact_index[cluster['text_hash']] = cluster['text_hash']
+
+
+def _find_near(value):
+    for band, band_value in zip(_band_index, _bands(value)):
+        for text_hash in band.get(band_value, ()):
+            if hamming_distance(_clusters[text_hash]['simhash'], value) <= config.DEDUP_MAX_HAMMING_DISTANCE:
+                return _clusters[text_hash]
+    return None
+
+
+async def load():
+    """Загружает кластеры за последние DEDUP_WINDOW_DAYS дней (один раз за процесс)."""
+    global _loaded
+    async with _load_lock:
+        if _loaded:
+            return
+        rows = await adb.load_message_clusters(config.DEDUP_WINDOW_DAYS)
+        for text_hash, signed_simhash, lead_type, route_decision, route_persona in rows:
+            cluster = {
+                'text_hash': text_hash,
+                'simhash': signed_simhash & _HASH_MASK,
+                'lead_type': lead_type,
+                'route': (route_decision, route_persona) if route_decision else None,
+                'new_copies': 0,
+            }
+            _clusters[text_hash] = cluster
+            _index(cluster)
+        _loaded = True
+        print(f"✅ Загружено кластеров повторяющихся сообщений: {len(rows)}.")
+
+
+def cluster_for(text, count=True):
+    """
+    Возвращает кластер сообщения (создавая новый при необходимости)
+    или None, если текст слишком короткий для надежного сравнения.
+    count=False — не учитывать сообщение как новую копию (оно уже учтено на предыдущем этапе).
+    """
+    normalized = normalize(text or '')
+    if len(normalized) < config.DEDUP_MIN_TEXT_LENGTH:
+        return None
+
+    text_hash = hashlib.sha1(normalized.encode('utf-8')).hexdigest()
+    representative = _exact_index.get(text_hash)
+    if representative:
+        cluster = _clusters[representative]
+    else:
+        value = simhash(normalized)
+        cluster = _find_near(value)
+        if cluster is None:
+            cluster = {'text_hash': text_hash, 'simhash': value, 'lead_type': None, 'route': None, 'new_copies': 0}
+            _clusters[text_hash] = cluster
+            _index(cluster)
+            _dirty.add(text_hash)
+        else:
+            _exact_index[text_hash] = cluster['text_hash']
+
+    if count:
+        cluster['new_copies'] += 1
+        _dirty.add(cluster['text_hash'])
+    return cluster
+
+
+def group_for_router(messages):
+    """
+    Готовит сообщения для Сортировщика.
+    Возвращает (представители для сортировки, уже известные решения, группы),
+    где группы — {ID представителя: (кластер, [копии])}. Короткие сообщения не группируются.
+    """
+    representatives = []
+    known_decisions = []
+    groups = {}
+    representative_by_cluster = {}
+    for message in messages:
+        cluster = cluster_for(message.text)
+        if cluster is None:
+            representatives.append(message)
+            continue
+        text_hash = cluster['text_hash']
+        if text_hash in representative_by_cluster:
+            groups[representative_by_cluster[text_hash]][1].append(message)
+            continue
+        representative_by_cluster[text_hash] = message.id
+        groups[message.id] = (cluster, [])
+        if cluster['route']:
+            decision, persona = cluster['route']
+            known_decisions.append(RoutingDecision(message.id, decision, persona))
+        else:
+            representatives.append(message)
+
+    reused = len(messages) - len(representatives)
+    if reused:
+        print(f" 	♻️ Повторы уже виденных сообщений не отправляются Сортировщику: {reused}.")
+    return representatives, known_decisions, groups
+
+
+def fan_out_routing_decisions(decisions, groups):
+    """
+    Запоминает решения Сортировщика в кластерах представителей и раздает их копиям.
+    Возвращает решения для всех сообщений, включая копии.
+    """
+    fanned_out = []
+    for decision in decisions:
+        cluster, copies = groups.get(decision.message_id, (None, []))
+        route = (decision.decision, decision.persona)
+        if cluster and cluster['route'] != route:
+            cluster['route'] = route
+            _dirty.add(cluster['text_hash'])
+        fanned_out.append(decision)
+        for copy in copies:
+            fanned_out.append(replace(decision, message_id=copy.id))
+    return fanned_out
+
+
+def group_for_leads(messages):
+    """
+    Готовит сообщения для Классификатора лидов.
+    Возвращает (представители для классификации, уже известные решения, группы),
+    где группы — {ID представителя: (кластер, [копии])}.
+    """
+    representatives = []
+    known_decisions = []
+    groups = {}
+    representative_by_cluster = {}
+    for message in messages:
+        cluster = cluster_for(message.text, count=False)
+        if cluster is None:
+            representatives.append(message)
+            continue
+        text_hash = cluster['text_hash']
+        if text_hash in representative_by_cluster:
+            groups[representative_by_cluster[text_hash]][1].append(message)
+            continue
+        representative_by_cluster[text_hash] = message.id
+        groups[message.id] = (cluster, [])
+        if cluster['lead_type']:
+            known_decisions.append(LeadDecision(message.id, cluster['lead_type']))
+        else:
+            representatives.append(message)
+
+    reused = len(messages) - len(representatives)
+    if reused:
+        print(f"  ♻️ Повторяющихся сообщений, не отправленных на классификацию: {reused}.")
+    return representatives, known_decisions, groups
+
+
+def fan_out_lead_decisions(decisions, groups):
+    """
+    Запоминает вердикты представителей в их кластерах и раздает их копиям.
+    Возвращает решения для всех сообщений, включая копии.
+    """
+    fanned_out = []
+    for decision in decisions:
+        cluster, copies = groups.get(decision.message_id, (None, []))
+        if cluster and cluster['lead_type'] != decision.lead_type:
+            cluster['lead_type'] = decision.lead_type
+            _dirty.add(cluster['text_hash'])
+        fanned_out.append(decision)
+        for copy in copies:
+            fanned_out.append(replace(decision, message_id=copy.id))
+    return fanned_out
+
+
+async def save():
+    """Записывает новые и изменившиеся кластеры в базу."""
+    if not _dirty:
+        return
+    text_hashes = list(_dirty)
+    _dirty.clear()
+    rows = []
+    for text_hash in text_hashes:
+        cluster = _clusters[text_hash]
+        signed_simhash = cluster['simhash'] - (1 << _HASH_BITS) if cluster['simhash'] >> 63 else cluster['simhash']
+        route_decision, route_persona = cluster['route'] or (None, None)
+        rows.append((text_hash, signed_simhash, cluster['lead_type'], route_decision, route_persona, cluster['new_copies']))
+    if await adb.save_message_clusters(rows, config.DEDUP_WINDOW_DAYS):
+        for text_hash in text_hashes:
+            _clusters[text_hash]['new_copies'] = 0
+    else:
+        _dirty.update(text_hashes)
@@ -0,0 +1,131 @@
+# components/delivery_service.py
+
+"""
+Доставка одобренных действий по уведомлениям Postgres (LISTEN/NOTIFY).
+
+Раньше одобренный ответ из public.pending_actions уходил, только когда кто-то вызывал
+sender_service.send_pending_messages, и мог часами терять актуальность. Теперь триггер
+pending_actions_notify при вставке действия делает NOTIFY, а этот модуль держит отдельное
+соединение с LISTEN, встроенное в цикл asyncio через loop.add_reader, и в течение
+нескольких секунд запускает отправку на уже подключенном клиенте Telethon.
+
+Если уведомление потерялось (обрыв соединения, пулер без LISTEN, цикл событий без add_reader),
+очередь все равно проверяется каждые DELIVERY_POLL_SECONDS, а подписка восстанавливается.
+Режим работает отдельно (`python -u main.py --deliver`) или фоном внутри демона (start/stop).
+"""
+
+import asyncio
+import psycopg2
+from . import config
+from . import database_manager as db
+from . import async_database_manager as adb
+from . import sender_service
+
+_task = None
+
+
+class _Listener:
+    """Соединение с LISTEN, пробуждающее event при каждом уведомлении."""
+
+    def __init__(self, event):
+        self.event = event
+        self.conn = None
+        self.loop = None
+        # Отсутствие add_reader не лечится переподключением, поэтому второй раз не пробуем
+        self.supported = True
+
+    @property
+    def active(self):
+        return self.conn is not None
+
+    async def connect(self):
+        conn = await adb.open_notification_listener()
+        if conn is None:
+            return
+        loop = asyncio.get_running_loop()
+        try:
+            loop.add_reader(conn.fileno(), self._on_readable)
+        except NotImplementedError:
+            # Например, ProactorEventLoop в Windows: остаемся на периодическом опросе
+            print("⚠️ Цикл событий не поддерживает add_reader. Доставка работает только по опросу.")
+            db.close_notification_listener(conn)
+            self.supported = False
+            return
+        self.conn, self.loop = conn, loop
+        print(f"👂 Подписка на уведомления '{db.PENDING_ACTIONS_CHANNEL}' активна.")
+
+    def _on_readable(self):
+        try:
+            payloads = db.read_notifications(self.conn)
+        except psycopg2.Error as e:
+            print(f"⚠️ Соединение с уведомлениями оборвалось: {e}. Переподключимся при следующем опросе.")
+            self.close()
+            # Пока подписки нет, могли прийти новые действия — проверяем очередь сразу
+            self.event.set()
+            return
+        if payloads:
+            self.event.set()
+
+    def close(self):
+        if self.conn is None:
+            return
+        try:
+            self.loop.remove_reader(self.conn.fileno())
+        except Exception:
+            pass
+        db.close_notification_listener(self.conn)
+        self.conn = None
+
+
+async def run(client):
+    """
+    Цикл доставки: отправляет очередь при каждом уведомлении и не реже раза в DELIVERY_POLL_SECONDS.
+    Работает, пока агент активен в базе данных (проверяется перед каждой отправкой).
+    """
+    print(f"\n--- 🚚 Режим доставки: уведомления Neon, резервный опрос раз в {config.DELIVERY_POLL_SECONDS} с. ---")
+    wakeup = asyncio.Event()
+    listener = _Listener(wakeup)
+    # Сначала отправляем то, что одобрили, пока доставка не работала
+    wakeup.set()
+    try:
+        while True:
+            if listener.supported and not listener.active:
+                await listener.connect()
+
+            try:
+                await asyncio.wait_for(wakeup.wait(), timeout=config.DELIVERY_POLL_SECONDS)
+                # Даем вставкам одной пачки одобрений дойти, чтобы отправить их за один проход
+                await asyncio.sleep(config.DELIVERY_DEBOUNCE_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            wakeup.clear()
+
+            if not await adb.is_agent_active():
+                print("⏹️ Агент деактивирован. Доставка останавливается.")
+                return
+
+            try:
+                await sender_service.send_pending_messages(client)
+            except Exception as e:
+                print(f"❌ Ошибка доставки одобренных действий: {e}")
+    finally:
+        listener.close()
+
+
+def start(client):
+    """Запускает доставку фоном в текущем цикле событий (для режима демона)."""
+    global _task
+    if _task is None or _task.done():
+        _task = asyncio.create_task(run(client))
+
+
+async def stop():
+    """Останавливает фоновую доставку."""
+    global _task
+    if _task is not None:
+        _task.cancel()
+        try:
+            await _task
+        except asyncio.CancelledError:
+            pass
+        _task = None
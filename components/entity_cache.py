@@ -0,0 +1,104 @@
+# components/entity_cache.py
+
+"""
+Кэш разрешенных сущностей Telegram в таблице target_chats.
+
+StringSession не хранит access_hash между запусками, поэтому каждый get_entity уходит в сеть
+и легко упирается в FloodWait. Здесь access_hash чата и связка "канал → чат комментариев"
+сохраняются в Neon, и в обычном запуске InputPeer собирается из базы без запросов к Telegram.
+Запись обновляется из сети, если она старше ENTITY_CACHE_TTL_DAYS или была помечена
+недействительной через invalidate().
+"""
+
+from datetime import datetime, timezone, timedelta
+from telethon import utils
+from telethon.tl import types
+from telethon.tl.functions.channels import GetFullChannelRequest
+from . import config
+from . import async_database_manager as adb
+
+
+def _input_peer(peer_id, access_hash):
+    """Собирает InputPeer из помеченного ID (-100...) и сохраненного access_hash."""
+    real_id, peer_type = utils.resolve_id(peer_id)
+    if peer_type is types.PeerChannel:
+        return types.InputPeerChannel(channel_id=real_id, access_hash=access_hash)
+    if peer_type is types.PeerChat:
+        return types.InputPeerChat(chat_id=real_id)
+    return types.InputPeerUser(user_id=real_id, access_hash=access_hash)
+
+
+def _is_fresh(chat_info):
+    resolved_at = chat_info.get('entity_resolved_at')
+    if not resolved_at:
+        return False
+    return datetime.now(timezone.utc) - resolved_at < timedelta(days=config.ENTITY_CACHE_TTL_DAYS)
+
+
+async def _resolve_from_network(client, chat_id):
+    """
+    Разрешает чат через Telegram и возвращает (entity, linked_entity).
+    Для каналов-трансляций связанный чат комментариев берется из полной информации о канале.
+    """
+    entity = await client.get_entity(chat_id)
+    linked_entity = None
+
+    linked_chat_id = getattr(entity, 'linked_chat_id', None)
+    if not linked_chat_id and getattr(entity, 'broadcast', False):
+        full = await client(GetFullChannelRequest(entity))
+        linked_chat_id = full.full_chat.linked_chat_id
+        # Связанный чат приходит в том же ответе вместе со своим access_hash
+        linked_entity = next((chat for chat in full.chats if chat.id == linked_chat_id), None)
+
+    if linked_chat_id and linked_entity is None:
+        linked_entity = await client.get_entity(types.PeerChannel(linked_chat_id))
+
+    return entity, linked_entity
+
+
+async def resolve_chat(client, chat_info):
+    """
+    Возвращает (input_peer, linked_chat_id, linked_input_peer) для строки target_chats.
+    linked_chat_id — помеченный ID чата комментариев (-100...) или None.
+    """
+    chat_id = chat_info['chat_id']
+
+    if _is_fresh(chat_info):
+        input_peer = _input_peer(chat_id, chat_info['access_hash'])
+        linked_chat_id = chat_info.get('linked_chat_id')
+        linked_input_peer = (
+            _input_peer(linked_chat_id, chat_info.get('linked_access_hash'))
+            if linked_chat_id else None
+        )
+        return input_peer, linked_chat_id, linked_input_peer
+
+    print(f" 	🔄 Разрешение чата {chat_id} через Telegram (нет в кэше или кэш устарел)...")
+    entity, linked_entity = await _resolve_from_network(client, chat_id)
+
+    linked_chat_id = utils.get_peer_id(linked_entity) if linked_entity else None
+    await adb.save_chat_entity(
+        chat_id,
+        getattr(entity, 'access_hash', None),
+        linked_chat_id,
+        getattr(linked_entity, 'access_hash', None) if linked_entity else None
+    )
+
+    # Обновляем и словарь в памяти, чтобы повторные вызовы в этом запуске не шли в сеть
+    chat_info.update({
+        'access_hash': getattr(entity, 'access_hash', None),
+        'linked_chat_id': linked_chat_id,
+        'linked_access_hash': getattr(linked_entity, 'access_hash', None) if linked_entity else None,
+        'entity_resolved_at': datetime.now(timezone.utc),
+    })
+
+    return (
+        utils.get_input_peer(entity),
+        linked_chat_id,
+        utils.get_input_peer(linked_entity) if linked_entity else None
+    )
+
+
+async def invalidate(chat_info):
+    """Помечает кэш чата устаревшим: в следующий раз чат будет разрешен заново через сеть."""
+    chat_info['entity_resolved_at'] = None
+    await adb.invalidate_chat_entity(chat_info['chat_id'])
@@ -0,0 +1,98 @@
+# components/keyword_matcher.py
+
+"""
+Поиск ключевых слов-триггеров в сообщениях за один проход по тексту.
+
+Раньше каждое сообщение заново приводилось к нижнему регистру для каждого ключевого слова
+и просматривалось столько раз, сколько было триггеров: O(сообщения × слова × длина).
+KeywordMatcher строит автомат Ахо-Корасик один раз за запуск, после чего поиск всех
+совпадений в сообщении занимает один проход по его тексту независимо от числа ключевых слов.
+Сравнение идет без учета регистра (str.casefold, корректно для кириллицы и "ß").
+"""
+
+
+def _is_word_char(char):
+    return char.isalnum() or char == '_'
+
+
+class KeywordMatcher:
+    def __init__(self, keywords, whole_words=False):
+        """
+        keywords    — список ключевых слов (например, из db.get_keyword_triggers()).
+        whole_words — если True, слово засчитывается, только когда вокруг него нет букв и цифр
+                      ("java" не найдется в "javascript"). По умолчанию ищутся подстроки,
+                      как и в прежней проверке `keyword in text`.
+        """
+        self.whole_words = whole_words
+        self._keywords = []
+
+        # Бор: переходы, суффиксные ссылки и список (keyword, длина) для каждого состояния
+        self._transitions = [{}]
+        self._fail = [0]
+        self._outputs = [[]]
+
+        for keyword in keywords:
+            normalized = keyword.casefold().strip() if keyword else ''
+            if not normalized:
+                continue
+            self._keywords.append(keyword)
+            self._add(keyword, normalized)
+        self._build_fail_links()
+
+    def __len__(self):
+        return len(self._keywords)
+
+    def _add(self, keyword, normalized):
+        state = 0
+        for char in normalized:
+            next_state = self._transitions[state].get(char)
+            if next_state is None:
+                next_state = len(self._transitions)
+                self._transitions[state][char] = next_state
+                self._transitions.append({})
+                self._fail.append(0)
+                self._outputs.append([])
+            state = next_state
+        self._outputs[state].append((keyword, len(normalized)))
+
+    def _build_fail_links(self):
+        queue = list(self._transitions[0].values())
+        for state in queue:
+            for char, next_state in self._transitions[state].items():
+                fail = self._fail[state]
+                while fail and char not in self._transitions[fail]:
+                    fail = self._fail[fail]
+                candidate = self._transitions[fail].get(char, 0)
+                self._fail[next_state] = candidate if candidate != next_state else 0
+                # Совпадения более коротких суффиксов наследуются, чтобы не ходить по ссылкам при поиске
+                self._outputs[next_state] = self._outputs[next_state] + self._outputs[self._fail[next_state]]
+                queue.append(next_state)
+
+    def find_all(self, text):
+        """Возвращает все ключевые слова, найденные в тексте, в порядке их первого появления."""
+        if not text or not self._keywords:
+            return []
+
+        text = text.casefold()
+        transitions, fail, outputs = self._transitions, self._fail, self._outputs
+        found = {}
+        state = 0
+        for index, char in enumerate(text):
+            while state and char not in transitions[state]:
+                state = fail[state]
+            state = transitions[state].get(char, 0)
+            for keyword, length in outputs[state]:
+                if keyword in found:
+                    continue
+                if self.whole_words:
+                    start, end = index - length + 1, index + 1
+                    if start > 0 and _is_word_char(text[start - 1]):
+                        continue
+                    if end < len(text) and _is_word_char(text[end]):
+                        continue
+                found[keyword] = None
+        return list(found)
+
+    def matches(self, text):
+        """True, если в тексте есть хотя бы одно ключевое слово."""
+        return bool(self.find_all(text))
@@ -1,5 +1,39 @@
+import asyncio
+from types import SimpleNamespace
 from . import ai_processor
-from . import approval_service
+from . import async_database_manager as adb
+from . import approval_outbox
+from . import config
+from . import dedup
+from . import model_client
+from .structured_output import LeadDecision
+
+
+def _retry_entry(message, lead_type=None):
+    sender = getattr(message, 'sender', None)
+    return (
+        message.chat_id, message.id, getattr(message, 'sender_id', None),
+        getattr(sender, 'username', None), getattr(sender, 'first_name', None),
+        message.text, lead_type
+    )
+
+
+def _message_from_retry(row):
+    """Восстанавливает из отложенной записи объект с теми полями сообщения Telethon, которые нужны "Охотнику"."""
+    sender = None
+    if row['sender_id']:
+        sender = SimpleNamespace(id=row['sender_id'], username=row['sender_username'], first_name=row['sender_first_name'])
+    return SimpleNamespace(
+        id=row['message_id'], chat_id=row['chat_id'], text=row['message_text'],
+        sender_id=row['sender_id'], sender=sender
+    )
+
+
+async def _defer(entries):
+    # Одно сообщение может попасть в пачку дважды (из нового запуска и из отложенных)
+    unique = {(entry[0], entry[1]): entry for entry in entries}
+    await adb.save_lead_retries(list(unique.values()))
+
 
 async def find_and_process_leads(client, messages):
     """
@@ -7,22 +41,53 @@ async def find_and_process_leads(client, messages):
     1. Классифицирует все сообщения, чтобы найти лиды.
     2. Для каждого найденного лида генерирует персонализированное сообщение.
     3. Отправляет готовый результат на утверждение.
+
+    Если Gemini недоступен (ModelCallError), сообщения и лиды не теряются: они откладываются
+    в lead_retry_queue и обрабатываются в начале следующего вызова вместе с новыми сообщениями.
     """
-    if not messages:
-        # Это дополнительная проверка, хотя main.py уже делает такую.
+    # Сообщения и лиды, отложенные прошлыми запусками из-за недоступности Gemini
+    retry_rows = await adb.get_lead_retries(config.LEAD_RETRY_BATCH_SIZE, config.LEAD_RETRY_MAX_AGE_HOURS)
+    retried_messages = [_message_from_retry(row) for row in retry_rows]
+    retried_leads = [
+        LeadDecision(row['message_id'], row['lead_type']) for row in retry_rows if row['lead_type']
+    ]
+    messages_to_classify = list(messages) + [
+        message for message, row in zip(retried_messages, retry_rows) if not row['lead_type']
+    ]
+    if retry_rows:
+        print(f"  🔁 Повторная обработка отложенных сообщений \"Охотника\": {len(retry_rows)}.")
+
+    if not messages_to_classify and not retried_leads:
         return
 
-    # 1. Отправляем ВСЕ сообщения на классификацию для поиска лидов
-    print("  🕵️‍♂️ Отправка сообщений на классификацию (поиск лидов)...")
-    lead_decisions = await ai_processor.get_lead_decisions(messages)
-    
+    lead_decisions = []
+    if messages_to_classify:
+        # 1. Отправляем ВСЕ сообщения на классификацию для поиска лидов
+        print("  🕵️‍♂️ Отправка сообщений на классификацию (поиск лидов)...")
+        # Из каждого кластера повторяющихся сообщений классифицируется один представитель,
+        # а для уже известных кластеров вердикт берется из базы
+        await dedup.load()
+        representatives, known_decisions, groups = dedup.group_for_leads(messages_to_classify)
+        try:
+            new_decisions = await ai_processor.get_lead_decisions(representatives) if representatives else []
+            lead_decisions = dedup.fan_out_lead_decisions(known_decisions + new_decisions, groups)
+        except model_client.ModelCallError:
+            await _defer([_retry_entry(message) for message in messages_to_classify])
+            # Неклассифицированные отложенные сообщения только что записаны заново, их не удаляем
+            retry_rows = [row for row in retry_rows if row['lead_type']]
+
+    lead_decisions = lead_decisions + retried_leads
+    # Отложенные записи, которые дальше обрабатываются заново или уже не нужны, удаляются;
+    # лиды, снова упершиеся в недоступность Gemini, будут отложены еще раз
+    await adb.delete_lead_retries([(row['chat_id'], row['message_id']) for row in retry_rows])
+
     if not lead_decisions:
         print("  ✅ AI-классификатор не вернул решений.")
         return
 
     # 2. Фильтруем результаты, чтобы работать только с лидами
-    hot_leads = [d for d in lead_decisions if d.get('lead_type') == 'hot_lead']
-    cold_leads = [d for d in lead_decisions if d.get('lead_type') == 'cold_lead']
+    hot_leads = [d for d in lead_decisions if d.lead_type == 'hot_lead']
+    cold_leads = [d for d in lead_decisions if d.lead_type == 'cold_lead']
 
     if not hot_leads and not cold_leads:
         print("  ✅ Потенциальные лиды не найдены после классификации.")
@@ -30,40 +95,71 @@ async def find_and_process_leads(client, messages):
 
     print(f"  🔥 Найдено горячих лидов: {len(hot_leads)}. ❄️ Найдено холодных: {len(cold_leads)}.")
 
+    # Горячие лиды ставятся в очередь первыми: семафор пропускает ожидающих по порядку,
+    # поэтому генерация для них начинается раньше холодных
     all_leads = hot_leads + cold_leads
     # Создаем словарь для быстрого доступа к объекту сообщения по его ID
-    message_map = {msg.id: msg for msg in messages}
-
-    # 3. Обрабатываем каждый найденный лид
-    for lead_decision in all_leads:
-        message_id = lead_decision.get('message_id')
-        target_message = message_map.get(message_id)
-
-        if not target_message or not hasattr(target_message, 'sender') or not target_message.sender:
-            print(f"  ⚠️ Пропускаем лид для сообщения {message_id}: не найден автор.")
-            continue
-        
-        # 4. Для каждого лида генерируем персонализированное сообщение
+    message_map = {msg.id: msg for msg in retried_messages}
+    message_map.update({msg.id: msg for msg in messages})
+    semaphore = asyncio.Semaphore(config.LEAD_OUTREACH_CONCURRENCY)
+
+    # 3. Обрабатываем все найденные лиды параллельно и отправляем каждый, как только он готов
+    deferred = []
+    tasks = [
+        asyncio.create_task(_process_lead(lead_decision, message_map, semaphore, deferred))
+        for lead_decision in all_leads
+    ]
+    sent_count = 0
+    for finished in asyncio.as_completed(tasks):
+        try:
+            if await finished:
+                sent_count += 1
+        except Exception as e:
+            # Ошибка одного лида не должна останавливать остальные
+            print(f"  ❌ Ошибка при обработке лида: {e}")
+    await _defer(deferred)
+
+    print(f"  ✅ Отправлено на утверждение лидов: {sent_count} из {len(all_leads)}.")
+
+
+async def _process_lead(lead_decision, message_map, semaphore, deferred):
+    """
+    Генерирует сообщение для одного лида и отправляет его на утверждение. Возвращает True при успехе.
+    Если Gemini недоступен, лид добавляется в deferred для откладывания до следующего запуска.
+    """
+    message_id = lead_decision.message_id
+    target_message = message_map.get(message_id)
+
+    if not target_message or not hasattr(target_message, 'sender') or not target_message.sender:
+        print(f"  ⚠️ Пропускаем лид для сообщения {message_id}: не найден автор.")
+        return False
+
+    # 4. Для каждого лида генерируем персонализированное сообщение
+    async with semaphore:
         print(f"  🤖 Генерация персонального сообщения для лида (ID сообщения: {message_id})...")
-        generated_pitch = await ai_processor.generate_lead_outreach_message(target_message)
-
-        if not generated_pitch or not generated_pitch.get('pitch_text'):
-            print(f"  ⚠️ AI-генератор не создал текст для лида {message_id}.")
-            continue
-
-        # 5. Формируем полный пакет данных и отправляем его воркеру на утверждение
-        lead_payload = {
-            'action_type': 'lead_outreach', # Новый тип действия для воркера
-            'lead_type': lead_decision.get('lead_type'),
-            'lead_user_id': target_message.sender.id,
-            'lead_username': target_message.sender.username,
-            'lead_first_name': target_message.sender.first_name,
-            'original_message_text': target_message.text,
-            'original_message_id': target_message.id,
-            'source_chat_id': target_message.chat_id,
-            'pitch_text': generated_pitch.get('pitch_text')
-        }
-        
-        print(f"  📤 Отправка лида '{lead_payload['lead_first_name']}' ({lead_payload['lead_type']}) на утверждение...")
-        # Используем уже существующий сервис для отправки
-        approval_service.send_action_for_approval(lead_payload)
\ No newline at end of file
+        try:
+            generated_pitch = await ai_processor.generate_lead_outreach_message(target_message)
+        except model_client.ModelCallError:
+            deferred.append(_retry_entry(target_message, lead_decision.lead_type))
+            return False
+
+    if not generated_pitch or not generated_pitch.get('pitch_text'):
+        print(f"  ⚠️ AI-генератор не создал текст для лида {message_id}.")
+        return False
+
+    # 5. Формируем полный пакет данных и отправляем его воркеру на утверждение
+    lead_payload = {
+        'action_type': 'lead_outreach', # Новый тип действия для воркера
+        'lead_type': lead_decision.lead_type,
+        'lead_user_id': target_message.sender.id,
+        'lead_username': target_message.sender.username,
+        'lead_first_name': target_message.sender.first_name,
+        'original_message_text': target_message.text,
+        'original_message_id': target_message.id,
+        'source_chat_id': target_message.chat_id,
+        'pitch_text': generated_pitch.get('pitch_text')
+    }
+
+    print(f"  📤 Отправка лида '{lead_payload['lead_first_name']}' ({lead_payload['lead_type']}) на утверждение...")
+    # Лид сначала надежно записывается в outbox, доставку воркеру выполняет фоновая задача
+    return await approval_outbox.enqueue(lead_payload)
@@ -0,0 +1,291 @@
+# components/model_client.py
+
+"""
+Надежный вызов моделей Gemini для всех этапов ai_processor.
+
+Раньше один медленный или упавший вызов Gemini Pro задерживал весь запуск, а ошибка
+превращалась в None, и работа просто терялась. generate() оборачивает generate_content_async:
+  - у каждого этапа свой таймаут (GEMINI_*_TIMEOUT_SECONDS);
+  - ошибки 429 и 5xx, таймауты и сбои соединения повторяются с экспоненциальной задержкой со
+    случайным разбросом (full jitter), не больше GEMINI_MAX_RETRIES раз;
+  - на этапах из GEMINI_HEDGE_STAGES, если ответ задерживается дольше обычного (p95 задержек
+    этапа, а пока статистики мало — GEMINI_HEDGE_DELAY_SECONDS), отправляется дублирующий
+    запрос, и используется тот ответ, что пришел первым;
+  - автомат защиты (circuit breaker) на модель: после GEMINI_BREAKER_FAILURE_THRESHOLD
+    неудач подряд модель не вызывается GEMINI_BREAKER_COOLDOWN_SECONDS, затем пропускается
+    один пробный вызов.
+Если сервис так и не ответил (таймауты, 429, 5xx, сбои соединения, автомат защиты), выбрасывается ModelCallError,
+чтобы вызывающий код мог не отмечать сообщения обработанными и повторить их позже. Если модель
+отвергла сам запрос (ответ 4xx, кроме 429: например, 400 из-за схемы или настроек), выбрасывается ModelRequestError:
+повтор того же запроса ничего не даст, и сообщения надо считать обработанными.
+Каждая попытка учитывается в метриках (print_stats()).
+"""
+
+import asyncio
+import random
+import threading
+import time
+from google.api_core import exceptions as google_exceptions
+from . import config
+from . import quota_governor
+
+_STAGE_TIMEOUTS = {
+    'router': config.GEMINI_ROUTER_TIMEOUT_SECONDS,
+    'reply': config.GEMINI_REPLY_TIMEOUT_SECONDS,
+    'lead_classifier': config.GEMINI_LEAD_CLASSIFIER_TIMEOUT_SECONDS,
+    'lead_outreach': config.GEMINI_LEAD_OUTREACH_TIMEOUT_SECONDS,
+}
+
+# Сколько последних удачных задержек этапа хранить и с какого количества им доверять
+_LATENCY_WINDOW = 200
+_LATENCY_MIN_SAMPLES = 20
+
+
+class ModelCallError(Exception):
+    """Вызов модели не удался после всех повторов (или модель временно отключена автоматом защиты)."""
+
+
+class ModelRequestError(Exception):
+    """Модель отвергла запрос (ошибка не временная): повторять тот же запрос бессмысленно."""
+
+
+class _CircuitBreaker:
+    def __init__(self):
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+
+    def allow(self):
+        if self.opened_at is None:
+            return True
+        if time.monotonic() - self.opened_at < config.GEMINI_BREAKER_COOLDOWN_SECONDS:
+            return False
+        # Полуоткрытое состояние: пропускаем ровно один пробный вызов
+        if self.trial_in_flight:
+            return False
+        self.trial_in_flight = True
+        return True
+
+    def cancel_trial(self):
+        # Пробный вызов отменен (завершение работы, отмена задачи): следующий вызов станет пробным
+        self.trial_in_flight = False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        self.trial_in_flight = False
+        if self.opened_at is not None or self.failures >= config.GEMINI_BREAKER_FAILURE_THRESHOLD:
+            self.opened_at = time.monotonic()
+
+
+_lock = threading.Lock()
+_breakers = {}   # model_name -> _CircuitBreaker
+_latencies = {}  # stage -> [секунды удачных попыток]
+_metrics = {}    # stage -> счетчики
+
+
+def _stage_metrics(stage):
+    return _metrics.setdefault(stage, {
+        'calls': 0, 'attempts': 0, 'succeeded': 0, 'failed': 0, 'retries': 0,
+        'timeouts': 0, 'rate_limited': 0, 'server_errors': 0, 'other_errors': 0,
+        'cancelled': 0, 'hedges': 0, 'hedge_wins': 0, 'breaker_rejections': 0, 'latency_total': 0.0,
+    })
+
+
+def _count(stage, *names):
+    with _lock:
+        stage_metrics = _stage_metrics(stage)
+        for name in names:
+            stage_metrics[name] += 1
+
+
+def _breaker(model_name):
+    with _lock:
+        return _breakers.setdefault(model_name, _CircuitBreaker())
+
+
+def _is_retryable(error):
+    # Окончательно отвергнутым считается только ответ 4xx (кроме 429). Таймауты, 429, 5xx и сбои
+    # транспорта (ConnectionError, OSError, DeadlineExceeded и т. п.) — временные
+    if isinstance(error, google_exceptions.TooManyRequests):
+        return True
+    return not isinstance(error, google_exceptions.ClientError)
+
+
+def _error_kind(error):
+    if isinstance(error, asyncio.TimeoutError):
+        return 'timeouts'
+    if isinstance(error, google_exceptions.TooManyRequests):
+        return 'rate_limited'
+    if isinstance(error, google_exceptions.ServerError):
+        return 'server_errors'
+    return 'other_errors'
+
+
+def _hedge_delay(stage):
+    with _lock:
+        samples = sorted(_latencies.get(stage, ()))
+    if len(samples) < _LATENCY_MIN_SAMPLES:
+        return config.GEMINI_HEDGE_DELAY_SECONDS
+    return samples[int(len(samples) * 0.95) - 1]
+
+
+def _backoff_delay(attempt):
+    return random.uniform(0, min(config.GEMINI_BACKOFF_MAX_SECONDS, config.GEMINI_BACKOFF_BASE_SECONDS * 2 ** attempt))
+
+
+async def _attempt(model, model_name, stage, prompt, generation_config, estimated_tokens):
+    """
+    Одна попытка: ожидание квоты, затем вызов (_call).
+    Каждая попытка (включая повторы и дубли) расходует квоту модели, ожидание квоты не входит в таймаут.
+    """
+    await quota_governor.acquire(model_name, estimated_tokens)
+    return await _call(model, model_name, stage, prompt, generation_config, estimated_tokens)
+
+
+async def _call(model, model_name, stage, prompt, generation_config, estimated_tokens):
+    """Вызов с таймаутом этапа после того, как квота уже получена. Учитывает его в метриках и задержках."""
+    _count(stage, 'attempts')
+    started = time.monotonic()
+    try:
+        response = await asyncio.wait_for(
+            model.generate_content_async(prompt, generation_config=generation_config),
+            timeout=_STAGE_TIMEOUTS.get(stage, config.GEMINI_REPLY_TIMEOUT_SECONDS)
+        )
+    except asyncio.CancelledError:
+        # Проигравший дублирующий запрос отменяется, это не ошибка
+        _count(stage, 'cancelled')
+        raise
+    except Exception as e:
+        _count(stage, _error_kind(e))
+        raise
+    latency = time.monotonic() - started
+    quota_governor.settle(model_name, estimated_tokens, response)
+    with _lock:
+        _stage_metrics(stage)['latency_total'] += latency
+        stage_latencies = _latencies.setdefault(stage, [])
+        stage_latencies.append(latency)
+        del stage_latencies[:-_LATENCY_WINDOW]
+    return response
+
+
+async def _hedged_attempt(model, model_name, stage, prompt, generation_config, estimated_tokens):
+    """
+    Попытка с дублирующим запросом, если первый отвечает дольше обычного.
+    Отсчет до дубля начинается после получения квоты, а пока вызовы модели ждут в очереди
+    ограничителя квот, дубль не отправляется: он только удвоил бы расход и без того нехватающей квоты.
+    """
+    await quota_governor.acquire(model_name, estimated_tokens)
+    primary = asyncio.ensure_future(_call(model, model_name, stage, prompt, generation_config, estimated_tokens))
+    try:
+        done, _ = await asyncio.wait({primary}, timeout=_hedge_delay(stage))
+    except asyncio.CancelledError:
+        primary.cancel()
+        raise
+    if done:
+        return primary.result()
+    if quota_governor.get_queue_depth(model_name) > 0:
+        return await primary
+
+    _count(stage, 'hedges')
+    hedge = asyncio.ensure_future(_attempt(model, model_name, stage, prompt, generation_config, estimated_tokens))
+    pending = {primary, hedge}
+    error = None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is hedge:
+                        _count(stage, 'hedge_wins')
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def generate(model, model_name, stage, prompt, generation_config=None, estimated_tokens=0):
+    """
+    Вызывает model.generate_content_async с таймаутом, повторами, хеджированием
+    и автоматом защиты. estimated_tokens — оценка длины промпта для ограничителя квот.
+    Выбрасывает ModelCallError (временный сбой) или ModelRequestError (запрос отвергнут).
+    """
+    _count(stage, 'calls')
+    breaker = _breaker(model_name)
+    hedged = stage in config.GEMINI_HEDGE_STAGES
+    last_error = None
+
+    for attempt in range(config.GEMINI_MAX_RETRIES + 1):
+        with _lock:
+            allowed = breaker.allow()
+            # allow() выставляет trial_in_flight только для пропущенного им пробного вызова
+            is_trial = allowed and breaker.trial_in_flight
+        if not allowed:
+            _count(stage, 'breaker_rejections', 'failed')
+            raise ModelCallError(f"модель {model_name} временно отключена после серии ошибок")
+
+        try:
+            if hedged:
+                response = await _hedged_attempt(model, model_name, stage, prompt, generation_config, estimated_tokens)
+            else:
+                response = await _attempt(model, model_name, stage, prompt, generation_config, estimated_tokens)
+        except asyncio.CancelledError:
+            if is_trial:
+                with _lock:
+                    breaker.cancel_trial()
+            raise
+        except Exception as e:
+            last_error = e
+            if not _is_retryable(e):
+                # Модель ответила ошибкой запроса (например, 400): сервис жив, повторять бессмысленно
+                with _lock:
+                    breaker.record_success()
+                _count(stage, 'failed')
+                raise ModelRequestError(f"{type(e).__name__}: {e}") from e
+            with _lock:
+                breaker.record_failure()
+            if attempt == config.GEMINI_MAX_RETRIES:
+                break
+            delay = _backoff_delay(attempt)
+            print(f"    🔁 {stage}: {type(e).__name__} от {model_name}. Повтор через {delay:.1f} с...")
+            _count(stage, 'retries')
+            await asyncio.sleep(delay)
+            continue
+
+        with _lock:
+            breaker.record_success()
+        _count(stage, 'succeeded')
+        return response
+
+    _count(stage, 'failed')
+    raise ModelCallError(f"{type(last_error).__name__}: {last_error}") from last_error
+
+
+def get_stats():
+    """Возвращает копию метрик по этапам."""
+    with _lock:
+        return {stage: dict(values) for stage, values in _metrics.items()}
+
+
+def print_stats():
+    """Печатает сводку попыток, повторов, хеджирования и ошибок по этапам."""
+    stats = get_stats()
+    if not stats:
+        return
+    print("\n--- 🛡️ Вызовы Gemini за запуск ---")
+    for stage, values in stats.items():
+        successful_attempts = values['attempts'] - values['cancelled'] - values['timeouts'] - values['rate_limited'] - values['server_errors'] - values['other_errors']
+        average = values['latency_total'] / successful_attempts if successful_attempts > 0 else 0.0
+        print(
+            f"   {stage}: вызовов {values['calls']} (успешно {values['succeeded']}, неудачно {values['failed']}), "
+            f"попыток {values['attempts']}, повторов {values['retries']}, дублей {values['hedges']} "
+            f"(выиграли {values['hedge_wins']}), таймаутов {values['timeouts']}, 429: {values['rate_limited']}, "
+            f"5xx: {values['server_errors']}, прочих ошибок {values['other_errors']}, "
+            f"отказов автомата защиты {values['breaker_rejections']}, средняя задержка {average:.1f} с"
+        )
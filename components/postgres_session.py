@@ -0,0 +1,135 @@
+# components/postgres_session.py
+
+"""
+Сессия Telethon, хранящая свое состояние в таблицах Neon.
+
+StringSession сохраняет только ключ авторизации и адрес дата-центра, поэтому после каждого
+перезапуска Telethon заново разрешает сущности и не может догнать пропущенные обновления.
+PostgresSession хранит то же, что и SQLiteSession (ключ авторизации, сущности, хэши
+отправленных файлов и состояние обновлений pts/qts), но в Postgres. Изменения копятся в памяти
+и записываются пачкой в save(), которую Telethon вызывает при подключении и отключении.
+"""
+
+from telethon.crypto import AuthKey
+from telethon.sessions import MemorySession, StringSession
+from telethon.sessions.memory import _SentFileType
+from telethon.tl import types
+from . import database_manager as db
+
+
+class PostgresSession(MemorySession):
+    def __init__(self, session_name):
+        super().__init__()
+        self.session_name = session_name
+
+        # Изменения с момента последнего save()
+        self._auth_dirty = False
+        self._dirty_entities = {}       # id -> (id, hash, username, phone, name)
+        self._dirty_files = {}          # (md5_digest, file_size, type) -> (id, hash)
+        self._dirty_update_states = {}  # entity_id -> types.updates.State
+
+        self._load()
+
+    def _load(self):
+        stored = db.load_telethon_session(self.session_name)
+        if not stored:
+            return
+
+        auth = stored['auth']
+        if auth:
+            self._dc_id = auth['dc_id'] or 0
+            self._server_address = auth['server_address']
+            self._port = auth['port']
+            self._takeout_id = auth['takeout_id']
+            if auth['auth_key']:
+                self._auth_key = AuthKey(data=bytes(auth['auth_key']))
+
+        self._entities = set(stored['entities'])
+        for md5_digest, file_size, file_type, file_id, file_hash in stored['files']:
+            self._files[(bytes(md5_digest), file_size, _SentFileType(file_type))] = (file_id, file_hash)
+        for entity_id, pts, qts, date, seq in stored['update_states']:
+            self._update_states[entity_id] = types.updates.State(pts, qts, date, seq, unread_count=0)
+
+    # --- Авторизация и дата-центр ---
+
+    def set_dc(self, dc_id, server_address, port):
+        super().set_dc(dc_id, server_address, port)
+        self._auth_dirty = True
+
+    @MemorySession.auth_key.setter
+    def auth_key(self, value):
+        if value is not self._auth_key:
+            self._auth_dirty = True
+        self._auth_key = value
+
+    @MemorySession.takeout_id.setter
+    def takeout_id(self, value):
+        self._takeout_id = value
+        self._auth_dirty = True
+
+    def import_string_session(self, session_string):
+        """Переносит ключ авторизации и дата-центр из старой StringSession и сразу сохраняет их."""
+        legacy = StringSession(session_string)
+        self.set_dc(legacy.dc_id, legacy.server_address, legacy.port)
+        self.auth_key = legacy.auth_key
+        # Состояние обновлений от другой авторизации не имеет смысла
+        self._update_states.clear()
+        self._dirty_update_states.clear()
+        self.save()
+
+    # --- Сущности, файлы и состояние обновлений ---
+
+    def process_entities(self, tlo):
+        for row in self._entities_to_rows(tlo):
+            if row not in self._entities:
+                self._entities.add(row)
+                self._dirty_entities[row[0]] = row
+
+    def cache_file(self, md5_digest, file_size, instance):
+        super().cache_file(md5_digest, file_size, instance)
+        key = (md5_digest, file_size, _SentFileType.from_type(type(instance)))
+        self._dirty_files[key] = self._files[key]
+
+    def set_update_state(self, entity_id, state):
+        super().set_update_state(entity_id, state)
+        self._dirty_update_states[entity_id] = state
+
+    # --- Сохранение ---
+
+    def save(self):
+        if not (self._auth_dirty or self._dirty_entities or self._dirty_files or self._dirty_update_states):
+            return
+
+        auth = None
+        if self._auth_dirty:
+            auth = {
+                'dc_id': self._dc_id,
+                'server_address': self._server_address,
+                'port': self._port,
+                'auth_key': self._auth_key.key if self._auth_key else None,
+                'takeout_id': self._takeout_id,
+            }
+        files = [
+            (md5_digest, file_size, file_type.value, file_id, file_hash)
+            for (md5_digest, file_size, file_type), (file_id, file_hash) in self._dirty_files.items()
+        ]
+        update_states = [
+            (entity_id, state.pts, state.qts, state.date, state.seq)
+            for entity_id, state in self._dirty_update_states.items()
+        ]
+
+        if db.save_telethon_session(self.session_name, auth, list(self._dirty_entities.values()), files, update_states):
+            self._auth_dirty = False
+            self._dirty_entities.clear()
+            self._dirty_files.clear()
+            self._dirty_update_states.clear()
+
+    def close(self):
+        self.save()
+
+    def delete(self):
+        db.delete_telethon_session(self.session_name)
+        self._auth_dirty = False
+        self._dirty_entities.clear()
+        self._dirty_files.clear()
+        self._dirty_update_states.clear()
@@ -0,0 +1,91 @@
+# components/prefilter.py
+
+"""
+Дешевый локальный фильтр перед Сортировщиком и Классификатором лидов.
+
+Раньше в Gemini Flash уходило каждое текстовое сообщение, включая "спасибо", подписи
+к стикерам и ответы из одного слова. is_candidate() отбрасывает сообщения, которые не могут
+быть ни лидом, ни поводом для ответа: без букв, из списка коротких реплик или слишком
+короткие (если в них нет вопроса).
+
+Порог проверяется по полноте: доля сообщений из ai_suggestions_log (на них агент уже
+отвечал или писал лидам), которые фильтр пропускает, должна быть не ниже
+PREFILTER_RECALL_TARGET. Проверка — benchmarks/prefilter_recall.py.
+"""
+
+import re
+import threading
+from . import config
+
+_NON_WORD_RE = re.compile(r'[\W_]+')
+
+# Реплики, на которые не отвечают и которые не бывают лидами (после нормализации)
+_STOP_PHRASES = {
+    'спасибо', 'спасибо большое', 'большое спасибо', 'спс', 'благодарю', 'пасиб',
+    'ок', 'окей', 'ok', 'okay', 'хорошо', 'понял', 'поняла', 'понятно', 'ясно',
+    'да', 'нет', 'ага', 'угу', 'неа', 'конечно', 'согласен', 'согласна', 'точно',
+    'привет', 'здравствуйте', 'добрый день', 'доброе утро', 'добрый вечер', 'всем привет',
+    'пока', 'до свидания', 'спокойной ночи',
+    'ахах', 'ахаха', 'хах', 'хаха', 'хахаха', 'лол', 'ору', 'жиза', 'класс', 'круто', 'супер',
+    'плюс', 'плюсую', 'поддерживаю', 'тоже', 'я тоже', 'и я', 'thanks', 'thank you', 'lol',
+}
+
+_lock = threading.Lock()
+_stats = {'checked': 0, 'dropped': 0, 'dropped_chars': 0}
+
+
+def normalize(text):
+    return ' '.join(_NON_WORD_RE.sub(' ', text.casefold().replace('ё', 'е')).split())
+
+
+def _passes(text):
+    if not text or text.isspace():
+        return False
+    letters = sum(char.isalpha() for char in text)
+    if not letters:
+        return False
+    normalized = normalize(text)
+    if normalized in _STOP_PHRASES:
+        return False
+    if letters < config.PREFILTER_MIN_LETTERS and '?' not in text:
+        return False
+    return True
+
+
+def is_candidate(text):
+    """True, если сообщение стоит показывать Gemini. Учитывает отброшенные сообщения в статистике."""
+    passed = not config.PREFILTER_ENABLED or _passes(text)
+    with _lock:
+        _stats['checked'] += 1
+        if not passed:
+            _stats['dropped'] += 1
+            _stats['dropped_chars'] += len(text or '')
+    return passed
+
+
+def evaluate_recall(texts):
+    """
+    Полнота фильтра на заведомо полезных сообщениях (без учета статистики запуска).
+    Возвращает (доля пропущенных фильтром, [отброшенные тексты]).
+    """
+    texts = [text for text in texts if text]
+    if not texts:
+        return 1.0, []
+    rejected = [text for text in texts if not _passes(text)]
+    return 1 - len(rejected) / len(texts), rejected
+
+
+def get_stats():
+    with _lock:
+        return dict(_stats)
+
+
+def print_stats():
+    """Печатает, сколько сообщений и символов не ушло в Gemini Flash за запуск."""
+    stats = get_stats()
+    if not stats['checked']:
+        return
+    print(
+        f"\n--- 🧹 Локальный фильтр: отброшено {stats['dropped']} из {stats['checked']} сообщений "
+        f"({stats['dropped_chars']} символов не отправлено в Gemini Flash) ---"
+    )
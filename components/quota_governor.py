@@ -0,0 +1,133 @@
+# components/quota_governor.py
+
+"""
+Клиентский ограничитель квот Gemini: запросы в минуту (RPM) и токены в минуту (TPM).
+
+Когда чаты и лиды обрабатываются параллельно, квоты Gemini легко превысить, и это
+проявляется как случайные ошибки 429. Здесь на каждую модель (GEMINI_FLASH_MODEL_NAME,
+GEMINI_PRO_MODEL_NAME) заведены два "ведра с токенами", пополняющиеся равномерно
+до минутной квоты. Вызов допускается, когда в ведрах есть один запрос и оценка длины
+промпта; после ответа расход уточняется по usage_metadata (промпт и ответ).
+
+Ожидающие обслуживаются строго по очереди (FIFO): первый в очереди ждет пополнения ведер,
+остальные — за ним, поэтому большой промпт не "голодает" за потоком маленьких.
+Глубину очереди можно узнать через get_queue_depth(), сводку — через print_stats().
+"""
+
+import asyncio
+import time
+from . import config
+
+_QUOTAS = {
+    config.GEMINI_FLASH_MODEL_NAME: (config.GEMINI_FLASH_RPM, config.GEMINI_FLASH_TPM),
+    config.GEMINI_PRO_MODEL_NAME: (config.GEMINI_PRO_RPM, config.GEMINI_PRO_TPM),
+}
+
+
+class _Governor:
+    def __init__(self, rpm, tpm):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.requests = float(rpm)
+        self.tokens = float(tpm)
+        self.updated_at = time.monotonic()
+        self.lock = asyncio.Lock()  # asyncio.Lock будит ожидающих в порядке очереди
+        self.queue_depth = 0
+        self.stats = {'admitted': 0, 'waited': 0, 'wait_seconds': 0.0, 'max_queue_depth': 0}
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.updated_at
+        self.updated_at = now
+        if self.rpm:
+            self.requests = min(self.rpm, self.requests + elapsed * self.rpm / 60)
+        if self.tpm:
+            self.tokens = min(self.tpm, self.tokens + elapsed * self.tpm / 60)
+
+    def _wait_time(self, tokens):
+        waits = [0.0]
+        if self.rpm and self.requests < 1:
+            waits.append((1 - self.requests) * 60 / self.rpm)
+        if self.tpm and self.tokens < tokens:
+            waits.append((tokens - self.tokens) * 60 / self.tpm)
+        return max(waits)
+
+    async def acquire(self, tokens):
+        # Промпт больше минутной квоты иначе не прошел бы никогда
+        tokens = min(tokens, self.tpm) if self.tpm else 0
+        started = time.monotonic()
+        self.queue_depth += 1
+        self.stats['max_queue_depth'] = max(self.stats['max_queue_depth'], self.queue_depth)
+        try:
+            async with self.lock:
+                while True:
+                    self._refill()
+                    wait = self._wait_time(tokens)
+                    if wait <= 0:
+                        break
+                    await asyncio.sleep(wait)
+                if self.rpm:
+                    self.requests -= 1
+                if self.tpm:
+                    self.tokens -= tokens
+        finally:
+            self.queue_depth -= 1
+
+        waited = time.monotonic() - started
+        self.stats['admitted'] += 1
+        if waited >= 0.05:
+            self.stats['waited'] += 1
+            self.stats['wait_seconds'] += waited
+
+    def settle(self, estimated_tokens, actual_tokens):
+        """Возвращает в ведро или дописывает разницу между оценкой и фактическим расходом."""
+        if self.tpm and actual_tokens:
+            self._refill()
+            self.tokens = min(self.tpm, self.tokens + estimated_tokens - actual_tokens)
+
+
+_governors = {}
+
+
+def _governor(model_name):
+    rpm, tpm = _QUOTAS.get(model_name, (0, 0))
+    if not rpm and not tpm:
+        return None
+    if model_name not in _governors:
+        _governors[model_name] = _Governor(rpm, tpm)
+    return _governors[model_name]
+
+
+async def acquire(model_name, estimated_tokens):
+    """Ждет, пока квота модели позволит отправить запрос с промптом примерно в estimated_tokens токенов."""
+    governor = _governor(model_name)
+    if governor is not None:
+        await governor.acquire(estimated_tokens or 0)
+
+
+def settle(model_name, estimated_tokens, response):
+    """Уточняет расход токенов по usage_metadata ответа (промпт и ответ вместе)."""
+    governor = _governor(model_name)
+    if governor is None:
+        return
+    actual_tokens = getattr(getattr(response, 'usage_metadata', None), 'total_token_count', None)
+    governor.settle(estimated_tokens or 0, actual_tokens)
+
+
+def get_queue_depth(model_name):
+    """Сколько вызовов модели сейчас ждут своей очереди по квоте."""
+    governor = _governors.get(model_name)
+    return governor.queue_depth if governor else 0
+
+
+def print_stats():
+    """Печатает, сколько вызовов пришлось придержать по квоте и как долго."""
+    if not _governors:
+        return
+    print("\n--- 🚦 Квоты Gemini за запуск ---")
+    for model_name, governor in _governors.items():
+        stats = governor.stats
+        print(
+            f"   {model_name}: допущено {stats['admitted']}, ждали квоту {stats['waited']} "
+            f"({stats['wait_seconds']:.1f} с всего), максимальная очередь {stats['max_queue_depth']}"
+        )
@@ -0,0 +1,67 @@
+# components/response_cache.py
+
+"""
+Кэш ответов Gemini с адресацией по содержимому.
+
+Если запуск упал или был перезапущен, сортировщик, классификатор лидов и генератор сообщений
+лидам заново отправляют те же промпты и повторно платят за те же ответы. Здесь разобранный
+JSON-ответ сохраняется в Neon под ключом sha256(имя модели + полный текст промпта), поэтому
+идентичный промпт обслуживается из базы. Записи живут AI_CACHE_TTL_HOURS, общее число записей
+ограничено AI_CACHE_MAX_ENTRIES (вытесняются давно не использованные). AI_CACHE_BYPASS=true
+отключает кэш, например на время экспериментов с промптами.
+"""
+
+import hashlib
+import threading
+from . import config
+from . import async_database_manager as adb
+
+_lock = threading.Lock()
+_counters = {'hits': 0, 'misses': 0, 'stores': 0, 'bypassed': 0}
+
+
+def _count(name):
+    with _lock:
+        _counters[name] += 1
+
+
+def make_key(model_name, prompt):
+    """Ключ кэша: sha256 от имени модели и полностью собранного промпта."""
+    return hashlib.sha256(f"{model_name}\0{prompt}".encode('utf-8')).hexdigest()
+
+
+async def get(model_name, prompt):
+    """Возвращает сохраненный разобранный ответ или None, если его нет (или кэш отключен)."""
+    if config.AI_CACHE_BYPASS:
+        _count('bypassed')
+        return None
+    cached = await adb.get_cached_ai_response(make_key(model_name, prompt), config.AI_CACHE_TTL_HOURS)
+    _count('hits' if cached is not None else 'misses')
+    return cached
+
+
+async def put(model_name, prompt, response):
+    """Сохраняет разобранный ответ модели для этого промпта."""
+    if config.AI_CACHE_BYPASS or response is None:
+        return
+    await adb.save_cached_ai_response(
+        make_key(model_name, prompt), model_name, response,
+        config.AI_CACHE_TTL_HOURS, config.AI_CACHE_MAX_ENTRIES
+    )
+    _count('stores')
+
+
+def get_stats():
+    with _lock:
+        return dict(_counters)
+
+
+def print_stats():
+    """Печатает счетчики попаданий и промахов кэша за запуск."""
+    stats = get_stats()
+    if not any(stats.values()):
+        return
+    print(
+        f"\n--- 🗄️ Кэш ответов Gemini: попаданий {stats['hits']}, промахов {stats['misses']}, "
+        f"сохранено {stats['stores']}, в обход кэша {stats['bypassed']} ---"
+    )
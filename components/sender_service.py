@@ -1,84 +1,195 @@
 # components/sender_service.py
 
-from . import database_manager as db
+import asyncio
+import os
+import socket
+from telethon import errors
+from . import async_database_manager as adb
+from . import config
+
+# Идентификатор отправителя в claimed_by: по нему видно, какой процесс держит аренду
+_WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+# Отправленные, но не зафиксированные в базе действия [(action_id, user_id, chat_id)]: повторяются перед
+# следующим захватом, иначе по истечении аренды они были бы отправлены повторно
+_unrecorded_deliveries = []
+
+
+async def _record_unrecorded():
+    """Повторяет фиксацию отправленных действий, которую не удалось записать раньше. Возвращает True, если долгов нет."""
+    if not _unrecorded_deliveries:
+        return True
+    batch = _unrecorded_deliveries[:]
+    if not await adb.record_action_deliveries(batch):
+        return False
+    del _unrecorded_deliveries[:len(batch)]
+    print(f"      ✅ Повторно зафиксировано выполнение действий: {', '.join(str(action_id) for action_id, _, _ in batch)}.")
+    return True
+
+
+def _prepare(action):
+    """
+    Разбирает запись pending_actions.
+    Возвращает (получатель, текст, ID сообщения для ответа, ID пользователя, ID чата публичного ответа).
+    """
+    action_type = action.get('action_type', 'reply') # По умолчанию 'reply' для совместимости
+
+    # В зависимости от типа действия, определяем получателя и текст
+    if action_type == 'lead_outreach':
+        # Это сообщение в личку лиду; в личных сообщениях не отвечаем на что-то конкретное
+        target_user_id = int(action['lead_user_id']) if action.get('lead_user_id') else None
+        return target_user_id, action.get('pitch_text'), None, target_user_id, None
+
+    # action_type == 'reply' или 'keyword_alert': ответ в публичном чате
+    chat_id = action.get('target_chat_id')
+    reply_to_id = action.get('reply_to_message_id')
+    entity_to_send = int(chat_id) if chat_id else None
+    # Время последнего *публичного ответа* обновляется, чтобы соблюдать часовой лимит
+    post_chat_id = entity_to_send if action_type == 'reply' else None
+    target_user_id = int(action['target_user_id']) if action.get('target_user_id') else None
+    return entity_to_send, action.get('message_text'), reply_to_id, target_user_id, post_chat_id
+
 
 async def send_pending_messages(client):
     """
-    Проверяет очередь в Supabase и отправляет все одобренные, неопубликованные сообщения.
-    
-    ИЗМЕНЕНИЕ: После успешной отправки любого сообщения, записывает контакт с пользователем,
-    чтобы избежать повторных сообщений в тот же день.
+    Захватывает в Neon одобренные, неопубликованные сообщения страницами по SENDER_PAGE_SIZE и отправляет их.
+
+    Захват идет через claim_pending_actions (FOR UPDATE SKIP LOCKED с арендой), поэтому несколько
+    отправителей могут разбирать очередь одновременно, не отправляя одно действие дважды.
+    Разные чаты и пользователи обслуживаются параллельно (до SENDER_CONCURRENCY одновременно),
+    а сообщения одному получателю уходят строго по порядку. FloodWaitError приостанавливает
+    только того получателя, для которого он пришел. После отправки выполнение действия,
+    контакт с пользователем и время последнего ответа в чате фиксируются одной транзакцией
+    (несколько отправок, завершившихся одновременно, фиксируются вместе).
+    Неотправленные действия в конце возвращаются в очередь, а после FloodWait — с запретом
+    захвата до окончания ожидания, чтобы следующий запуск не нарушил его.
     """
     print("\n--- 📬 Проверка очереди на отправку ---")
-    
-    pending_actions = db.get_pending_actions()  
-    
-    if not pending_actions:
-        print("✅ Очередь на отправку пуста.")
-        print("-" * 50)
-        return
 
-    print(f"📥 Найдено {len(pending_actions)} действий для выполнения.")
-    
+    semaphore = asyncio.Semaphore(config.SENDER_CONCURRENCY)
+    pending_deliveries = []
+    commit_lock = asyncio.Lock()
+    # Получатели, чья очередь остановлена ошибкой: {получатель: через сколько секунд можно повторить}.
+    # Их следующие сообщения ждут следующего запуска
+    blocked = {}
+    # Захваченные, но не отправленные действия — освобождаются в конце: {action_id: задержка повтора}
+    unsent = {}
+
+    async def commit(delivery):
+        # Групповая фиксация: кто первым получил блокировку, записывает все накопившиеся отправки
+        pending_deliveries.append(delivery)
+        async with commit_lock:
+            if not pending_deliveries:
+                return
+            batch = pending_deliveries[:]
+            pending_deliveries.clear()
+            if await adb.record_action_deliveries(batch):
+                print(f"      ✅ Зафиксировано выполнение действий: {', '.join(str(action_id) for action_id, _, _ in batch)}.")
+            else:
+                _unrecorded_deliveries.extend(batch)
+
+    def stop_destination(entity_to_send, remaining, retry_after_seconds=0):
+        blocked[entity_to_send] = retry_after_seconds
+        for action_id, _ in remaining:
+            unsent[action_id] = retry_after_seconds
+
+    async def run_destination(entity_to_send, actions):
+        sent = 0
+        for index, (action_id, (_, message_text, reply_to_id, target_user_id, post_chat_id)) in enumerate(actions):
+            for attempt in range(config.FLOOD_WAIT_MAX_RETRIES + 1):
+                # Ожидание FloodWait может пережить аренду страницы, поэтому перед каждой отправкой
+                # аренда оставшихся сообщений получателя продлевается
+                held = set(await adb.extend_action_leases(
+                    [queued_id for queued_id, _ in actions[index:]], _WORKER_ID, config.SENDER_LEASE_SECONDS
+                ))
+                if action_id not in held:
+                    print(f"      ⚠️ Аренда action_id {action_id} потеряна. Сообщения получателю {entity_to_send} не отправляются.")
+                    stop_destination(entity_to_send, [queued for queued in actions[index:] if queued[0] in held])
+                    return sent
+                async with semaphore:
+                    try:
+                        print(f"  -> Отправка action_id {action_id} получателю {entity_to_send}...")
+                        # Используем клиент Telethon для отправки
+                        await client.send_message(
+                            entity=entity_to_send,
+                            message=message_text,
+                            reply_to=int(reply_to_id) if reply_to_id else None
+                        )
+                        break
+                    except errors.FloodWaitError as e:
+                        wait_seconds = e.seconds
+                    except Exception as e:
+                        # Действие вернется в очередь для повторной попытки в следующий раз,
+                        # а следующие сообщения этому получателю не отправляем, чтобы не нарушить порядок
+                        print(f"      ❌ Критическая ошибка при отправке action_id: {action_id}. Ошибка: {e}")
+                        stop_destination(entity_to_send, actions[index:])
+                        return sent
+
+                if wait_seconds > config.FLOOD_WAIT_MAX_SECONDS or attempt == config.FLOOD_WAIT_MAX_RETRIES:
+                    print(f"      ❌ FloodWait {wait_seconds} с. для получателя {entity_to_send}. Остальные его сообщения — не раньше, чем через {wait_seconds} с.")
+                    # Повтор до конца FloodWait только увеличил бы штраф Telegram
+                    stop_destination(entity_to_send, actions[index:], wait_seconds)
+                    return sent
+                print(f"      ⏳ FloodWait {wait_seconds} с. для получателя {entity_to_send}. Остальные получатели продолжают.")
+                await asyncio.sleep(wait_seconds)
+
+            sent += 1
+            await commit((action_id, target_user_id, post_chat_id))
+        return sent
+
+    claimed_count = 0
     successful_sends = 0
-    # Проходим по каждому действию
-    for action in pending_actions:
-        action_id = action.get('id')
-        try:
-            # Извлекаем необходимые данные из записи
-            action_type = action.get('action_type', 'reply') # По умолчанию 'reply' для совместимости
-            
-            # В зависимости от типа действия, определяем получателя и текст
-            if action_type == 'lead_outreach':
-                # Это сообщение в личку лиду
-                target_user_id = action.get('lead_user_id')
-                message_text = action.get('pitch_text')
-                # Для личных сообщений entity - это ID пользователя
-                entity_to_send = int(target_user_id) if target_user_id else None
-                reply_to_id = None # В личных сообщениях не отвечаем на что-то конкретное
-                print(f"  -> Подготовка личного сообщения (lead_outreach) для пользователя {target_user_id}...")
-            else: # action_type == 'reply' или 'keyword_alert'
-                # Это ответ в публичном чате
-                target_user_id = action.get('target_user_id')
-                chat_id = action.get('target_chat_id')
-                message_text = action.get('message_text')
-                reply_to_id = action.get('reply_to_message_id')
-                entity_to_send = int(chat_id) if chat_id else None
-                print(f"  -> Подготовка ответа (reply) в чат {chat_id}...")
+    while True:
+        # Пока отправленное не зафиксировано, новые действия не захватываем: база недоступна,
+        # а незафиксированные действия иначе ушли бы повторно
+        if not await _record_unrecorded():
+            print(f"      ❌ Не удалось зафиксировать {len(_unrecorded_deliveries)} отправленных действий. Отправка приостановлена до следующего запуска.")
+            break
+        # Захваченные этим отправителем действия под арендой, поэтому повторно они не попадутся
+        pending_actions = await adb.claim_pending_actions(
+            _WORKER_ID, config.SENDER_PAGE_SIZE, config.SENDER_LEASE_SECONDS
+        )
+        if not pending_actions:
+            break
+        claimed_count += len(pending_actions)
+        print(f"📥 Захвачено {len(pending_actions)} действий для выполнения.")
 
+        # Очереди по получателям в порядке записи действий
+        queues = {}
+        for action in pending_actions:
+            action_id = action.get('id')
+            try:
+                prepared = _prepare(action)
+            except (TypeError, ValueError) as e:
+                print(f"      ❌ Ошибка данных для action_id: {action_id}. Возможно, неверный ID. Ошибка: {e}")
+                unsent[action_id] = 0
+                continue
+            entity_to_send, message_text = prepared[0], prepared[1]
             # Проверяем, все ли данные на месте перед отправкой
             if not all([entity_to_send, message_text]):
-                 print(f"      ❌ Пропуск action_id: {action_id}. Недостаточно данных (ID получателя или текст).")
-                 continue
-            
-            # Используем клиент Telethon для отправки
-            await client.send_message(
-                entity=entity_to_send,
-                message=message_text,
-                reply_to=int(reply_to_id) if reply_to_id else None
-            )
-            
-            # Если отправка успешна, помечаем действие как выполненное
-            db.mark_action_as_completed(action_id)
-            print(f"      ✅ Успешно отправлено. Запись {action_id} помечена как выполненная.")
-            successful_sends += 1
-
-            # --- ОБНОВЛЕННЫЙ БЛОК ЛОГИРОВАНИЯ ---
-            # 1. Записываем, что мы связались с этим пользователем сегодня
-            if target_user_id:
-                db.record_user_contact(int(target_user_id))
-
-            # 2. Обновляем метку времени последнего *публичного ответа* в чате, чтобы соблюдать часовой лимит
-            if action_type == 'reply':
-                db.update_last_post_time(int(action.get('target_chat_id')))
-            # --- КОНЕЦ ОБНОВЛЕННОГО БЛОКА ---
-
-        except TypeError as e:
-            print(f"      ❌ Ошибка данных для action_id: {action_id}. Возможно, неверный ID. Ошибка: {e}")
-            # Возможно, стоит пометить это действие как ошибочное в БД
-        except Exception as e:
-            print(f"      ❌ Критическая ошибка при отправке action_id: {action_id}. Ошибка: {e}")
-            # Оставляем is_completed = false для повторной попытки в следующий раз
-            
-    print(f"\n--- ✅ Отправка завершена. Успешно: {successful_sends} из {len(pending_actions)} ---")
-    print("-" * 50)
\ No newline at end of file
+                print(f"      ❌ Пропуск action_id: {action_id}. Недостаточно данных (ID получателя или текст).")
+                unsent[action_id] = 0
+                continue
+            if entity_to_send in blocked:
+                unsent[action_id] = blocked[entity_to_send]
+                continue
+            queues.setdefault(entity_to_send, []).append((action_id, prepared))
+
+        results = await asyncio.gather(*(
+            run_destination(entity_to_send, actions) for entity_to_send, actions in queues.items()
+        ))
+        successful_sends += sum(results)
+
+    if not claimed_count:
+        print("✅ Очередь на отправку пуста.")
+        print("-" * 50)
+        return
+
+    # Освобождаем пачками с одинаковой задержкой повтора
+    by_delay = {}
+    for action_id, retry_after_seconds in unsent.items():
+        by_delay.setdefault(retry_after_seconds, []).append(action_id)
+    for retry_after_seconds, action_ids in by_delay.items():
+        await adb.release_claimed_actions(action_ids, _WORKER_ID, retry_after_seconds)
+
+    print(f"\n--- ✅ Отправка завершена. Успешно: {successful_sends} из {claimed_count} ---")
+    print("-" * 50)
@@ -9,7 +9,7 @@ from telethon.sessions import StringSession
 
 # Импортируем общие компоненты
 from . import config
-from . import database_manager as db
+from . import async_database_manager as adb
 
 # Загружаем переменные окружения для доступа к номеру телефона
 load_dotenv()
@@ -74,7 +74,7 @@ async def create_new_session():
         print("--- ✅ Сессия успешно сгенерирована. ---")
         
         # Сохраняем валидную строку в базу данных для дальнейшего использования
-        db.save_session_string(session_string)
+        await adb.save_session_string(session_string)
         print("--- ✅ Сессия успешно сохранена в базу данных. ---")
 
     except Exception as e:
@@ -0,0 +1,172 @@
+# components/structured_output.py
+
+"""
+Структурированные ответы Gemini: схемы JSON, устойчивый разбор и типизированные решения.
+
+Раньше каждый этап срезал ```json и вызывал json.loads: если модель дописывала текст вокруг
+JSON или обрывала массив, терялся весь ответ, и пачка заново оплачивалась в следующем запуске.
+Теперь:
+  - запрос просит у модели JSON по схеме (response_mime_type + response_schema);
+  - parse_json_array разбирает массив поэлементно и при обрыве или мусоре возвращает
+    все элементы, прочитанные до места поломки;
+  - решения Сортировщика и Классификатора лидов приходят в виде RoutingDecision/LeadDecision,
+    а некорректные элементы отбрасываются по одному, не ломая остальные.
+"""
+
+import json
+from dataclasses import dataclass, asdict
+from typing import Optional
+
+_decoder = json.JSONDecoder()
+
+# --- Схемы ответов (формат response_schema библиотеки google-generativeai) ---
+
+ROUTER_SCHEMA = {
+    'type': 'ARRAY',
+    'items': {
+        'type': 'OBJECT',
+        'properties': {
+            'message_id': {'type': 'INTEGER'},
+            'decision': {'type': 'STRING'},
+            'persona': {'type': 'STRING', 'nullable': True},
+        },
+        'required': ['message_id', 'decision'],
+    },
+}
+
+LEAD_SCHEMA = {
+    'type': 'ARRAY',
+    'items': {
+        'type': 'OBJECT',
+        'properties': {
+            'message_id': {'type': 'INTEGER'},
+            'lead_type': {'type': 'STRING'},
+        },
+        'required': ['message_id', 'lead_type'],
+    },
+}
+
+OUTREACH_SCHEMA = {
+    'type': 'OBJECT',
+    'properties': {
+        'pitch_text': {'type': 'STRING'},
+    },
+    'required': ['pitch_text'],
+}
+
+
+def generation_config(schema=None):
+    """generation_config для generate_content_async: только JSON и, если задана, схема."""
+    config = {'response_mime_type': 'application/json'}
+    if schema is not None:
+        config['response_schema'] = schema
+    return config
+
+
+# --- Устойчивый разбор ---
+
+def _strip_fences(text):
+    return text.strip().removeprefix('```json').removeprefix('```').removesuffix('```').strip()
+
+
+def _skip_separators(text, index):
+    while index < len(text) and (text[index].isspace() or text[index] == ','):
+        index += 1
+    return index
+
+
+def parse_json_array(text):
+    """
+    Разбирает JSON-массив поэлементно.
+    Возвращает (элементы, полный ли ответ): при обрыве или мусоре внутри массива
+    возвращаются элементы, прочитанные до места поломки, и False.
+    Одиночный объект вместо массива считается массивом из одного элемента.
+    """
+    text = _strip_fences(text or '')
+    start = next((i for i, char in enumerate(text) if char in '[{'), None)
+    if start is None:
+        return [], False
+
+    if text[start] == '{':
+        try:
+            value, _ = _decoder.raw_decode(text, start)
+            return [value], True
+        except json.JSONDecodeError:
+            return [], False
+
+    items = []
+    index = start + 1
+    while True:
+        index = _skip_separators(text, index)
+        if index >= len(text):
+            return items, False
+        if text[index] == ']':
+            return items, True
+        try:
+            value, index = _decoder.raw_decode(text, index)
+        except json.JSONDecodeError:
+            return items, False
+        items.append(value)
+
+
+def parse_json_object(text):
+    """Разбирает JSON-объект (или первый объект массива). Возвращает dict или None."""
+    items, _ = parse_json_array(text)
+    return next((item for item in items if isinstance(item, dict)), None)
+
+
+# --- Типизированные решения ---
+
+def _as_message_id(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+@dataclass(frozen=True)
+class RoutingDecision:
+    message_id: int
+    decision: str
+    persona: Optional[str] = None
+
+    @classmethod
+    def from_dict(cls, item):
+        """Строит решение из элемента ответа или возвращает None, если элемент некорректен."""
+        if not isinstance(item, dict):
+            return None
+        message_id = _as_message_id(item.get('message_id'))
+        decision = item.get('decision')
+        if message_id is None or not isinstance(decision, str):
+            return None
+        persona = item.get('persona')
+        return cls(message_id, decision, persona if isinstance(persona, str) and persona else None)
+
+    def to_dict(self):
+        return asdict(self)
+
+
+@dataclass(frozen=True)
+class LeadDecision:
+    message_id: int
+    lead_type: str
+
+    @classmethod
+    def from_dict(cls, item):
+        """Строит решение из элемента ответа или возвращает None, если элемент некорректен."""
+        if not isinstance(item, dict):
+            return None
+        message_id = _as_message_id(item.get('message_id'))
+        lead_type = item.get('lead_type')
+        if message_id is None or not isinstance(lead_type, str):
+            return None
+        return cls(message_id, lead_type)
+
+    def to_dict(self):
+        return asdict(self)
+
+
+def to_decisions(decision_class, items):
+    """Превращает элементы ответа в решения, пропуская некорректные."""
+    decisions = [decision_class.from_dict(item) for item in items]
+    return [decision for decision in decisions if decision is not None]
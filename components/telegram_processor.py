@@ -1,14 +1,75 @@
+import asyncio
+import time
 from datetime import datetime, timezone, timedelta
-from . import database_manager as db
+from telethon import errors
+from . import async_database_manager as adb
 from . import ai_processor
-from . import approval_service
+from . import approval_outbox
+from . import config
+from . import entity_cache
+from . import dedup
+from . import model_client
 
-async def process_chat_for_engagement(client, chat_info, my_id, keyword_triggers):
+# Telethon запрашивает историю страницами по 100 сообщений (максимум для messages.getHistory)
+TELEGRAM_PAGE_SIZE = 100
+
+async def _fetch_new_messages(client, entity, last_id, my_id, today_start_utc):
+    """
+    Загружает из Telegram сегодняшние сообщения новее last_id.
+    Возвращает (сообщения в хронологическом порядке, максимальный ID среди них или last_id).
+    """
+    messages = []
+    newest_message_id = last_id
+
+    # Telegram сам отсекает уже обработанное (min_id), а сообщения идут от новых к старым
+    # страницами по 100 штук. Читаем не больше TELEGRAM_MAX_PAGES_PER_CHAT страниц и
+    # останавливаемся на первом вчерашнем сообщении, поэтому старая история не скачивается.
+    fetch_limit = config.TELEGRAM_MAX_PAGES_PER_CHAT * TELEGRAM_PAGE_SIZE
+    fetched_count = 0
+    reached_yesterday = False
+    async for message in client.iter_messages(entity, min_id=last_id, limit=fetch_limit):
+        fetched_count += 1
+        if message.date < today_start_utc:
+            reached_yesterday = True
+            break
+        if message.sender_id == my_id:
+            continue
+        if message and message.text:
+            messages.append(message)
+            if message.id > newest_message_id:
+                newest_message_id = message.id
+    # Остальной конвейер ожидает сообщения в хронологическом порядке
+    messages.reverse()
+
+    if fetched_count >= fetch_limit and not reached_yesterday:
+        print(f" 	⚠️ Достигнут лимит в {config.TELEGRAM_MAX_PAGES_PER_CHAT} стр. истории. Более ранние сообщения за сегодня пропущены.")
+
+    return messages, newest_message_id
+
+
+def _select_new_messages(messages, last_id, my_id, today_start_utc):
+    """То же, что _fetch_new_messages, но для уже полученных сообщений (например, из событий)."""
+    selected = sorted(
+        (
+            message for message in messages
+            if message.id > last_id and message.date >= today_start_utc
+            and message.sender_id != my_id and message.text
+        ),
+        key=lambda message: message.id
+    )
+    newest_message_id = selected[-1].id if selected else last_id
+    return selected, newest_message_id
+
+
+async def process_chat_for_engagement(client, chat_info, my_id, keyword_matcher, prefetched_messages=None, completed_chats=None):
     """
     ОБНОВЛЕННАЯ ВЕРСИЯ:
     Обрабатывает ОДИН чат для публичного вовлечения ("Агент влияния").
     Добавлена проверка на часовой лимит, ограничение на количество сообщений для анализа
     и проверка на повторный контакт с пользователем в течение дня.
+    Если передан prefetched_messages, новые сообщения берутся из него, а не из Telegram.
+    Если передан completed_chats, в него добавляется ID чата, когда его новые сообщения
+    разобраны до конца (не пропущены по часовому лимиту или из-за ошибки).
     """
     # --- НАСТРОЙКА ЛИМИТА ИСТОРИИ ---
     # 👇 Вот новая настройка. Можете менять это число.
@@ -23,7 +84,11 @@ async def process_chat_for_engagement(client, chat_info, my_id, keyword_triggers
         print(f"\n▶️  Обработка чата (Агент влияния): {original_chat_id} (тип: {chat_type})")
 
         # --- ПРОВЕРКА ЧАСОВОГО ЛИМИТА ---
-        last_post_time = db.get_last_post_time(processing_id)
+        # Состояние обычно уже загружено пачкой вместе со списком чатов (get_target_chats_with_state)
+        if 'last_agent_post_timestamp' in chat_info:
+            last_post_time = chat_info['last_agent_post_timestamp']
+        else:
+            last_post_time = await adb.get_last_post_time(processing_id)
         if last_post_time:
             time_since_last_post = datetime.now(timezone.utc) - last_post_time
             if time_since_last_post < timedelta(hours=1):
@@ -31,41 +96,45 @@ async def process_chat_for_engagement(client, chat_info, my_id, keyword_triggers
                 print("-" * 50)
                 return None
         
-        entity = await client.get_entity(original_chat_id)
+        # access_hash и связанный чат обычно берутся из кэша в target_chats, без запросов к Telegram
+        entity, linked_chat_id, linked_entity = await entity_cache.resolve_chat(client, chat_info)
 
         # Логика для каналов и связанных с ними чатов комментариев
         if chat_type == 'channel':
-            if hasattr(entity, 'linked_chat_id') and entity.linked_chat_id:
-                processing_id = entity.linked_chat_id
-                entity = await client.get_entity(processing_id)
+            if linked_chat_id:
+                processing_id = linked_chat_id
+                entity = linked_entity
                 print(f" 	✅ Найден связанный чат для комментариев: {processing_id}")
             else:
                 print(f" 	⚠️ Для канала {original_chat_id} комментарии отключены. Пропускаем.")
                 return None
 
         # Получение новых сообщений
-        last_id = db.get_last_message_id(processing_id)
+        if processing_id == chat_info.get('state_chat_id') and 'last_message_id' in chat_info:
+            last_id = chat_info['last_message_id']
+        else:
+            # Для связанного чата комментариев состояние хранится под его собственным ID
+            last_id = await adb.get_last_message_id(processing_id)
         today_start_utc = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
         
         print(f" 	ID последнего обработанного сообщения из БД: {last_id}")
-        print(" 	🔄 Получение новых сообщений, отправленных СЕГОДНЯ...")
 
-        messages_to_process = []
-        newest_message_id = last_id
-        
-        async for message in client.iter_messages(entity, offset_date=today_start_utc, reverse=True):
-            if message.id <= last_id:
-                continue
-            if message.sender_id == my_id:
-                continue
-            if message and message.text:
-                messages_to_process.append(message)
-                if message.id > newest_message_id:
-                    newest_message_id = message.id
+        if prefetched_messages is not None:
+            # Сообщения уже доставлены обработчиком событий (режим демона), в Telegram не ходим
+            messages_to_process, newest_message_id = _select_new_messages(
+                prefetched_messages, last_id, my_id, today_start_utc
+            )
+        else:
+            print(" 	🔄 Получение новых сообщений, отправленных СЕГОДНЯ...")
+            messages_to_process, newest_message_id = await _fetch_new_messages(
+                client, entity, last_id, my_id, today_start_utc
+            )
 
         if not messages_to_process:
             if newest_message_id > last_id:
-                db.update_last_message_id(processing_id, newest_message_id)
+                await adb.update_last_message_id(processing_id, newest_message_id)
+            if completed_chats is not None:
+                completed_chats.add(original_chat_id)
             print(" 	✅ Новых сообщений для публичного ответа нет.")
             return None
 
@@ -79,28 +148,39 @@ async def process_chat_for_engagement(client, chat_info, my_id, keyword_triggers
             messages_for_ai_analysis = messages_to_process
         # --- КОНЕЦ БЛОКА ---
 
-        # 1. Проверка на ключевые слова (проверяем все сообщения, а не только последние 10)
-        if keyword_triggers:
+        # 1. Проверка на ключевые слова (проверяем все сообщения, а не только последние 10).
+        # Идет до AI-конвейера: оповещения не зависят от Gemini. Если из-за сбоя Gemini чат будет
+        # разобран заново, повторные оповещения отбросит outbox (тот же ключ идемпотентности)
+        if keyword_matcher:
             print(" 	🔍 Проверка сообщений на ключевые слова...")
+            alerts = []
             for message in messages_to_process:
-                if message.text and any(keyword.lower() in message.text.lower() for keyword in keyword_triggers):
-                    print(f" 	🚨 Найдено ключевое слово в сообщении {message.id}!")
+                matched_keywords = keyword_matcher.find_all(message.text)
+                if matched_keywords:
+                    print(f" 	🚨 Найдено ключевое слово в сообщении {message.id}: {', '.join(matched_keywords)}")
                     alert_payload = {
                         'action_type': 'keyword_alert',
                         'target_chat_id': processing_id,
                         'original_message_text': message.text,
                         'reply_to_message_id': message.id
                     }
-                    approval_service.send_action_for_approval(alert_payload)
+                    alerts.append(alert_payload)
+            # Все оповещения чата записываются в outbox вместе и уходят воркеру пачкой
+            await approval_outbox.enqueue_many(alerts)
         else:
             print(" 	ℹ️ Список ключевых слов пуст, проверка пропускается.")
 
         # 2. Запуск AI-конвейера для публичного ответа (используем ограниченный список)
         print(" 	🤖 Запуск AI-конвейера (Агент влияния)...")
-        routing_decisions = await ai_processor.get_routing_decisions(messages_for_ai_analysis)
+        # Сортировщику уходит один представитель каждого текста, а копии получают его решение
+        # (в том числе решение, запомненное в прошлых запусках)
+        await dedup.load()
+        messages_for_router, known_routing, router_groups = dedup.group_for_router(messages_for_ai_analysis)
+        new_routing = await ai_processor.get_routing_decisions(messages_for_router) if messages_for_router else []
+        routing_decisions = dedup.fan_out_routing_decisions(known_routing + new_routing, router_groups)
 
         if routing_decisions:
-            decisions_to_reply = [d for d in routing_decisions if d.get('decision') == 'reply']
+            decisions_to_reply = [d for d in routing_decisions if d.decision == 'reply']
             
             final_decision = None
             if decisions_to_reply:
@@ -109,14 +189,14 @@ async def process_chat_for_engagement(client, chat_info, my_id, keyword_triggers
                 final_decision = decisions_to_reply[0]
 
             if final_decision:
-                message_id_to_reply = final_decision.get('message_id')
-                persona = final_decision.get('persona')
+                message_id_to_reply = final_decision.message_id
+                persona = final_decision.persona
                 # Важно: ищем сообщение в полном списке, чтобы получить правильный объект
                 message_map = {msg.id: msg for msg in messages_to_process}
                 target_message = message_map.get(message_id_to_reply)
 
                 # --- НАЧАЛО НОВОГО БЛОКА ПРОВЕРКИ ---
-                if target_message and db.was_user_contacted_today(target_message.sender_id):
+                if target_message and await adb.was_user_contacted_today(target_message.sender_id):
                     print(f" 	🚫 Пользователь {target_message.sender_id} уже получал ответ сегодня. Ответ от 'Агента влияния' пропускается.")
                 # --- КОНЕЦ НОВОГО БЛОКА ПРОВЕРКИ ---
                 
@@ -142,7 +222,7 @@ async def process_chat_for_engagement(client, chat_info, my_id, keyword_triggers
                     
                     if final_action:
                         print(" 	🚀 Сгенерирован 1 публичный ответ. Отправка на утверждение...")
-                        approval_service.send_action_for_approval(final_action)
+                        await approval_outbox.enqueue(final_action)
                     else:
                         print(" 	✅ AI решил ответить, но генератор не создал финальный текст.")
             else:
@@ -150,13 +230,77 @@ async def process_chat_for_engagement(client, chat_info, my_id, keyword_triggers
 
         # Обновляем ID последнего сообщения в базе данных (используя ID из полного списка)
         if newest_message_id > last_id:
-            db.update_last_message_id(processing_id, newest_message_id)
+            await adb.update_last_message_id(processing_id, newest_message_id)
+        if completed_chats is not None:
+            completed_chats.add(original_chat_id)
 
         # Возвращаем полный список собранных сообщений для "Охотника за лидами"
         return messages_to_process
 
+    except (errors.ChannelInvalidError, errors.ChannelPrivateError, errors.PeerIdInvalidError) as e:
+        # Сохраненный access_hash больше не подходит: в следующий раз разрешим чат заново
+        print(f"❌ Чат {original_chat_id} недоступен по сохраненным данным ({e}). Кэш сущности сброшен.")
+        await entity_cache.invalidate(chat_info)
+        return None
+    except errors.FloodWaitError:
+        # Ожидание по FloodWait решает планировщик: он приостанавливает все чаты и повторяет этот
+        raise
+    except model_client.ModelCallError as e:
+        # Временный сбой Gemini (таймауты, 429, 5xx, автомат защиты). Если запрос отвергнут (ModelRequestError),
+        # ai_processor возвращает пустой результат, и ID сдвигается как обычно.
+        # Здесь ID последнего сообщения не сдвигается: чат будет разобран заново в следующий раз
+        print(f"❌ Gemini недоступен для чата {original_chat_id} ({e}). Новые сообщения останутся необработанными до следующего запуска.")
+        return None
     except Exception as e:
         print(f"❌ Произошла критическая ошибка при обработке чата {original_chat_id}: {e}")
         return None
     finally:
-        print("-" * 50)
\ No newline at end of file
+        print("-" * 50)
+
+
+async def process_chats_for_engagement(client, target_chats, my_id, keyword_matcher, prefetched_messages=None, completed_chats=None):
+    """
+    Обрабатывает несколько чатов одновременно (не более CHAT_PROCESSING_CONCURRENCY за раз).
+
+    Все изменения состояния одного чата по-прежнему выполняются последовательно внутри его
+    собственной корутины. При FloodWaitError новые запросы к Telegram приостанавливаются для
+    всех чатов на указанное время, а пострадавший чат обрабатывается повторно.
+    Возвращает все собранные сообщения в порядке target_chats, чтобы вход
+    "Охотника за лидами" не зависел от того, какой чат закончил раньше.
+    prefetched_messages — необязательный словарь {chat_id из target_chats: [сообщения]}.
+    completed_chats — необязательное множество, куда добавляются ID полностью разобранных чатов.
+    """
+    semaphore = asyncio.Semaphore(config.CHAT_PROCESSING_CONCURRENCY)
+    resume_at = 0.0  # time.monotonic(), до которого Telegram просил подождать
+
+    async def run_chat(chat_info):
+        nonlocal resume_at
+        chat_id = chat_info['chat_id']
+        for attempt in range(config.FLOOD_WAIT_MAX_RETRIES + 1):
+            async with semaphore:
+                delay = resume_at - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                try:
+                    return await process_chat_for_engagement(
+                        client, chat_info, my_id, keyword_matcher,
+                        prefetched_messages=prefetched_messages.get(chat_id) if prefetched_messages else None,
+                        completed_chats=completed_chats
+                    )
+                except errors.FloodWaitError as e:
+                    wait_seconds = e.seconds
+
+            if wait_seconds > config.FLOOD_WAIT_MAX_SECONDS or attempt == config.FLOOD_WAIT_MAX_RETRIES:
+                print(f"❌ FloodWait {wait_seconds} с. для чата {chat_id}. Чат пропускается в этом запуске.")
+                return None
+            print(f"⏳ FloodWait: Telegram просит подождать {wait_seconds} с. Чат {chat_id} будет обработан повторно.")
+            resume_at = max(resume_at, time.monotonic() + wait_seconds)
+        return None
+
+    results = await asyncio.gather(*(run_chat(chat_info) for chat_info in target_chats))
+
+    all_messages = []
+    for processed_messages in results:
+        if processed_messages:
+            all_messages.extend(processed_messages)
+    return all_messages
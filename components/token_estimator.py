@@ -0,0 +1,139 @@
+# components/token_estimator.py
+
+"""
+Локальная оценка длины промпта в токенах Gemini.
+
+Раньше перед каждым вызовом Gemini выполнялся count_tokens_async — отдельный сетевой запрос
+только ради строчки в логе. Теперь длина оценивается локально по составу текста (кириллица,
+латиница, цифры, знаки препинания), а оценка калибруется по фактическому prompt_token_count,
+который Gemini и так возвращает в usage_metadata каждого ответа. Точный подсчет через API
+остается как отладочный режим (GEMINI_EXACT_TOKEN_COUNT=true).
+
+Поправки хранятся в таблице token_corrections: load() вызывается при старте, а save()
+записывает изменившиеся поправки, чтобы следующий запуск не начинал калибровку с нуля.
+"""
+
+import threading
+from . import async_database_manager as adb
+
+# Сколько символов каждого класса в среднем приходится на один токен
+_CHARS_PER_TOKEN = {
+    'latin': 4.0,
+    'cyrillic': 2.8,
+    'digit': 2.0,
+    'punct': 1.6,    # JSON-разметка: кавычки, скобки, двоеточия часто склеиваются с соседями
+    'space': 8.0,    # отступы indent=4 и переводы строк
+    'other': 1.2,    # эмодзи и прочие символы
+}
+
+# Вес нового наблюдения в скользящей поправке на этап
+_CALIBRATION_WEIGHT = 0.3
+
+_lock = threading.Lock()
+_correction = {}  # stage -> поправочный коэффициент (фактические / оценочные токены)
+_stats = {}       # stage -> {'calls', 'estimated', 'actual', 'measured_calls'}
+_dirty = set()    # этапы, поправку которых нужно записать в базу
+
+
+def _char_class(char):
+    if char.isspace():
+        return 'space'
+    if char.isdigit():
+        return 'digit'
+    if 'a' <= char.lower() <= 'z':
+        return 'latin'
+    if 'Ѐ' <= char <= 'ӿ':
+        return 'cyrillic'
+    if char.isalpha():
+        return 'latin'
+    if char.isprintable() and ord(char) < 0x2000:
+        return 'punct'
+    return 'other'
+
+
+def _raw_estimate(text):
+    counts = dict.fromkeys(_CHARS_PER_TOKEN, 0)
+    for char in text:
+        counts[_char_class(char)] += 1
+    return sum(count / _CHARS_PER_TOKEN[name] for name, count in counts.items())
+
+
+def estimate_tokens(text, stage=None):
+    """
+    Оценивает число токенов в тексте. Если указан этап (stage), применяется поправка,
+    накопленная по фактическим ответам Gemini для этого этапа.
+    """
+    if not text:
+        return 0
+    estimate = _raw_estimate(text)
+    if stage is not None:
+        with _lock:
+            estimate *= _correction.get(stage, 1.0)
+    return int(estimate) + 1
+
+
+def record_usage(stage, estimated_tokens, response):
+    """
+    Запоминает оценку и фактическую длину промпта из usage_metadata ответа
+    и уточняет поправку для этапа. Возвращает фактическое число токенов или None.
+    """
+    actual_tokens = getattr(getattr(response, 'usage_metadata', None), 'prompt_token_count', None)
+    with _lock:
+        stage_stats = _stats.setdefault(stage, {'calls': 0, 'estimated': 0, 'actual': 0, 'measured_calls': 0})
+        stage_stats['calls'] += 1
+        stage_stats['estimated'] += estimated_tokens
+        if actual_tokens and estimated_tokens:
+            stage_stats['actual'] += actual_tokens
+            stage_stats['measured_calls'] += 1
+            # Поправка считается к "сырой" оценке, поэтому убираем из наблюдения уже примененную
+            current = _correction.get(stage, 1.0)
+            observed = current * actual_tokens / estimated_tokens
+            _correction[stage] = current + _CALIBRATION_WEIGHT * (observed - current)
+            _dirty.add(stage)
+    return actual_tokens
+
+
+async def load():
+    """Загружает поправки, накопленные прошлыми запусками (уже уточненные в этом запуске не трогает)."""
+    corrections = await adb.load_token_corrections()
+    with _lock:
+        for stage, correction in corrections.items():
+            if stage not in _dirty:
+                _correction[stage] = correction
+    if corrections:
+        print(f"✅ Загружены поправки оценки токенов для этапов: {', '.join(sorted(corrections))}.")
+
+
+async def save():
+    """Записывает в базу поправки, изменившиеся с прошлого сохранения."""
+    with _lock:
+        if not _dirty:
+            return
+        stages = list(_dirty)
+        _dirty.clear()
+        corrections = {stage: _correction[stage] for stage in stages}
+    if not await adb.save_token_corrections(corrections):
+        with _lock:
+            _dirty.update(stages)
+
+
+def get_stats():
+    """Возвращает копию статистики: {stage: {'calls', 'estimated', 'actual', 'measured_calls', 'correction'}}."""
+    with _lock:
+        return {
+            stage: {**values, 'correction': round(_correction.get(stage, 1.0), 3)}
+            for stage, values in _stats.items()
+        }
+
+
+def print_stats():
+    """Печатает сводку оценочных и фактических токенов промптов по этапам."""
+    stats = get_stats()
+    if not stats:
+        return
+    print("\n--- 📊 Токены промптов за запуск (оценка / факт) ---")
+    for stage, values in stats.items():
+        print(
+            f"   {stage}: вызовов {values['calls']}, оценка {values['estimated']}, "
+            f"факт {values['actual']} (по {values['measured_calls']} ответам), поправка x{values['correction']}"
+        )
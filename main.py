@@ -1,16 +1,30 @@
 # main.py
 
 import asyncio
+import sys
 from datetime import date
 from telethon.sync import TelegramClient
-from telethon.sessions import StringSession
 
 # --- Компоненты системы ---
 from components import config
 from components import database_manager as db
+from components import async_database_manager as adb
 from components import telegram_processor
+from components import entity_cache
+from components import daemon_service
+from components import delivery_service
+from components import token_estimator
+from components import response_cache
+from components import dedup
+from components import prefilter
+from components import model_client
+from components import quota_governor
+from components import approval_service
+from components import approval_outbox
 # 💡 Импортируем наш новый менеджер сессий
 from components import session_manager 
+from components.postgres_session import PostgresSession
+from components.keyword_matcher import KeywordMatcher
 
 # --- Эта функция осталась без изменений ---
 async def initialize_first_run_of_day(client):
@@ -18,7 +32,7 @@ async def initialize_first_run_of_day(client):
     Выполняет первую инициализацию для нового дня.
     """
     print("\n--- 🌅 ПЕРВЫЙ ЗАПУСК ДНЯ: РЕЖИМ ИНИЦИАЛИЗАЦИИ ---\n")
-    target_chats = db.get_target_chats()
+    target_chats = await adb.get_target_chats()
     if not target_chats:
         print("ℹ️ Целевые чаты не найдены. Инициализация не требуется.")
         return
@@ -28,19 +42,19 @@ async def initialize_first_run_of_day(client):
         processing_id = chat_id
         print(f"▶️ Инициализация чата: {chat_id}")
         try:
-            entity = await client.get_entity(chat_id)
+            entity, linked_chat_id, linked_entity = await entity_cache.resolve_chat(client, chat_info)
             
             # Если это канал со связанным чатом, работаем с чатом комментариев
-            if hasattr(entity, 'linked_chat_id') and entity.linked_chat_id:
-                processing_id = entity.linked_chat_id
+            if linked_chat_id:
+                processing_id = linked_chat_id
                 print(f"   ✅ Канал {chat_id} связан с чатом для комментариев {processing_id}.")
-                entity_to_read = await client.get_entity(processing_id)
+                entity_to_read = linked_entity
             else:
                 entity_to_read = entity
 
             # Получаем последнее сообщение и обновляем ID в базе
             async for last_message in client.iter_messages(entity_to_read, limit=1):
-                db.update_last_message_id(processing_id, last_message.id)
+                await adb.update_last_message_id(processing_id, last_message.id)
                 break
             else:
                 print(f"   ⚠️ В чате {processing_id} нет сообщений, пропускаем.")
@@ -48,28 +62,41 @@ async def initialize_first_run_of_day(client):
         except Exception as e:
             print(f"   ❌ Ошибка при инициализации чата {chat_id}: {e}")
 
-    db.update_initialization_date()
+    # Дату инициализации ставим только после того, как ID сообщений реально записаны
+    if await adb.flush_pending_writes():
+        await adb.update_initialization_date()
     print("\n--- ✅ Инициализация на сегодня завершена ---")
 
 
-async def main():
+async def main(daemon_mode=False, deliver_mode=False):
     """
     Основная логика работы агента с интегрированным созданием и проверкой сессии.
+    В режиме демона (daemon_mode=True) агент не завершается после одного прохода,
+    а слушает новые сообщения целевых чатов (см. components/daemon_service.py).
+    В режиме доставки (deliver_mode=True) агент только отправляет одобренные действия
+    по мере их появления (см. components/delivery_service.py).
     """
-    if not db.is_agent_active():
+    if not await adb.is_agent_active():
         print("ℹ️ Агент неактивен в базе данных. Запуск отменен.")
         return
 
     # --- 🚀 НАДЁЖНАЯ СИСТЕМА УПРАВЛЕНИЯ СЕССИЕЙ ---
-    session_string = db.get_session_string()
+    # Сессия Telethon целиком (ключ, сущности, состояние обновлений) хранится в таблицах Neon
+    session = PostgresSession(config.SESSION_NAME)
+    if not session.auth_key:
+        # Однократный перенос старой StringSession из public.sessions
+        legacy_session_string = await adb.get_session_string()
+        if legacy_session_string:
+            print("ℹ️ Переносим сохраненную StringSession в хранилище сессий Telethon...")
+            session.import_string_session(legacy_session_string)
     client = None
 
     # Шаг 1: Попытка использовать существующую сессию
-    if session_string:
+    if session.auth_key:
         print("ℹ️ Найдена существующая сессия. Проверяем...")
         # Инициализируем клиент с уникальными параметрами
         client = TelegramClient(
-            StringSession(session_string), 
+            session,
             config.TELEGRAM_API_ID, 
             config.TELEGRAM_API_HASH,
             device_model="HR Vision Agent",
@@ -80,27 +107,29 @@ async def main():
             await client.connect()
             if not await client.is_user_authorized():
                 print("⚠️ Существующая сессия недействительна или истекла.")
-                session_string = None
                 await client.disconnect()
                 client = None
             else:
                 print("✅ Сессия действительна.")
         except Exception as e:
             print(f"⚠️ Ошибка при проверке сессии: {e}. Будет создана новая.")
-            session_string = None
             if client and client.is_connected():
                 await client.disconnect()
             client = None
 
     # Шаг 2: Создание новой сессии, если она отсутствует или невалидна
-    if not session_string:
+    if client is None:
         session_string = await session_manager.create_new_session()
         if not session_string:
             print("❌ Не удалось создать новую сессию. Работа агента прервана.")
             return
+        # Данные старой авторизации больше не нужны: начинаем хранилище сессии с чистого листа
+        session = PostgresSession(config.SESSION_NAME)
+        session.delete()
+        session.import_string_session(session_string)
         # После создания новой сессии, нужно заново инициализировать клиент для основной работы
         client = TelegramClient(
-            StringSession(session_string), 
+            session,
             config.TELEGRAM_API_ID, 
             config.TELEGRAM_API_HASH,
             device_model="HR Vision Agent",
@@ -109,53 +138,86 @@ async def main():
         )
     # --- КОНЕЦ СИСТЕМЫ УПРАВЛЕНИЯ СЕССИЕЙ ---
 
+    # Записи состояния за запуск копятся в памяти и сбрасываются в базу на контрольных точках
+    await adb.begin_unit_of_work()
     try:
+        # Сначала доставляем действия, оставшиеся в outbox с прошлых запусков
+        await approval_outbox.drain()
+        approval_outbox.start()
+
         # `async with` сам управляет подключением и отключением клиента
         async with client:
-            last_init_date = db.get_last_initialization_date()
+            if deliver_mode:
+                await delivery_service.run(client)
+                return
+
+            # Поправки оценки токенов продолжают калибровку прошлых запусков
+            await token_estimator.load()
+
+            last_init_date = await adb.get_last_initialization_date()
             today = date.today()
 
             # --- Первоначальная логика без изменений ---
             if last_init_date is None or last_init_date < today:
                 await initialize_first_run_of_day(client)
-                return
+                if not daemon_mode:
+                    return
 
-            print("\n--- ✨ ЗАПУСК HR VISION AGENT (РАБОЧИЙ РЕЖИМ) ✨ ---\n")
-            
             me = await client.get_me()
             my_id = me.id
+
+            if daemon_mode:
+                print(f"✅ Демон запущен от имени: {me.first_name} (ID: {my_id})")
+                await daemon_service.run_daemon(client, my_id, initialize_first_run_of_day)
+                return
+
+            print("\n--- ✨ ЗАПУСК HR VISION AGENT (РАБОЧИЙ РЕЖИМ) ✨ ---\n")
             print(f"✅ Скрипт запущен от имени: {me.first_name} (ID: {my_id})")
 
-            target_chats = db.get_target_chats()
+            # Состояние всех чатов (последний ID и время последнего ответа) грузим одним запросом
+            target_chats = await adb.get_target_chats_with_state()
             if not target_chats:
                 print("ℹ️ Целевые чаты для обработки не найдены.")
                 return
 
-            keyword_triggers = db.get_keyword_triggers()
-            all_messages_for_lead_hunter = []
-            
-            print("\n--- 🚀 Начало последовательной обработки чатов (Агент влияния) ---")
-            for chat_info in target_chats:
-                processed_messages = await telegram_processor.process_chat_for_engagement(
-                    client, chat_info, my_id, keyword_triggers
-                )
-                if processed_messages:
-                    all_messages_for_lead_hunter.extend(processed_messages)
-            
+            # Автомат для поиска ключевых слов строится один раз на весь запуск
+            keyword_matcher = KeywordMatcher(
+                await adb.get_keyword_triggers(), whole_words=config.KEYWORD_MATCH_WHOLE_WORDS
+            )
+
+            print(f"\n--- 🚀 Начало параллельной обработки чатов (Агент влияния, до {config.CHAT_PROCESSING_CONCURRENCY} одновременно) ---")
+            all_messages_for_lead_hunter = await telegram_processor.process_chats_for_engagement(
+                client, target_chats, my_id, keyword_matcher
+            )
+
             print("\n--- ✅ Все чаты обработаны 'Агентом влияния' ---")
+            await adb.flush_pending_writes()
 
+            from components import lead_hunter_service 
             if all_messages_for_lead_hunter:
                 print("\n--- 🕵️‍♂️ Запуск 'Охотника за лидами' по всем собранным сообщениям ---")
-                from components import lead_hunter_service 
                 await lead_hunter_service.find_and_process_leads(client, all_messages_for_lead_hunter)
                 print("\n--- ✅ Поиск лидов завершен ---")
             else:
                 print("\n--- ℹ️ Новых сообщений для поиска лидов не найдено ---")
-
+                # Сообщения, отложенные прошлыми запусками из-за недоступности Gemini, обрабатываются и без новых
+                await lead_hunter_service.find_and_process_leads(client, [])
+
+            token_estimator.print_stats()
+            response_cache.print_stats()
+            prefilter.print_stats()
+            model_client.print_stats()
+            quota_governor.print_stats()
             print("\n--- 🏁 Работа агента на этот запуск завершена ---\n")
 
     except Exception as e:
         print(f"❌ Критическая ошибка в main: {e}")
+    finally:
+        await approval_outbox.stop()
+        await approval_service.close()
+        await dedup.save()
+        await token_estimator.save()
+        await adb.end_unit_of_work()
 
 
 if __name__ == "__main__":
@@ -165,8 +227,13 @@ if __name__ == "__main__":
         # Убедимся, что база данных готова к работе
         if hasattr(db, 'init_db'):
             db.init_db()
-        asyncio.run(main())
+        # `python -u main.py --daemon` — постоянная работа вместо одного прохода,
+        # `python -u main.py --deliver` — только доставка одобренных действий
+        asyncio.run(main(daemon_mode='--daemon' in sys.argv, deliver_mode='--deliver' in sys.argv))
     except ValueError as e:
         print(e)
     except Exception as e:
-        print(f"❌ Непредвиденная ошибка при запуске: {e}")
\ No newline at end of file
+        print(f"❌ Непредвиденная ошибка при запуске: {e}")
+    finally:
+        # Соединения с Neon живут весь запуск, закрываем их один раз при выходе
+        db.close_pool()
\ No newline at end of file
@@ -0,0 +1,59 @@
+# stub_approval_worker.py
+
+"""
+Локальная заглушка Cloudflare Worker для проверки отправки действий на утверждение.
+
+Принимает POST / (одно действие) и POST /batch ({"actions": [...]}), печатает полученное
+и хранит все действия в памяти; GET /actions возвращает их списком. Флаг --fail-rate
+позволяет случайно отвечать 503, чтобы проверить повторы и outbox.
+
+Запуск:
+    python stub_approval_worker.py --port 8787
+и в .env:
+    CLOUDFLARE_WORKER_URL=http://127.0.0.1:8787/
+    APPROVAL_BATCH_URL=http://127.0.0.1:8787/batch
+"""
+
+import argparse
+import random
+from aiohttp import web
+
+
+def create_app(fail_rate=0.0):
+    received = []
+
+    def _maybe_fail():
+        if random.random() < fail_rate:
+            raise web.HTTPServiceUnavailable(text="stub: simulated failure")
+
+    async def single(request):
+        _maybe_fail()
+        action = await request.json()
+        received.append(action)
+        print(f"📥 {action.get('action_type')}: {action.get('original_message_text', '')[:60]!r}")
+        return web.json_response({'ok': True})
+
+    async def batch(request):
+        _maybe_fail()
+        actions = (await request.json()).get('actions', [])
+        received.extend(actions)
+        print(f"📥 Пачка из {len(actions)} действий")
+        return web.json_response({'ok': True, 'accepted': len(actions)})
+
+    async def list_actions(request):
+        return web.json_response(received)
+
+    app = web.Application()
+    app.router.add_post('/', single)
+    app.router.add_post('/batch', batch)
+    app.router.add_get('/actions', list_actions)
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Заглушка воркера утверждений")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8787)
+    parser.add_argument('--fail-rate', type=float, default=0.0, help="доля запросов, на которые отвечать 503")
+    args = parser.parse_args()
+    web.run_app(create_app(args.fail_rate), host=args.host, port=args.port)